@@ -49,6 +49,11 @@ function adversarial.train(dataset, maxAccuracyD, accsInterval)
     local countNotTrainedD = 0
     local countLrIncreasedD = 0
     local countLrDecreasedD = 0 
+    -- sums of the losses of D and G over this epoch
+    local lossSumD = 0.0
+    local lossCountD = 0
+    local lossSumG = 0.0
+    local lossCountG = 0
     --samples = nil
 
     local batchIdx = 0
@@ -58,6 +63,18 @@ function adversarial.train(dataset, maxAccuracyD, accsInterval)
     -- in reality the examples (per batch) will be picked randomly
     print(string.format("<trainer> Epoch #%d [batchSize = %d]", EPOCH, OPT.batchSize))
     for t = 1,N_epoch,dataBatchSize do
+        -- stop early if the next batch (estimated by the mean time of the batches
+        -- so far) would not finish before the deadline of --timeBudget
+        if TRAIN_DEADLINE ~= nil then
+            local now = sys.clock()
+            local batchTime = 0
+            if batchIdx > 0 then batchTime = (now - time) / batchIdx end
+            if now + batchTime > TRAIN_DEADLINE then
+                BUDGET_EXHAUSTED = true
+                break
+            end
+        end
+
         -- size of this batch, will usually be dataBatchSize but can be lower at the end
         local thisBatchSize = math.min(OPT.batchSize, N_epoch - t + 1)
         
@@ -172,6 +189,8 @@ function adversarial.train(dataset, maxAccuracyD, accsInterval)
             -- G generating garbage.
             doTrainD = (accAvg < maxAccuracyD)
             lastAccuracyD = tV
+            lossSumD = lossSumD + f
+            lossCountD = lossCountD + 1
             if doTrainD then
                 countTrainedD = countTrainedD + 1
                 return f,GRAD_PARAMETERS_D
@@ -233,6 +252,9 @@ function adversarial.train(dataset, maxAccuracyD, accsInterval)
                 GRAD_PARAMETERS_G:clamp((-1)*OPT.G_clamp, OPT.G_clamp)
             end
 
+            lossSumG = lossSumG + f
+            lossCountG = lossCountG + 1
+
             return f,GRAD_PARAMETERS_G
         end
         ----------------------------------------------------------------------
@@ -295,6 +317,7 @@ function adversarial.train(dataset, maxAccuracyD, accsInterval)
         ----------------------------------------------------------------------
 
         batchIdx = batchIdx + 1
+        BATCHES_COMPLETED = (BATCHES_COMPLETED or 0) + 1
         
         -- display progress
         xlua.progress(t + thisBatchSize, N_epoch)
@@ -307,9 +330,10 @@ function adversarial.train(dataset, maxAccuracyD, accsInterval)
 
     -- time taken
     time = sys.clock() - time
-    print(string.format("<trainer> time required for this epoch = %d s", time))
+    print(string.format("<trainer> time required for this epoch = %.3f s", time))
     print(string.format("<trainer> time to learn 1 sample = %f ms", 1000 * time/N_epoch))
     print(string.format("<trainer> trained D %d of %d times.", countTrainedD, countTrainedD + countNotTrainedD))
+    print(string.format("<trainer> mean loss D = %f, G = %f", lossSumD / math.max(1, lossCountD), lossSumG / math.max(1, lossCountG)))
     
     -- old code for self-adjusting learning rate
     --print(string.format("<trainer> adam learning rate D:%.5f | G:%.5f", OPTSTATE.adam.D.learningRate, OPTSTATE.adam.G.learningRate))
@@ -322,7 +346,8 @@ function adversarial.train(dataset, maxAccuracyD, accsInterval)
     CONFUSION:zero()
 
     -- save/log current net
-    if EPOCH % OPT.saveFreq == 0 then
+    -- (always save if the time budget ran out, as training ends here)
+    if EPOCH % OPT.saveFreq == 0 or BUDGET_EXHAUSTED then
         local filename = paths.concat(OPT.save, 'adversarial.net')
         os.execute(string.format("mkdir -p %s", sys.dirname(filename)))
         if paths.filep(filename) then
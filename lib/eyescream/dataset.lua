@@ -12,6 +12,10 @@ dataset.scale = 32
 dataset.nbChannels = 3
 -- cache for filepaths to all images
 dataset.paths = nil
+-- packed shards (see dataset/shards.py), used instead of the image files if
+-- the directories contain any
+dataset.shardExtension = "shard"
+dataset.shards = nil
 
 -- Set one or more directories to load images from
 -- @param dirs Table of directories, e.g. {"/path/to/images", "/another/path"}
@@ -73,21 +77,121 @@ function dataset.loadImages(startAt, count)
     return result
 end
 
+-- Reads a little endian unsigned integer from a ByteStorage.
+-- @param storage The ByteStorage.
+-- @param offset Offset of the first byte (0-based, like in the file).
+-- @param nbBytes Size of the integer in bytes.
+-- @return Number
+local function readUInt(storage, offset, nbBytes)
+    local val = 0
+    for i=nbBytes, 1, -1 do
+        val = val * 256 + storage[offset + i]
+    end
+    return val
+end
+
+-- Memory-maps a shard written by dataset/shards.py.
+-- @param file Path to the shard.
+-- @return Table with the number of images (count) and a ByteTensor (data) of
+--         size count x height x width x channels backed by the file.
+function dataset.loadShard(file)
+    -- not shared: pages are mapped privately and read on demand
+    local storage = torch.ByteStorage(file, false)
+    local magic = {}
+    for i=1, 8 do
+        magic[i] = string.char(storage[i])
+    end
+    if table.concat(magic) ~= "EYESHRD1" or readUInt(storage, 8, 4) ~= 1 then
+        error('not a shard of version 1: ' .. file)
+    end
+
+    local count = readUInt(storage, 12, 4)
+    local height = readUInt(storage, 16, 4)
+    local width = readUInt(storage, 20, 4)
+    local channels = readUInt(storage, 24, 4)
+    local dataOffset = readUInt(storage, 28, 8)
+    local shard = {file = file, count = count, channels = channels}
+    if count > 0 then
+        shard.data = torch.ByteTensor(storage, dataOffset + 1, torch.LongStorage{count, height, width, channels})
+    end
+    return shard
+end
+
+-- Finds the shards in directories.
+-- @param dirs Table of directories.
+-- @return Table of shards (see loadShard()), sorted by filename, with the
+--         total number of images in .nbImages.
+function dataset.loadShards(dirs)
+    local files = {}
+    for i=1, #dirs do
+        for file in paths.files(dirs[i]) do
+            if file:find('%.' .. dataset.shardExtension .. '$') then
+                table.insert(files, paths.concat(dirs[i], file))
+            end
+        end
+    end
+    table.sort(files, function (a,b) return a < b end)
+
+    local shards = {nbImages = 0}
+    for i=1, #files do
+        local shard = dataset.loadShard(files[i])
+        if shard.count > 0 then
+            shard.first = shards.nbImages + 1
+            shards.nbImages = shards.nbImages + shard.count
+            table.insert(shards, shard)
+        end
+    end
+    return shards
+end
+
+-- Returns one image of a set of shards.
+-- @param shards Shards from loadShards().
+-- @param index Number of the image (1 to shards.nbImages).
+-- @return FloatTensor of size nbChannels x height x width, values 0 to 1.
+function dataset.shardImage(shards, index)
+    -- binary search for the shard containing the image
+    local low, high = 1, #shards
+    while low < high do
+        local mid = math.floor((low + high + 1) / 2)
+        if shards[mid].first <= index then
+            low = mid
+        else
+            high = mid - 1
+        end
+    end
+    local shard = shards[low]
+
+    local img = shard.data[index - shard.first + 1]:permute(3, 1, 2):float():div(255)
+    if dataset.nbChannels == 1 and shard.channels == 3 then
+        img = image.rgb2y(img)
+    elseif dataset.nbChannels == 3 and shard.channels == 1 then
+        img = img:expand(3, img:size(2), img:size(3)):contiguous()
+    end
+    return img
+end
+
 -- Loads a defined number of randomly selected images from
--- the cached paths (cached in loadPaths()).
+-- the cached paths (cached in loadPaths()) or shards.
 -- @param count Number of random images.
 -- @return List of Tensors
 function dataset.loadRandomImages(count)
-    if dataset.paths == nil then
+    if dataset.paths == nil and dataset.shards == nil then
         dataset.loadPaths()
     end
 
-    local shuffle = torch.randperm(#dataset.paths)    
-    
     local images = {}
-    for i=1,math.min(shuffle:size(1), count) do
-       -- load each image
-       table.insert(images, image.load(dataset.paths[shuffle[i]], dataset.nbChannels, "float"))
+    if dataset.shards ~= nil then
+        local shuffle = torch.randperm(dataset.shards.nbImages)
+        for i=1,math.min(shuffle:size(1), count) do
+            table.insert(images, dataset.shardImage(dataset.shards, shuffle[i]))
+        end
+    else
+        local shuffle = torch.randperm(#dataset.paths)
+
+        for i=1,math.min(shuffle:size(1), count) do
+           -- load each image
+           table.insert(images, image.load(dataset.paths[shuffle[i]], dataset.nbChannels, "float"))
+        end
     end
     
     local data = torch.FloatTensor(#images, dataset.nbChannels, dataset.scale, dataset.scale)
@@ -117,8 +221,16 @@ function dataset.loadRandomImages(count)
 end
 
 -- Loads the paths of all images in the defined files
--- (with defined file extensions)
+-- (with defined file extensions). If the directories contain shards, those
+-- are memory-mapped instead (see loadShards()).
 function dataset.loadPaths()
+    local shards = dataset.loadShards(dataset.dirs)
+    if shards.nbImages > 0 then
+        print(string.format("<dataset> Loaded %d shards with %d images", #shards, shards.nbImages))
+        dataset.shards = shards
+        return
+    end
+
     local files = {}
     local dirs = dataset.dirs
     local ext = dataset.fileExtension
@@ -154,6 +266,17 @@ end
 -- @param scale Desired height/width of images.
 -- @return FloatTensor
 function dataset.loadImagesFromDirs(dirs, ext, startAt, count, doSort, scale)
+    -- shards are already in sorted order and need no decoding
+    local shards = dataset.loadShards(dirs)
+    if shards.nbImages > 0 then
+        local endAt = math.min(startAt+count-1, shards.nbImages)
+        local images = torch.FloatTensor(math.max(0, endAt-startAt+1), dataset.nbChannels, scale, scale)
+        for i=startAt, endAt do
+            images[i-startAt+1] = image.scale(dataset.shardImage(shards, i), scale, scale)
+        end
+        return images
+    end
+
     -- code from: https://github.com/andresy/torch-demos/blob/master/load-data/load-images.lua
     local files = {}
 
@@ -17,7 +17,19 @@ Example usage:
 from __future__ import division
 from skimage import transform as tf
 import numpy as np
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import os
+import queue
 import random
+import threading
+from timeit import default_timer as timer
+from . import warp
+from .sampling_cache import SamplingCache
+
+# dtypes that augment_batch() and apply_aug_matrices() may return, uint8 in
+# 0-255, floats in 0.0-1.0
+OUTPUT_DTYPES = [np.dtype(np.uint8), np.dtype(np.float16), np.dtype(np.float32)]
 
 def is_minmax_tuple(param):
     """Returns whether the parameter is a tuple containing two values.
@@ -36,13 +48,14 @@ def create_aug_matrices(nb_matrices, img_width_px, img_height_px,
                         scale_to_percent=1.0, scale_axis_equally=False,
                         rotation_deg=0, shear_deg=0,
                         translation_x_px=0, translation_y_px=0,
-                        seed=None):
+                        seed=None, as_transforms=False, random_state=None):
     """Creates the augmentation matrices that may later be used to transform
     images.
 
-    This is a wrapper around scikit-image's transform.AffineTransform class.
-    You can apply those matrices to images using the apply_aug_matrices()
-    function.
+    The matrices are the same as the ones of scikit-image's
+    transform.AffineTransform class, but all of them are generated at once
+    and returned as one array. You can apply those matrices to images using
+    the apply_aug_matrices() function.
 
     Args:
         nb_matrices: How many matrices to return, e.g. 100 returns 100 different
@@ -89,9 +102,17 @@ def create_aug_matrices(nb_matrices, img_width_px, img_height_px,
         translation_y_px: Same as in ImageAugmenter.__init__().
             See translation_x_px, just for the y-axis.
         seed: Seed to use for python's and numpy's random functions.
+        as_transforms: Whether to return a list of scikit-image transforms
+            instead of an array, see matrices_to_transforms().
+            Default is False.
+        random_state: Optional numpy.random.RandomState to draw the random
+            values from instead of numpy's global random state, which seed
+            then leaves untouched. Default is None.
 
     Returns:
-        List of augmentation matrices.
+        Numpy array of shape (nb_matrices, 3, 3), dtype float32, with the
+        inverse augmentation matrices (mapping coordinates of the augmented
+        image to the original one, as expected by transform.warp()).
     """
     assert nb_matrices > 0
     assert img_width_px > 0
@@ -102,11 +123,11 @@ def create_aug_matrices(nb_matrices, img_width_px, img_height_px,
     assert is_minmax_tuple(translation_x_px) or translation_x_px >= 0
     assert is_minmax_tuple(translation_y_px) or translation_y_px >= 0
 
-    if seed is not None:
-        random.seed(seed)
-        np.random.seed(seed)
-
-    result = []
+    if random_state is None:
+        if seed is not None:
+            random.seed(seed)
+            np.random.seed(seed)
+        random_state = np.random
 
     shift_x = int(img_width_px / 2.0)
     shift_y = int(img_height_px / 2.0)
@@ -157,54 +178,73 @@ def create_aug_matrices(nb_matrices, img_width_px, img_height_px,
         translation_y_px_min = (-1) * translation_y_px
         translation_y_px_max = translation_y_px
 
-    # create nb_matrices randomized affine transformation matrices
-    for _ in range(nb_matrices):
-        # generate random values for scaling, rotation, shear, translation
-        scale_x = random.uniform(scale_x_min, scale_x_max)
-        if scale_axis_equally:
-            scale_y = scale_x
-        else:
-            scale_y = random.uniform(scale_y_min, scale_y_max)
-        rotation = np.deg2rad(random.randint(rotation_deg_min, rotation_deg_max))
-        shear = np.deg2rad(random.randint(shear_deg_min, shear_deg_max))
-        translation_x = random.randint(translation_x_px_min, translation_x_px_max)
-        translation_y = random.randint(translation_y_px_min, translation_y_px_max)
-
-        # create three affine transformation matrices
-        # 1st one moves the image to the top left, 2nd one transforms it, 3rd one
-        # moves it back to the center.
-        # The movement is neccessary, because rotation is applied to the top left
-        # and not to the image's center (same for scaling and shear).
-        #print("scale_x", scale_x, "scale_y", scale_y)
-        #scale_shift_x = ((img_width_px * scale_x) - img_width_px) / 2
-        #scale_shift_y = ((img_height_px * scale_y) - img_height_px) / 2
-        #print("img_width_px", img_width_px, "img_height_px", img_height_px)
-        #print("scale shift x", scale_shift_x, "scale shift y", scale_shift_y)
-        #matrix_scale = tf.AffineTransform(scale=(scale_x, scale_y))
-        #matrix_scale_shift = tf.SimilarityTransform(translation=[scale_shift_x, scale_shift_y])
-        matrix_to_topleft = tf.SimilarityTransform(translation=[-shift_x, -shift_y])
-        matrix_transforms = tf.AffineTransform(scale=(scale_x, scale_y),
-                                               rotation=rotation, shear=shear,
-                                               translation=(translation_x,
-                                                            translation_y))
-        matrix_to_center = tf.SimilarityTransform(translation=[shift_x, shift_y])
-
-        # Combine the three matrices to one affine transformation (one matrix)
-        #matrix = matrix_scale + matrix_scale_shift + matrix_to_topleft + matrix_transforms + matrix_to_center
-        matrix = matrix_to_topleft + matrix_transforms + matrix_to_center
-
-        # one matrix is ready, add it to the result
-        result.append(matrix.inverse)
-
+    # All random values at once, one row per matrix: scale x, scale y,
+    # rotation, shear, translation x, translation y. Rotation, shear and
+    # translation are whole degrees/pixels, uniformly drawn from [min, max].
+    values = random_state.uniform(size=(nb_matrices, 6))
+    scale_x = scale_x_min + values[:, 0] * (scale_x_max - scale_x_min)
+    if scale_axis_equally:
+        scale_y = scale_x
+    else:
+        scale_y = scale_y_min + values[:, 1] * (scale_y_max - scale_y_min)
+    rotation = np.deg2rad(_uniform_int(values[:, 2], rotation_deg_min, rotation_deg_max))
+    shear = np.deg2rad(_uniform_int(values[:, 3], shear_deg_min, shear_deg_max))
+    translation_x = _uniform_int(values[:, 4], translation_x_px_min, translation_x_px_max)
+    translation_y = _uniform_int(values[:, 5], translation_y_px_min, translation_y_px_max)
+
+    # The combination of three affine transformations: the 1st one moves the
+    # image to the top left, the 2nd one transforms it (like
+    # tf.AffineTransform(scale, rotation, shear, translation), with shear
+    # added to the rotation of the y-axis), the 3rd one moves it back to the
+    # center.
+    # The movement is neccessary, because rotation is applied to the top left
+    # and not to the image's center (same for scaling and shear).
+    matrices = np.zeros((nb_matrices, 3, 3), dtype=np.float64)
+    matrices[:, 0, 0] = scale_x * np.cos(rotation)
+    matrices[:, 0, 1] = -scale_y * np.sin(rotation + shear)
+    matrices[:, 1, 0] = scale_x * np.sin(rotation)
+    matrices[:, 1, 1] = scale_y * np.cos(rotation + shear)
+    matrices[:, 0, 2] = translation_x + shift_x \
+        - matrices[:, 0, 0] * shift_x - matrices[:, 0, 1] * shift_y
+    matrices[:, 1, 2] = translation_y + shift_y \
+        - matrices[:, 1, 0] * shift_x - matrices[:, 1, 1] * shift_y
+    matrices[:, 2, 2] = 1
+
+    # images are warped with the inverse (output to input coordinates)
+    result = np.linalg.inv(matrices).astype(np.float32)
+    if as_transforms:
+        return matrices_to_transforms(result)
     return result
 
+def _uniform_int(values, min_value, max_value):
+    """Maps uniform random values in [0, 1) to integers in [min_value, max_value]."""
+    return np.floor(min_value + values * (max_value - min_value + 1)).clip(max=max_value)
+
+def matrices_to_transforms(matrices):
+    """Converts augmentation matrices as returned by create_aug_matrices() to
+    a list of scikit-image transforms (e.g. for plotting or transform.warp()).
+
+    Args:
+        matrices: Numpy array of shape (N, 3, 3).
+
+    Returns:
+        List of N skimage.transform.AffineTransform.
+    """
+    return [tf.AffineTransform(matrix=np.asarray(matrix, dtype=np.float64))
+            for matrix in matrices]
+
 def apply_aug_matrices(images, matrices, transform_channels_equally=True,
                        channel_is_first_axis=False, random_order=True,
                        mode="constant", cval=0.0, interpolation_order=1,
-                       seed=None):
+                       seed=None, batched=True, sampling_cache=None,
+                       flips=None, brightness=None, noise_mean=0.0,
+                       noise_std=0.0, dtype=np.float32, out=None,
+                       backend="float", random_state=None):
     """Augment the given images using the given augmentation matrices.
 
-    This function is a wrapper around scikit-image's transform.warp().
+    This function is a wrapper around scikit-image's transform.warp(), or
+    for interpolation orders 0 and 1 its vectorized counterpart
+    warp.warp_batch(), which warps the whole batch at once.
     It is expected to be called by ImageAugmenter.augment_batch().
     The matrices may be generated by create_aug_matrices().
 
@@ -218,8 +258,9 @@ def apply_aug_matrices(images, matrices, transform_channels_equally=True,
             channels, where the channel is the last index.
             If your shape is (image-index, channel, width, height) then
             you must also set channel_is_first_axis=True in the constructor.
-        matrices: A list of augmentation matrices as produced by
-            create_aug_matrices().
+        matrices: The augmentation matrices as produced by
+            create_aug_matrices(), a numpy array of shape (N, 3, 3) or a
+            list of scikit-image transforms.
         transform_channels_equally: Same as in ImageAugmenter.__init__().
             Whether to apply the exactly same
             transformations to each channel of an image (True). Setting
@@ -252,6 +293,48 @@ def apply_aug_matrices(images, matrices, transform_channels_equally=True,
             generate the new/augmented image. See their documentation for
             further details.
         seed: Seed to use for python's and numpy's random functions.
+        batched: Whether to warp all images (and channels) at once with
+            warp.warp_batch() (True) or one by one with scikit-image's
+            transform.warp() (False). Only interpolation orders 0 and 1 are
+            batched, others always use scikit-image. The results match
+            scikit-image's within float32 precision.
+            Default is True.
+        sampling_cache: Optional sampling_cache.SamplingCache to look up
+            the samplings of the matrices in (batched only). It is ignored
+            if it was created for another image size, order or mode.
+        flips: Optional numpy array of shape (image-index, 2) of booleans,
+            whether to flip each image horizontally (column 0) and/or
+            vertically (column 1) before applying its matrices. The flips
+            are folded into the matrices (see fold_flips()), so they cost
+            no pass over the images.
+        brightness: Optional factor per image to multiply its augmented
+            values with, e.g. 1.1 to brighten it by 10%.
+        noise_mean: Mean of the gaussian noise added to each augmented
+            pixel (in units of 0.0-1.0).
+        noise_std: Standard deviation of the gaussian noise. Default is 0.0
+            (no noise).
+        dtype: Dtype of the augmented images, one of OUTPUT_DTYPES. uint8
+            images keep the values 0-255 (rounded), float16 and float32
+            images are scaled to 0.0-1.0. Default is float32.
+        out: Optional numpy array of the shape of images and that dtype to
+            write the augmented images to. Together with a float32 out or
+            dtype uint8/float16, no array of the size of the batch is
+            allocated (the warping uses reused buffers, see
+            warp.scratch_array()).
+        backend: One of warp.BACKENDS, how the batched warping interpolates
+            (ignored by scikit-image). "integer" warps into uint8 images
+            directly, which are at most one intensity level off the rounded
+            float results (order 1, see warp.FIXED_POINT_BITS) and exact
+            for order 0. Brightness is then applied through a lookup table
+            per image, i.e. to the rounded values. Default is "float".
+        random_state: Optional numpy.random.RandomState to draw the random
+            order and the noise from instead of numpy's global random state,
+            which seed then leaves untouched. Default is None.
+
+    Returns:
+        Augmented images as numpy array of the shape of images and the given
+        dtype (out if given). If brightness or noise were applied, the values
+        are clipped to the value range.
     """
     # images must be numpy array
     assert type(images).__module__ == np.__name__, "Expected numpy array for " \
@@ -267,8 +350,15 @@ def apply_aug_matrices(images, matrices, transform_channels_equally=True,
         or (image index, channel, y, x) / (image index, y, x, channel)
         for multi-channel (usually color) images."""
 
-    if seed:
-        np.random.seed(seed)
+    dtype = np.dtype(dtype)
+    assert dtype in OUTPUT_DTYPES, "Expected one of %s as dtype." % (str(OUTPUT_DTYPES),)
+    assert out is None or (out.shape == images.shape and out.dtype == dtype), \
+        "Expected out to have the shape of images and dtype %s." % (dtype.name,)
+
+    if random_state is None:
+        if seed:
+            np.random.seed(seed)
+        random_state = np.random
 
     nb_images = images.shape[0]
 
@@ -313,13 +403,153 @@ def apply_aug_matrices(images, matrices, transform_channels_equally=True,
         # translate by 1px and 50% by 0px. As a result, 75% of all augmentations
         # will transform both images in the same way.
         # The effect decreases if more matrices or images are chosen.
-        order_indices = np.random.random_integers(0, len(matrices) - 1, len_indices)
+        order_indices = random_state.randint(0, len(matrices), len_indices)
     else:
         # monotonously growing indexes (each by +1), but none of them may be
         # higher than or equal to the number of matrices
         order_indices = np.arange(0, len_indices) % len(matrices)
 
-    result = np.zeros(images.shape, dtype=np.float32)
+    # The matrix of each image, or of each channel (image by image) if the
+    # channels are not transformed equally. Only the first nb_images indices
+    # are used for channels that are transformed equally.
+    warps_per_image = 1 if not has_channels or transform_channels_equally \
+        else nb_channels
+    matrices = warp.as_matrix_array(matrices)[order_indices[:nb_images * warps_per_image]]
+    if flips is not None:
+        image_shape = images.shape[2:4] if has_channels and channel_is_first_axis \
+            else images.shape[1:3]
+        matrices = fold_flips(matrices, np.repeat(flips, warps_per_image, axis=0),
+                              image_shape)
+
+    assert backend in warp.BACKENDS, "Unknown backend '%s'." % (backend,)
+    batched = batched and interpolation_order in [0, 1]
+    warped_dtype = np.dtype(np.uint8 if batched and backend == "integer" else np.float32)
+    # warped in the units of the images (0-255), directly into out (the
+    # result, allocated here if not given) if possible, otherwise into a
+    # reused buffer
+    if dtype == warped_dtype and (out is None or out.flags.c_contiguous):
+        if out is None:
+            out = np.empty(images.shape, dtype=dtype)
+        warped = out
+    else:
+        warped = warp.scratch_array("apply_aug_matrices", images.shape, warped_dtype)
+    if batched:
+        _apply_aug_matrices_batched(images, matrices, warped, apply_directly,
+                                    channel_is_first_axis,
+                                    transform_channels_equally,
+                                    mode, cval, interpolation_order,
+                                    sampling_cache, backend)
+    else:
+        _apply_aug_matrices_loop(images, matrices, warped, apply_directly,
+                                 channel_is_first_axis,
+                                 transform_channels_equally,
+                                 mode, cval, interpolation_order)
+
+    if brightness is not None or noise_std > 0 or noise_mean != 0:
+        _adjust_intensity(warped, brightness, noise_mean, noise_std, random_state)
+    return convert_output(warped, dtype, out)
+
+def convert_output(values, dtype=np.float32, out=None):
+    """Converts images in the units 0-255 to an output dtype of
+    apply_aug_matrices().
+
+    Args:
+        values: Numpy array of dtype uint8 or float32 (values 0.0-255.0).
+            Float32 values are rounded in place for the output dtype uint8.
+        dtype: One of OUTPUT_DTYPES. Float outputs are scaled to 0.0-1.0.
+        out: Optional array of that dtype and the shape of values to write
+            to. May be values itself, which is then converted in place.
+
+    Returns:
+        The converted values, out if given.
+    """
+    if out is None:
+        out = np.empty(values.shape, dtype=dtype)
+    if out.dtype == np.uint8:
+        if values.dtype != np.uint8:
+            np.rint(values, out=values)
+        if out is not values:
+            np.copyto(out, values, casting="unsafe")
+    else:
+        np.divide(values, np.float32(255), out=out, casting="same_kind")
+    return out
+
+def fold_flips(matrices, flips, image_shape):
+    """Folds flips of the input images into augmentation matrices.
+
+    A horizontal flip of the input maps the x-coordinate x to (width - 1 - x),
+    i.e. it is a scale by -1 about the image's center. As the matrices map
+    output to input coordinates, the flip is applied after them, which only
+    rewrites their first (horizontal) or second (vertical) row.
+
+    Args:
+        matrices: Numpy array of shape (N, 3, 3), see warp.as_matrix_array().
+        flips: Numpy array of shape (N, 2) of booleans, whether to flip the
+            input of each matrix horizontally (column 0) and/or vertically
+            (column 1).
+        image_shape: (height, width) of the input images.
+
+    Returns:
+        Numpy array of shape (N, 3, 3), the matrices with the flips.
+    """
+    height, width = image_shape[0], image_shape[1]
+    matrices = np.array(matrices, dtype=np.float64)
+    flips = np.asarray(flips, dtype=bool).reshape(-1, 2)
+    hflip, vflip = flips[:, 0], flips[:, 1]
+    matrices[hflip, 0] = (width - 1) * matrices[hflip, 2] - matrices[hflip, 0]
+    matrices[vflip, 1] = (height - 1) * matrices[vflip, 2] - matrices[vflip, 1]
+    return matrices
+
+def _adjust_intensity(result, brightness, noise_mean, noise_std, random_state=np.random):
+    """Multiplies each image of result (float32, 0.0-255.0) with its
+    brightness, adds gaussian noise (in units of 0.0-1.0, drawn from
+    random_state) and clips to 0.0-255.0, in place. uint8 results are
+    adjusted image by image, see _adjust_intensity_uint8()."""
+    if result.dtype == np.uint8:
+        _adjust_intensity_uint8(result, brightness, noise_mean, noise_std, random_state)
+        return
+    for i in range(result.shape[0]):
+        if brightness is not None:
+            result[i] *= brightness[i]
+        if noise_std > 0 or noise_mean != 0:
+            # drawn per image, to keep the float64 temporary at the size of
+            # one image
+            noise = random_state.normal(noise_mean, noise_std, result.shape[1:])
+            noise *= 255
+            result[i] += noise
+    np.clip(result, 0.0, 255.0, out=result)
+
+def _adjust_intensity_uint8(result, brightness, noise_mean, noise_std, random_state=np.random):
+    """_adjust_intensity() of a uint8 result (integer backend). Without noise,
+    the brightness is a lookup table of the 256 values per image, otherwise
+    each image is adjusted in float32 scratch space and rounded back."""
+    noise = noise_std > 0 or noise_mean != 0
+    values = np.arange(256, dtype=np.float32)
+    for i in range(result.shape[0]):
+        image_brightness = None if brightness is None else brightness[i:i + 1]
+        if noise:
+            image = warp.scratch_array("adjust_intensity", (1,) + result.shape[1:])
+            np.copyto(image, result[i])
+            _adjust_intensity(image, image_brightness, noise_mean, noise_std, random_state)
+            np.rint(image, out=image)
+            np.copyto(result[i], image[0], casting="unsafe")
+        elif brightness is not None:
+            lut = np.rint(np.clip(values * brightness[i], 0.0, 255.0)).astype(np.uint8)
+            np.take(lut, result[i], out=result[i], mode="clip")
+
+def _apply_aug_matrices_loop(images, matrices, result, apply_directly,
+                             channel_is_first_axis, transform_channels_equally,
+                             mode, cval, interpolation_order):
+    """Applies the matrices of apply_aug_matrices() image by image (and
+    channel by channel) with scikit-image's transform.warp(), writing the
+    warped images (float32, values 0.0-255.0) to result.
+    """
+    # in the units of the images, like warp.warp_batch()
+    kwargs = dict(mode=mode, cval=cval * 255, order=interpolation_order,
+                  preserve_range=True)
+    nb_channels = 1
+    if not apply_directly:
+        nb_channels = images.shape[1] if channel_is_first_axis else images.shape[3]
     matrix_number = 0
 
     # iterate over every image, find out which matrix to apply and then use
@@ -329,9 +559,8 @@ def apply_aug_matrices(images, matrices, transform_channels_equally=True,
             # we can apply the matrix to the whole numpy array of the image
             # at the same time, so we do that to save time (instead of eg. three
             # steps for three channels as in the else-part)
-            matrix = matrices[order_indices[matrix_number]]
-            result[img_idx, ...] = tf.warp(image, matrix, mode=mode, cval=cval,
-                                           order=interpolation_order)
+            matrix = matrices[matrix_number]
+            result[img_idx, ...] = tf.warp(image, matrix, **kwargs)
             matrix_number += 1
         else:
             # we cant apply the matrix to the whole image in one step, instead
@@ -340,14 +569,12 @@ def apply_aug_matrices(images, matrices, transform_channels_equally=True,
             # tf.warp()) or if it was explicitly requested via
             # transform_channels_equally=False.
             for channel_idx in range(nb_channels):
-                matrix = matrices[order_indices[matrix_number]]
+                matrix = matrices[matrix_number]
                 if channel_is_first_axis:
-                    warped = tf.warp(image[channel_idx], matrix, mode=mode,
-                                     cval=cval, order=interpolation_order)
+                    warped = tf.warp(image[channel_idx], matrix, **kwargs)
                     result[img_idx, channel_idx, ...] = warped
                 else:
-                    warped = tf.warp(image[..., channel_idx], matrix, mode=mode,
-                                     cval=cval, order=interpolation_order)
+                    warped = tf.warp(image[..., channel_idx], matrix, **kwargs)
                     result[img_idx, ..., channel_idx] = warped
 
                 if not transform_channels_equally:
@@ -355,7 +582,60 @@ def apply_aug_matrices(images, matrices, transform_channels_equally=True,
             if transform_channels_equally:
                 matrix_number += 1
 
-    return result
+def _apply_aug_matrices_batched(images, matrices, result, apply_directly,
+                                channel_is_first_axis, transform_channels_equally,
+                                mode, cval, interpolation_order,
+                                sampling_cache=None, backend="float"):
+    """Applies the matrices of apply_aug_matrices() to all images at once,
+    writing the warped images (float32, values 0.0-255.0, or uint8 for the
+    "integer" backend) to result, a C-contiguous array of the shape of
+    images.
+
+    Channel-first images whose channels are transformed equally are warped
+    with one sampling per image for all channels (see warp.apply_sampling()).
+    Channels that are transformed differently are warped as a batch of
+    grayscale planes, each with the matrix of its channel.
+    """
+    nb_images = images.shape[0]
+    image_shape = images.shape[2:4] if channel_is_first_axis and images.ndim == 4 \
+        else images.shape[1:3]
+    if sampling_cache is not None and (sampling_cache.input_shape != tuple(image_shape)
+                                       or sampling_cache.order != interpolation_order
+                                       or sampling_cache.mode != mode):
+        sampling_cache = None
+
+    # warp_batch() works in the units of the images, scikit-image in 0-1
+    def warp_batch(images, matrices, out, channel_first=False):
+        if sampling_cache is None:
+            return warp.warp_batch(images, matrices, mode=mode, cval=cval * 255,
+                                   order=interpolation_order, out=out,
+                                   channel_first=channel_first, backend=backend)
+        return warp.apply_sampling(images, sampling_cache.sampling(matrices, scratch=True),
+                                   cval=cval * 255, out=out, channel_first=channel_first,
+                                   backend=backend)
+
+    if apply_directly:
+        warp_batch(np.ascontiguousarray(images), matrices, result)
+    elif channel_is_first_axis and transform_channels_equally:
+        # one sampling per image for all of its channels
+        warp_batch(np.ascontiguousarray(images), matrices, result, channel_first=True)
+    else:
+        if channel_is_first_axis:
+            nb_channels = images.shape[1]
+        else:
+            nb_channels = images.shape[3]
+        planes_shape = (nb_images * nb_channels,) + tuple(image_shape)
+        if channel_is_first_axis:
+            warp_batch(np.ascontiguousarray(images).reshape(planes_shape), matrices,
+                       result.reshape(planes_shape))
+        else:
+            planes = warp.scratch_array("aug_planes", planes_shape, np.uint8)
+            np.copyto(planes.reshape((nb_images, nb_channels) + tuple(image_shape)),
+                      np.moveaxis(images, 3, 1))
+            warped = warp_batch(planes, matrices,
+                                warp.scratch_array("aug_planes_warped", planes_shape,
+                                                   result.dtype))
+            np.copyto(result, np.moveaxis(warped.reshape((nb_images, nb_channels) + tuple(image_shape)), 1, 3))
 
 class ImageAugmenter(object):
     """Helper class to randomly augment images, usually for neural networks.
@@ -377,7 +657,8 @@ class ImageAugmenter(object):
                  scale_to_percent=1.0, scale_axis_equally=False,
                  rotation_deg=0, shear_deg=0,
                  translation_x_px=0, translation_y_px=0,
-                 transform_channels_equally=True):
+                 transform_channels_equally=True, workers=1,
+                 brightness_change=0.0, noise_mean=0.0, noise_std=0.0):
         """
         Args:
             img_width_px: The intended width of each image in pixels.
@@ -434,6 +715,17 @@ class ImageAugmenter(object):
                 by -5 degrees. If you don't have any channels (2D grayscale),
                 you can simply ignore this setting.
                 Default is True (transform all equally).
+            workers: Number of processes augment_batch() splits each batch
+                across (see augment_batch()). The processes are started on
+                the first call and kept until close() is called.
+                Default is 1 (augment in the calling process).
+            brightness_change: By up to how much the brightness of each image
+                may be changed, e.g. 0.1 multiplies its values by a random
+                factor between 0.9 and 1.1. Default is 0.0 (no change).
+            noise_mean: Mean of the gaussian noise added to each pixel, in
+                units of the augmented images (0.0-1.0). Default is 0.0.
+            noise_std: Standard deviation of that noise. Default is 0.0
+                (no noise).
         """
         self.img_width_px = img_width_px
         self.img_height_px = img_height_px
@@ -471,11 +763,60 @@ class ImageAugmenter(object):
         self.translation_x_px = translation_x_px
         self.translation_y_px = translation_y_px
         self.transform_channels_equally = transform_channels_equally
+        self.brightness_change = brightness_change
+        self.noise_mean = noise_mean
+        self.noise_std = noise_std
         self.cval = 0.0
         self.interpolation_order = 1
+        # whether to warp batches at once, see apply_aug_matrices()
+        self.batched = True
+        # interpolation of the batched warping, see apply_aug_matrices()
+        self.backend = "float"
         self.pregenerated_matrices = None
-
-    def pregenerate_matrices(self, nb_matrices, seed=None):
+        # samplings of the pregenerated matrices, see pregenerate_matrices()
+        self.sampling_cache = None
+        self.sampling_cache_path = None
+        # max_bytes of the sampling cache, the workers load theirs with it
+        self.sampling_cache_bytes = 0
+        self.workers = workers
+        # worker processes and the shared memory of their batches, see
+        # _augment_batch_parallel()
+        self._pool = None
+        self._shared = {}
+
+    def __getstate__(self):
+        # sent to the worker processes: without the processes themselves and
+        # the (possibly large) sampling cache, which the workers load from
+        # sampling_cache_path instead
+        state = dict(self.__dict__)
+        state["_pool"] = None
+        state["_shared"] = {}
+        state["sampling_cache"] = None
+        state["workers"] = 1
+        return state
+
+    def close(self):
+        """Stops the worker processes and frees the shared memory of the
+        batches, if augment_batch() started them, as well as the scratch
+        buffers of the calling thread (see warp.release_scratch())."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for shm in self._shared.values():
+            shm.close()
+            shm.unlink()
+        self._shared = {}
+        warp.release_scratch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def pregenerate_matrices(self, nb_matrices, seed=None, cache_bytes=0,
+                             cache_path=None):
         """Pregenerate/cache augmentation matrices.
 
         If matrices are pregenerated, augment_batch() will reuse them on
@@ -495,13 +836,30 @@ class ImageAugmenter(object):
         pregenerated matrices and augment_batch() returns to its default
         behaviour of generating new matrices on each call.
 
+        With cache_bytes > 0, the samplings of the matrices (which source
+        pixels each output pixel is interpolated from) are computed here
+        once and kept in a sampling_cache.SamplingCache, so augment_batch()
+        only gathers and interpolates. Its hit rate and memory use are
+        reported by self.sampling_cache.get_stats(). With flipping enabled,
+        the flipped matrices are cached too (up to 4 entries per matrix).
+
         Args:
             nb_matrices: The number of matrices to pregenerate. E.g. a few
                 thousand. If set to 0, the matrices will be generated again on
                 each call of augment_batch().
             seed: A random seed to use.
+            cache_bytes: Maximum memory of the cached samplings, e.g. 12
+                bytes per pixel and matrix for bilinear interpolation.
+                Default is 0 (no cache).
+            cache_path: Optional directory to persist the cache to. If it
+                holds a cache of the same image size, it is loaded
+                (memory-mapped) instead of computing the samplings again,
+                and saved again if matrices were missing.
         """
         assert nb_matrices >= 0
+        self.sampling_cache = None
+        self.sampling_cache_path = None
+        self.sampling_cache_bytes = 0
         if nb_matrices == 0:
             self.pregenerated_matrices = None
         else:
@@ -516,8 +874,33 @@ class ImageAugmenter(object):
                                            translation_y_px=self.translation_y_px,
                                            seed=seed)
             self.pregenerated_matrices = matrices
-
-    def augment_batch(self, images, seed=None):
+            if cache_bytes > 0 and self.interpolation_order in [0, 1]:
+                # augment_batch() warps with mode "constant"
+                cache = SamplingCache((self.img_height_px, self.img_width_px),
+                                      order=self.interpolation_order,
+                                      mode="constant", max_bytes=cache_bytes)
+                variants = self._flipped_variants(matrices)
+                if cache_path is not None and os.path.isdir(cache_path):
+                    cache.load(cache_path)
+                if cache.warm(variants) > 0 and cache_path is not None:
+                    cache.save(cache_path)
+                self.sampling_cache = cache
+                self.sampling_cache_path = cache_path
+                self.sampling_cache_bytes = cache_bytes
+
+    def _flipped_variants(self, matrices):
+        """Returns the matrices followed by their flipped versions that
+        augment_batch() may use, see fold_flips()."""
+        variants = [matrices]
+        for hflip, vflip in [(True, False), (False, True), (True, True)]:
+            if (hflip and self.hflip_prob == 0) or (vflip and self.vflip_prob == 0):
+                continue
+            flips = np.tile([hflip, vflip], (len(matrices), 1))
+            variants.append(fold_flips(matrices, flips,
+                                       (self.img_height_px, self.img_width_px)))
+        return np.concatenate(variants).astype(np.float32)
+
+    def augment_batch(self, images, seed=None, dtype=np.float32, out=None):
         """Augments a batch of images.
 
         Applies all settings (rotation, shear, translation, ...) that
@@ -532,12 +915,25 @@ class ImageAugmenter(object):
                 channels, where the channel is the last index.
                 If your shape is (image-index, channel, width, height) then
                 you must also set channel_is_first_axis=True in the constructor.
-            seed: Seed to use for python's and numpy's random functions.
-                Default is None (dont use a seed).
+            seed: Seed of a numpy.random.RandomState which all random
+                values of the batch are drawn from (numpy's global random
+                state is left untouched).
+                Default is None (draw from numpy's global random state).
+                With workers > 1, the batch is split into one part per
+                worker, each augmented with its own seed derived from this
+                one (or, if it is None, from numpy's random state), so the
+                results are reproducible for the same seed and number of
+                workers.
+            dtype: Dtype of the augmented images, one of OUTPUT_DTYPES, see
+                apply_aug_matrices(). Default is float32 (values between 0.0
+                and 1.0).
+            out: Optional numpy array of the shape of images and that dtype
+                to write the augmented images to. Reusing it across calls
+                (e.g. with dtype uint8 for writing images) avoids allocating
+                the results of each batch.
 
         Returns:
-            Augmented images as numpy array of dtype float32 (i.e. values
-            are between 0.0 and 1.0).
+            Augmented images as numpy array of the given dtype, out if given.
         """
         shape = images.shape
         nb_channels = 0
@@ -562,67 +958,60 @@ class ImageAugmenter(object):
                   "predefined image width/height (%d/%d)."
             raise Exception(msg % (str(shape), self.img_width_px, self.img_height_px))
 
-        if seed:
-            random.seed(seed)
-            np.random.seed(seed)
+        assert np.dtype(dtype) in OUTPUT_DTYPES, \
+            "Expected one of %s as dtype." % (str(OUTPUT_DTYPES),)
+
+        if self.workers > 1 and shape[0] > 1:
+            return self._augment_batch_parallel(images, seed, dtype, out)
+
+        # the flips, brightness, matrices, their order and the noise are
+        # drawn one after the other from one random state, so that none of
+        # them repeats the random values of another
+        random_state = np.random.RandomState(seed) if seed else np.random
+
+        nb_images = shape[0]
 
         # --------------------------------
-        # horizontal and vertical flipping/mirroring
+        # horizontal and vertical flipping/mirroring, brightness
         # --------------------------------
-        # This should be done before applying the affine matrices, as otherwise
-        # contents of image might already be rotated/translated out of the image.
-        # It is done with numpy instead of the affine matrices, because
-        # scikit-image doesn't offer a nice interface to add mirroring/flipping
-        # to affine transformations. The numpy operations are O(1), so they
-        # shouldn't have a noticeable effect on runtimes. They also won't suffer
-        # from interpolation problems.
+        # Flips are not applied to the images, but folded into the
+        # augmentation matrices (see fold_flips()), which map output to
+        # flipped input coordinates. Brightness and noise are applied to the
+        # warped images in place. So the images are read once and the result
+        # is written once.
+        flips = None
         if self.hflip_prob > 0 or self.vflip_prob > 0:
-            # TODO this currently ignores the setting in
-            # transform_channels_equally and will instead always flip all
-            # channels equally
-
-            # if this is simply a view, then the input array gets flipped too
-            # for some reason
-            images_flipped = np.copy(images)
-            #images_flipped = images.view()
-
-            if len(shape) == 4 and self.channel_is_first_axis:
-                # roll channel to the last axis
-                # swapaxes doesnt work here, because
-                #  (image index, channel, y, x)
-                # would be turned into
-                #  (image index, x, y, channel)
-                # and y needs to come before x
-                images_flipped = np.rollaxis(images_flipped, 1, 4)
-
-            y_p = self.hflip_prob
-            x_p = self.vflip_prob
-            for i in range(images.shape[0]):
-                if y_p > 0 and random.random() < y_p:
-                    images_flipped[i] = np.fliplr(images_flipped[i])
-                if x_p > 0 and random.random() < x_p:
-                    images_flipped[i] = np.flipud(images_flipped[i])
-
-            if len(shape) == 4 and self.channel_is_first_axis:
-                # roll channel back to the second axis (index 1)
-                images_flipped = np.rollaxis(images_flipped, 3, 1)
-            images = images_flipped
+            draws = random_state.random_sample((nb_images, 2))
+            flips = draws < [self.hflip_prob, self.vflip_prob]
+        brightness = None
+        if self.brightness_change > 0:
+            brightness = random_state.uniform(1.0 - self.brightness_change,
+                                           1.0 + self.brightness_change,
+                                           nb_images)
 
         # --------------------------------
         # if no augmentation has been chosen, stop early
         # for improved performance (evade applying matrices)
         # --------------------------------
-        if self.pregenerated_matrices is None \
-           and self.scale_to_percent == 1.0 and self.rotation_deg == 0 \
-           and self.shear_deg == 0 \
-           and self.translation_x_px == 0 and self.translation_y_px == 0:
-            return np.array(images, dtype=np.float32) / 255
+        no_affine = self.pregenerated_matrices is None \
+            and self.scale_to_percent == 1.0 and self.rotation_deg == 0 \
+            and self.shear_deg == 0 \
+            and self.translation_x_px == 0 and self.translation_y_px == 0
+        if no_affine and flips is None and brightness is None \
+           and self.noise_std == 0 and self.noise_mean == 0:
+            return convert_output(images, dtype, out)
 
         # --------------------------------
         # generate transformation matrices
         # --------------------------------
+        random_order = True
         if self.pregenerated_matrices is not None:
             matrices = self.pregenerated_matrices
+        elif no_affine:
+            # only flips, brightness or noise, which are applied with the
+            # identity (whole pixels, so no interpolation)
+            matrices = np.eye(3, dtype=np.float32)[np.newaxis, ...]
+            random_order = False
         else:
             # estimate the number of matrices required
             if self.transform_channels_equally:
@@ -640,7 +1029,7 @@ class ImageAugmenter(object):
                                            shear_deg=self.shear_deg,
                                            translation_x_px=self.translation_x_px,
                                            translation_y_px=self.translation_y_px,
-                                           seed=seed)
+                                           random_state=random_state)
 
         # --------------------------------
         # apply transformation matrices (i.e. augment images)
@@ -649,7 +1038,157 @@ class ImageAugmenter(object):
                                   transform_channels_equally=self.transform_channels_equally,
                                   channel_is_first_axis=self.channel_is_first_axis,
                                   cval=self.cval, interpolation_order=self.interpolation_order,
-                                  seed=seed)
+                                  random_order=random_order,
+                                  batched=self.batched,
+                                  sampling_cache=self.sampling_cache,
+                                  flips=flips, brightness=brightness,
+                                  noise_mean=self.noise_mean,
+                                  noise_std=self.noise_std,
+                                  dtype=dtype, out=out, backend=self.backend,
+                                  random_state=random_state)
+
+    def augment_stream(self, batches, batch_size=None, buffers=2, seed=None,
+                       dtype=np.float32, stats=None):
+        """Augments a stream of batches ahead of their use.
+
+        A background thread augments the next batches while the caller
+        processes the current one. The results are written to a ring of
+        preallocated arrays (double buffering with buffers=2, triple
+        buffering with 3), so at most buffers - 1 batches are augmented
+        ahead and the batches do not allocate their results.
+
+        Args:
+            batches: Iterable of uint8 batches as accepted by
+                augment_batch(), or one numpy array (e.g. a np.memmap of a
+                whole dataset), which is split into batches of batch_size
+                images. The batches are read in the background thread.
+            batch_size: Number of images per batch if batches is an array.
+            buffers: Number of result buffers, at least 2.
+            seed: Seed to derive the seed of each batch from. Default is None
+                (numpy's random state).
+            dtype: Dtype of the augmented batches, see augment_batch().
+            stats: Optional dict to accumulate the metrics of the pipeline
+                into: "batches" and "images" augmented, "augment" (seconds
+                spent augmenting), "stalls" (number of batches the caller had
+                to wait for), "stall_wait" (seconds the caller waited) and
+                "ahead_wait" (seconds the background thread waited for a
+                free buffer, i.e. the caller was the bottleneck).
+
+        Returns:
+            Generator of the augmented batches, in the order of batches. A
+            yielded batch is a buffer that is reused once the next batch is
+            requested, copy it to keep it. Exceptions of the background
+            thread are raised at the position of the failed batch.
+        """
+        assert buffers >= 2
+        if isinstance(batches, np.ndarray):
+            assert batch_size is not None and batch_size > 0, \
+                "Expected batch_size to split the array into batches."
+            images = batches
+            batches = (images[start:start + batch_size]
+                       for start in range(0, len(images), batch_size))
+        stats = stats if stats is not None else {}
+        for key in ["batches", "images", "augment", "stalls", "stall_wait", "ahead_wait"]:
+            stats.setdefault(key, 0)
+
+        # slots of the buffers not held by the caller, and augmented batches
+        free_slots = queue.Queue()
+        for slot in range(buffers):
+            free_slots.put(slot)
+        augmented = queue.Queue()
+        outputs = [None] * buffers
+        stop = threading.Event()
+
+        def run():
+            try:
+                for index, batch in enumerate(batches):
+                    start = timer()
+                    slot = free_slots.get()
+                    stats["ahead_wait"] += timer() - start
+                    if stop.is_set():
+                        return
+                    if outputs[slot] is None or len(outputs[slot]) < len(batch) \
+                            or outputs[slot].shape[1:] != batch.shape[1:]:
+                        outputs[slot] = np.empty(batch.shape, dtype=dtype)
+                    start = timer()
+                    result = self.augment_batch(batch,
+                                                seed=_worker_seed(seed, index) if seed else None,
+                                                dtype=dtype, out=outputs[slot][:len(batch)])
+                    stats["augment"] += timer() - start
+                    stats["batches"] += 1
+                    stats["images"] += len(batch)
+                    augmented.put((slot, result))
+                augmented.put(None)
+            except Exception as e:
+                augmented.put(e)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        held = None
+        try:
+            while True:
+                if held is not None:
+                    free_slots.put(held)
+                    held = None
+                stalled = augmented.empty()
+                start = timer()
+                item = augmented.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                if stalled:
+                    stats["stalls"] += 1
+                    stats["stall_wait"] += timer() - start
+                held, result = item
+                yield result
+        finally:
+            # wakes the thread if it waits for a buffer, a batch being
+            # augmented is finished first
+            stop.set()
+            free_slots.put(None)
+            thread.join()
+
+    def _augment_batch_parallel(self, images, seed, dtype=np.float32, out=None):
+        """Splits the batch of augment_batch() across the worker processes.
+
+        The images and the results are exchanged through shared memory that
+        is reused across calls (and only grown), so no image data is
+        pickled, only the settings of the augmenter.
+        """
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers)
+        images_shm = self._shared_memory("images", images.nbytes)
+        dtype = np.dtype(dtype)
+        result_shm = self._shared_memory("result", images.size * dtype.itemsize)
+        shared_images = np.ndarray(images.shape, dtype=np.uint8, buffer=images_shm.buf)
+        shared_images[...] = images
+
+        if not seed:
+            seed = np.random.randint(1, 2**31 - 1)
+        bounds = np.linspace(0, images.shape[0], self.workers + 1).astype(int)
+        tasks = [(self, images_shm.name, result_shm.name, images.shape, dtype,
+                  bounds[i], bounds[i + 1], _worker_seed(seed, i))
+                 for i in range(self.workers) if bounds[i] < bounds[i + 1]]
+        self._pool.map(_augment_part, tasks)
+
+        # copied, the shared memory is reused by the next call
+        result = np.ndarray(images.shape, dtype=dtype, buffer=result_shm.buf)
+        if out is None:
+            return np.array(result)
+        np.copyto(out, result)
+        return out
+
+    def _shared_memory(self, name, nbytes):
+        """Returns the shared memory block name of at least nbytes."""
+        shm = self._shared.get(name)
+        if shm is None or shm.size < nbytes:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = self._shared[name] = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+        return shm
 
     def plot_image(self, image, nb_repeat=40, show_plot=True):
         """Plot augmented variations of an image.
@@ -743,3 +1282,45 @@ class ImageAugmenter(object):
             plt.show()
 
         return fig
+
+def _worker_seed(seed, part):
+    """Derives the seed of one part of a batch of augment_batch()."""
+    return (seed * 1000003 + (part + 1) * 7919) % (2**31 - 1) or 1
+
+# per worker process: shared memory blocks by name and loaded sampling caches
+# by path and max_bytes
+_attached = {}
+_loaded_caches = {}
+
+def _attach(name):
+    """Attaches to a shared memory block created by the parent process."""
+    shm = _attached.get(name)
+    if shm is None:
+        shm = _attached[name] = shared_memory.SharedMemory(name=name)
+        # The parent owns the block. Without this, the resource tracker
+        # would warn about (or unlink) it when the worker exits.
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def _augment_part(task):
+    """Augments the images start to end of a batch in shared memory and
+    writes them to the result. Runs in the worker processes."""
+    augmenter, images_name, result_name, shape, dtype, start, end, seed = task
+    # blocks of earlier calls that the parent replaced by larger ones
+    for name in list(_attached.keys()):
+        if name not in [images_name, result_name]:
+            _attached.pop(name).close()
+    if augmenter.sampling_cache_path is not None:
+        key = (augmenter.sampling_cache_path, augmenter.sampling_cache_bytes)
+        cache = _loaded_caches.get(key)
+        if cache is None:
+            cache = SamplingCache((augmenter.img_height_px, augmenter.img_width_px),
+                                  order=augmenter.interpolation_order, mode="constant",
+                                  max_bytes=augmenter.sampling_cache_bytes)
+            cache.load(augmenter.sampling_cache_path, mmap=True)
+            _loaded_caches[key] = cache
+        augmenter.sampling_cache = cache
+    images = np.ndarray(shape, dtype=np.uint8, buffer=_attach(images_name).buf)
+    result = np.ndarray(shape, dtype=dtype, buffer=_attach(result_name).buf)
+    augmenter.augment_batch(images[start:end], seed=seed, dtype=dtype,
+                            out=result[start:end])
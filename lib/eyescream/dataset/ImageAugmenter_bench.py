@@ -0,0 +1,259 @@
+"""
+Benchmarks ImageAugmenter: images per second and peak memory of
+augment_batch() across image sizes, layouts (grayscale, channel-last HWC,
+channel-first CHW), transform_channels_equally, interpolation orders and
+backends, fresh vs. pregenerated (optionally cached) matrices and batch
+sizes, as well
+as create_aug_matrices(). Results are printed as JSON, optionally saved as a
+baseline and compared against one, flagging every case that got slower (or
+allocates more) than the threshold.
+
+With --workers, augment_batch() is instead benchmarked with different
+numbers of worker processes (see the workers parameter of ImageAugmenter).
+
+Run from the repository root with:
+    python -m lib.eyescream.dataset.ImageAugmenter_bench --sizes 32,64,250 --batch-sizes 8,64
+    python -m lib.eyescream.dataset.ImageAugmenter_bench --save-baseline
+    python -m lib.eyescream.dataset.ImageAugmenter_bench --compare --threshold 0.2
+    python -m lib.eyescream.dataset.ImageAugmenter_bench --backends float,integer --dtype uint8
+    python -m lib.eyescream.dataset.ImageAugmenter_bench --workers 1,2,4,8 --sizes 64 --batch-sizes 1024
+"""
+from __future__ import print_function, division
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tracemalloc
+from timeit import default_timer as timer
+import numpy as np
+from . import warp
+from .ImageAugmenter import ImageAugmenter, create_aug_matrices
+
+# next to the baseline of main_bench.py, in the (untracked) tmp directory of
+# main.py, as timings of one machine mean little on another
+BASELINE_PATH = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                              "..", "..", "..", "tmp",
+                                              "ImageAugmenter_bench_baseline.json"))
+LAYOUTS = ["gray", "hwc", "chw"]
+MATRICES = ["fresh", "pregenerated", "cached"]
+# matrices pregenerated for the "pregenerated" and "cached" cases
+NB_PREGENERATED = 1000
+# metrics compared against the baseline and whether higher values are better
+COMPARED_METRICS = {"images_per_s": True, "peak_bytes": False, "matrices_per_s": True}
+AUGMENT_PARAMS = dict(hflip=True, scale_to_percent=1.1, rotation_deg=10,
+                      translation_x_px=4, translation_y_px=4)
+
+def make_images(size, batch_size, layout):
+    """Returns a random uint8 batch of the layout."""
+    rng = np.random.RandomState(size)
+    if layout == "gray":
+        return rng.randint(0, 256, (batch_size, size, size)).astype(np.uint8)
+    images = rng.randint(0, 256, (batch_size, size, size, 3)).astype(np.uint8)
+    if layout == "chw":
+        images = np.ascontiguousarray(np.moveaxis(images, 3, 1))
+    return images
+
+def best_seconds(call, repeats):
+    """Returns the seconds of the fastest of repeats calls of call()."""
+    best = None
+    for _ in range(repeats):
+        start = timer()
+        call()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def peak_bytes(call):
+    """Returns the peak of the memory allocated by call() (tracemalloc),
+    after a first call that allocates the scratch space reused across calls."""
+    call()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = call()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak - baseline
+
+def case_name(size, layout, equally, order, matrices, batch_size, backend="float"):
+    name = "size=%d/layout=%s/equally=%d/order=%d/matrices=%s/batch=%d" % (
+        size, layout, equally, order, matrices, batch_size)
+    # the float backend keeps the names of earlier baselines
+    if backend != "float":
+        name += "/backend=%s" % (backend,)
+    return name
+
+def bench_case(size, layout, equally, order, matrices, batch_size, repeats,
+               backend="float", dtype=np.float32):
+    """Returns the images per second and the peak memory of augment_batch()
+    for one combination of the settings."""
+    images = make_images(size, batch_size, layout)
+    augmenter = ImageAugmenter(size, size, channel_is_first_axis=(layout == "chw"),
+                               transform_channels_equally=equally, **AUGMENT_PARAMS)
+    augmenter.interpolation_order = order
+    augmenter.backend = backend
+    if matrices != "fresh":
+        cache_bytes = 256 * 2**20 if matrices == "cached" else 0
+        augmenter.pregenerate_matrices(NB_PREGENERATED, seed=1, cache_bytes=cache_bytes)
+    call = lambda: augmenter.augment_batch(images, dtype=dtype)
+    peak = peak_bytes(call)
+    seconds = best_seconds(call, repeats)
+    return {"images_per_s": batch_size / seconds,
+            "ms_per_batch": seconds * 1000,
+            "peak_bytes": peak,
+            "peak_bytes_per_image": peak / batch_size}
+
+def bench_create_matrices(size, nb_matrices, repeats):
+    """Returns the matrices per second of create_aug_matrices()."""
+    call = lambda: create_aug_matrices(nb_matrices, size, size, scale_to_percent=1.1,
+                                       rotation_deg=10, shear_deg=5,
+                                       translation_x_px=4, translation_y_px=4)
+    call()
+    return {"matrices_per_s": nb_matrices / best_seconds(call, repeats)}
+
+def run_suite(sizes, layouts, orders, matrices, batch_sizes, repeats, verbose=True,
+              backends=("float",), dtype=np.float32):
+    """Runs every combination of the settings. Returns a dict of the results
+    by case name (see case_name())."""
+    results = {}
+    for size in sizes:
+        for layout in layouts:
+            # grayscale images have no channels to transform differently
+            for equally in [True] if layout == "gray" else [True, False]:
+                for order in orders:
+                    for matrices_mode in matrices:
+                        for batch_size in batch_sizes:
+                            for backend in backends:
+                                name = case_name(size, layout, equally, order, matrices_mode,
+                                                 batch_size, backend)
+                                results[name] = bench_case(size, layout, equally, order,
+                                                           matrices_mode, batch_size, repeats,
+                                                           backend, dtype)
+                                if verbose:
+                                    print("%s: %.0f images/s" % (name, results[name]["images_per_s"]),
+                                          file=sys.stderr)
+        results["create_aug_matrices/size=%d" % (size,)] = bench_create_matrices(
+            size, NB_PREGENERATED, repeats)
+    return results
+
+def compare(results, baseline, threshold):
+    """Returns a list of (case, metric, baseline, current) for every metric
+    that got worse than the baseline by more than threshold (e.g. 0.2 is
+    20%). Cases or metrics missing in either are skipped."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in result or metric not in baseline[name]:
+                continue
+            old, new = baseline[name][metric], result[metric]
+            if old == 0:
+                continue
+            change = (new - old) / old
+            if higher_is_better:
+                change = -change
+            if change > threshold:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+def bench_workers(images, workers, repeats, pregenerate=0):
+    """Returns the images per second of augment_batch() (the best of repeats)
+    with the given number of workers. The first call, which starts the
+    worker processes, is not measured."""
+    augmenter = ImageAugmenter(images.shape[2], images.shape[1], workers=workers,
+                               **AUGMENT_PARAMS)
+    if pregenerate > 0:
+        augmenter.pregenerate_matrices(pregenerate, seed=1)
+    with augmenter:
+        augmenter.augment_batch(images, seed=1)
+        seconds = best_seconds(lambda: augmenter.augment_batch(images, seed=1), repeats)
+    return len(images) / seconds
+
+def run_workers(workers_list, size, batch_size, repeats, pregenerate):
+    images = make_images(size, batch_size, "hwc")
+    results = {"cpus": multiprocessing.cpu_count(), "workers": {}}
+    single = None
+    for workers in workers_list:
+        images_per_s = bench_workers(images, workers, repeats, pregenerate)
+        single = single or images_per_s
+        # relative to the first number of workers
+        results["workers"][workers] = {"images_per_s": images_per_s,
+                                       "speedup": images_per_s / single}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="32,64,250", help="comma separated image sizes in pixels")
+    parser.add_argument("--layouts", default=",".join(LAYOUTS), help="comma separated, of %s" % (LAYOUTS,))
+    parser.add_argument("--orders", default="0,1", help="comma separated interpolation orders")
+    parser.add_argument("--matrices", default=",".join(MATRICES),
+                        help="comma separated, of %s" % (MATRICES,))
+    parser.add_argument("--batch-sizes", default="8,64", help="comma separated batch sizes")
+    parser.add_argument("--backends", default="float",
+                        help="comma separated, of %s" % (warp.BACKENDS,))
+    parser.add_argument("--dtype", default="float32", help="output dtype of augment_batch()")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default=None, help="file to write the results to (JSON)")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help="JSON file written by --save-baseline and read by --compare")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--workers", default=None,
+                        help="comma separated numbers of workers, benchmarks those instead "
+                             "(with the first size and batch size)")
+    parser.add_argument("--pregenerate", type=int, default=0,
+                        help="with --workers: number of pregenerated matrices, 0 generates "
+                             "them per batch")
+    args = parser.parse_args()
+    if args.compare and not args.save_baseline and not os.path.isfile(args.baseline):
+        parser.error("--compare needs a baseline, but %s does not exist" % (args.baseline,))
+    sizes = [int(s) for s in args.sizes.split(",")]
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+
+    if args.workers is not None:
+        results = run_workers([int(w) for w in args.workers.split(",")], sizes[0],
+                              batch_sizes[0], args.repeats, args.pregenerate)
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return 0
+
+    layouts = args.layouts.split(",")
+    matrices = args.matrices.split(",")
+    assert all(layout in LAYOUTS for layout in layouts)
+    assert all(matrices_mode in MATRICES for matrices_mode in matrices)
+    backends = args.backends.split(",")
+    assert all(backend in warp.BACKENDS for backend in backends)
+    results = run_suite(sizes, layouts, [int(o) for o in args.orders.split(",")],
+                        matrices, batch_sizes, args.repeats, backends=backends,
+                        dtype=np.dtype(args.dtype))
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        # tmp/ only exists once main.py ran
+        baseline_dir = os.path.dirname(os.path.abspath(args.baseline))
+        if not os.path.isdir(baseline_dir):
+            os.makedirs(baseline_dir)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("baseline saved to", args.baseline)
+
+    if args.compare:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, metric, old, new in regressions:
+            print("[regression] %s: %s went from %.4g to %.4g" % (name, metric, old, new))
+        if len(regressions) > 0:
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+import unittest
+import os
+import time
+import tracemalloc
+import numpy as np
+from skimage import transform as tf
+from lib.eyescream.dataset import ImageAugmenter as ia
+
+class TestImageAugmenter(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.images = rng.randint(0, 256, (5, 24, 20, 3)).astype(np.uint8)
+        self.matrices = ia.create_aug_matrices(7, 20, 24, scale_to_percent=1.2,
+                                               rotation_deg=20, shear_deg=10,
+                                               translation_x_px=4, translation_y_px=4,
+                                               seed=1)
+
+    def apply(self, images, batched, **kwargs):
+        return ia.apply_aug_matrices(images, self.matrices, seed=2, batched=batched, **kwargs)
+
+    def assert_same_as_skimage(self, images, msg="", **kwargs):
+        warped = self.apply(images, True, **kwargs)
+        expected = self.apply(images, False, **kwargs)
+        self.assertEqual(warped.dtype, np.float32)
+        self.assertEqual(warped.shape, images.shape)
+        self.assertTrue(np.allclose(warped, expected, atol=1e-4), msg)
+
+    def test_same_as_skimage(self):
+        # compared to warping float images, as newer scikit-image versions
+        # do not convert uint8 images to 0-1 for order 0
+        for order in [0, 1]:
+            for mode in ["constant", "edge", "symmetric", "reflect", "wrap"]:
+                for cval in [0.0, 0.5]:
+                    warped = self.apply(self.images, True, random_order=False, interpolation_order=order,
+                                        mode=mode, cval=cval)
+                    expected = [tf.warp(image / 255, self.matrices[i % len(self.matrices)], order=order,
+                                        mode=mode, cval=cval)
+                                for i, image in enumerate(self.images)]
+                    self.assertTrue(np.allclose(warped, expected, atol=1e-4),
+                                    "order %d, mode %s, cval %.1f" % (order, mode, cval))
+
+    def test_layouts(self):
+        for equally in [True, False]:
+            self.assert_same_as_skimage(self.images, transform_channels_equally=equally)
+            self.assert_same_as_skimage(np.ascontiguousarray(np.rollaxis(self.images, 3, 1)),
+                                        channel_is_first_axis=True, transform_channels_equally=equally)
+        self.assert_same_as_skimage(self.images[..., 0])
+        self.assert_same_as_skimage(self.images, random_order=False)
+
+    def test_create_aug_matrices(self):
+        self.assertEqual((7, 3, 3), self.matrices.shape)
+        self.assertEqual(np.float32, self.matrices.dtype)
+        self.assertTrue(np.array_equal(self.matrices, ia.create_aug_matrices(
+            7, 20, 24, scale_to_percent=1.2, rotation_deg=20, shear_deg=10,
+            translation_x_px=4, translation_y_px=4, seed=1)))
+
+        # the same as composing the scikit-image transforms
+        matrices = ia.create_aug_matrices(2, 20, 24, scale_to_percent=(1.2, 1.2), rotation_deg=(30, 30),
+                                          translation_x_px=(3, 3), translation_y_px=(-2, -2))
+        expected = tf.SimilarityTransform(translation=[-10, -12]) \
+            + tf.AffineTransform(scale=(1.2, 1.2), rotation=np.deg2rad(30), translation=(3, -2)) \
+            + tf.SimilarityTransform(translation=[10, 12])
+        for matrix in matrices:
+            self.assertTrue(np.allclose(matrix, np.linalg.inv(expected.params), atol=1e-5))
+
+        transforms = ia.create_aug_matrices(2, 20, 24, rotation_deg=10, seed=1, as_transforms=True)
+        self.assertTrue(np.allclose(transforms[1].params, ia.create_aug_matrices(2, 20, 24, rotation_deg=10,
+                                                                                 seed=1)[1]))
+
+    def test_augment_batch(self):
+        augmenter = ia.ImageAugmenter(20, 24, hflip=True, rotation_deg=20, translation_x_px=3)
+        augmented = augmenter.augment_batch(self.images, seed=3)
+        augmenter.batched = False
+        expected = augmenter.augment_batch(self.images, seed=3)
+        self.assertTrue(np.allclose(augmented, expected, atol=1e-4))
+
+    def test_flips(self):
+        # folded into the matrices, the same as flipping the images first
+        flips = np.array([[True, False], [False, True], [True, True], [False, False], [True, False]])
+        flipped = np.array([image[::-1 if v else 1, ::-1 if h else 1] for image, (h, v) in zip(self.images, flips)])
+        for order in [0, 1]:
+            for batched in [True, False]:
+                for equally in [True, False]:
+                    warped = self.apply(self.images, batched, flips=flips, interpolation_order=order,
+                                        transform_channels_equally=equally)
+                    expected = self.apply(flipped, batched, interpolation_order=order,
+                                          transform_channels_equally=equally)
+                    self.assertTrue(np.allclose(warped, expected, atol=1e-4), "order %d" % (order,))
+                    chw = np.ascontiguousarray(np.rollaxis(self.images, 3, 1))
+                    warped = self.apply(chw, batched, flips=flips, interpolation_order=order,
+                                        channel_is_first_axis=True, transform_channels_equally=equally)
+                    self.assertTrue(np.allclose(np.rollaxis(warped, 1, 4), expected, atol=1e-4))
+
+        # flips only, exact
+        augmenter = ia.ImageAugmenter(20, 24, hflip=1.0)
+        self.assertTrue(np.array_equal(self.images[:, :, ::-1] / np.float32(255), augmenter.augment_batch(self.images)))
+
+    def test_intensity(self):
+        warped = self.apply(self.images, True)
+        brightness = np.array([0.5, 1.0, 1.5, 2.0, 0.0])
+        adjusted = self.apply(self.images, True, brightness=brightness)
+        self.assertTrue(np.allclose(adjusted, np.minimum(warped * brightness[:, None, None, None], 1.0)))
+
+        noisy = self.apply(self.images, True, noise_mean=0.1, noise_std=0.05)
+        self.assertTrue(0.0 <= noisy.min() and noisy.max() <= 1.0)
+        inside = (warped > 0.3) & (warped < 0.7)
+        self.assertAlmostEqual(0.1, (noisy - warped)[inside].mean(), delta=0.01)
+        self.assertAlmostEqual(0.05, (noisy - warped)[inside].std(), delta=0.01)
+
+        augmenter = ia.ImageAugmenter(20, 24, brightness_change=0.2)
+        augmented = augmenter.augment_batch(self.images)
+        factors = (augmented / (self.images / np.float32(255)).clip(1e-3)).reshape(5, -1)
+        bright = (self.images.reshape(5, -1) > 10) & (augmented.reshape(5, -1) < 1.0)
+        for image_factors, image_bright in zip(factors, bright):
+            used = image_factors[image_bright]
+            self.assertTrue(np.allclose(used, used[0], atol=1e-3) and 0.8 <= used[0] <= 1.2)
+
+    def test_seed(self):
+        # the flips, matrices, their order and the noise are drawn one after
+        # the other from one random state, numpy's global one is untouched
+        augmenter = ia.ImageAugmenter(20, 24, hflip=True, rotation_deg=20,
+                                      noise_std=0.05)
+        np.random.seed(0)
+        augmented = augmenter.augment_batch(self.images, seed=3)
+        self.assertEqual(np.random.RandomState(0).random_sample(), np.random.random_sample())
+
+        random_state = np.random.RandomState(3)
+        flips = random_state.random_sample((5, 2)) < [0.5, 0.0]
+        matrices = ia.create_aug_matrices(5, 20, 24, rotation_deg=20, random_state=random_state)
+        expected = ia.apply_aug_matrices(self.images, matrices, flips=flips, noise_std=0.05,
+                                         random_state=random_state)
+        self.assertTrue(np.array_equal(expected, augmented))
+        self.assertTrue(np.array_equal(augmented, augmenter.augment_batch(self.images, seed=3)))
+
+    def test_output_allocation(self):
+        # without out, the result is the only image sized allocation (the
+        # reused buffers being allocated by the first call)
+        images = np.random.RandomState(0).randint(0, 256, (64, 64, 64, 3)).astype(np.uint8)
+        for backend, dtype in [("float", np.float32), ("integer", np.uint8)]:
+            ia.apply_aug_matrices(images, self.matrices, backend=backend, dtype=dtype)
+            tracemalloc.start()
+            try:
+                warped = ia.apply_aug_matrices(images, self.matrices, backend=backend, dtype=dtype)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(np.dtype(dtype), warped.dtype)
+            self.assertTrue(peak < 1.5 * warped.nbytes, "%s: %d bytes" % (backend, peak))
+
+    def test_output_dtypes(self):
+        expected = self.apply(self.images, True)
+        for batched in [True, False]:
+            for dtype in [np.uint8, np.float16, np.float32]:
+                out = np.zeros(self.images.shape, dtype=dtype)
+                self.assertTrue(self.apply(self.images, batched, dtype=dtype, out=out) is out)
+                scale = 255 if dtype == np.uint8 else 1
+                self.assertTrue(np.allclose(out, expected * scale, atol=0.5 if dtype == np.uint8 else 1e-3))
+
+        augmenter = ia.ImageAugmenter(20, 24)
+        out = np.zeros(self.images.shape, dtype=np.uint8)
+        self.assertTrue(augmenter.augment_batch(self.images, dtype=np.uint8, out=out) is out)
+        self.assertTrue(np.array_equal(self.images, out))
+        self.assertTrue(np.array_equal(self.images / np.float32(255), augmenter.augment_batch(self.images)))
+
+    def test_output_no_allocation(self):
+        import tracemalloc
+        augmenter = ia.ImageAugmenter(20, 24, hflip=True, rotation_deg=20, brightness_change=0.1)
+        augmenter.pregenerate_matrices(50, seed=1, cache_bytes=2**20)
+        # large enough for the bounded temporaries of the warp's chunks
+        images = np.concatenate([self.images] * 200)
+        for dtype in [np.uint8, np.float32]:
+            out = np.empty(images.shape, dtype=dtype)
+            augmenter.augment_batch(images, dtype=dtype, out=out)
+            tracemalloc.start()
+            augmenter.augment_batch(images, dtype=dtype, out=out)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            # none of the size of the batch, not even a uint8 one
+            self.assertTrue(peak < images.nbytes, "%s: %d bytes" % (np.dtype(dtype).name, peak))
+
+    def test_backend(self):
+        chw = np.ascontiguousarray(np.rollaxis(self.images, 3, 1))
+        brightness = np.array([0.5, 1.0, 1.5, 2.0, 0.0])
+        for images, first in [(self.images, False), (chw, True), (self.images[..., 0], False)]:
+            for equally in [True, False]:
+                for order in [0, 1]:
+                    kwargs = dict(channel_is_first_axis=first, transform_channels_equally=equally,
+                                  interpolation_order=order, brightness=brightness, dtype=np.uint8)
+                    expected = self.apply(images, True, **kwargs)
+                    warped = self.apply(images, True, backend="integer", **kwargs)
+                    self.assertEqual(warped.dtype, np.uint8)
+                    # one level off the rounded floats, doubled by the brightness
+                    error = np.abs(warped.astype(np.int32) - expected).max()
+                    self.assertTrue(error <= (0 if order == 0 else 2),
+                                    "%s, equally %d, order %d: %d" % (str(images.shape), equally, order, error))
+                    kwargs["dtype"] = np.float32
+                    scaled = self.apply(images, True, backend="integer", **kwargs)
+                    self.assertTrue(np.allclose(scaled, warped / np.float32(255)))
+
+        noisy = self.apply(self.images, True, backend="integer", noise_mean=0.1, noise_std=0.05)
+        expected = self.apply(self.images, True, noise_mean=0.1, noise_std=0.05)
+        self.assertTrue(np.allclose(noisy, expected, atol=1.5 / 255))
+
+        augmenter = ia.ImageAugmenter(20, 24, hflip=True, rotation_deg=20, brightness_change=0.1)
+        augmenter.backend = "integer"
+        augmenter.pregenerate_matrices(50, seed=1, cache_bytes=2**20)
+        out = np.empty(self.images.shape, dtype=np.uint8)
+        self.assertTrue(augmenter.augment_batch(self.images, seed=3, dtype=np.uint8, out=out) is out)
+        augmenter.backend = "float"
+        expected = augmenter.augment_batch(self.images, seed=3, dtype=np.uint8)
+        self.assertTrue(np.abs(out.astype(np.int32) - expected).max() <= 2)
+
+    def test_sampling_cache(self):
+        augmenter = ia.ImageAugmenter(20, 24, rotation_deg=20, translation_x_px=3)
+        augmenter.pregenerate_matrices(50, seed=1)
+        expected = augmenter.augment_batch(self.images, seed=3)
+        augmenter.pregenerate_matrices(50, seed=1, cache_bytes=2**20)
+        # whole degrees and pixels, some of the matrices are the same
+        distinct = set(matrix.tobytes() for matrix in augmenter.pregenerated_matrices)
+        self.assertEqual(len(distinct), augmenter.sampling_cache.get_stats()["entries"])
+        augmented = augmenter.augment_batch(self.images, seed=3)
+        self.assertTrue(np.array_equal(expected, augmented))
+        self.assertEqual(1.0, augmenter.sampling_cache.get_stats()["hit_rate"])
+
+        # the flipped matrices are cached too
+        augmenter = ia.ImageAugmenter(20, 24, hflip=True, rotation_deg=20, translation_x_px=3)
+        augmenter.pregenerate_matrices(50, seed=1, cache_bytes=2**20)
+        augmenter.augment_batch(self.images, seed=3)
+        self.assertEqual(2 * len(distinct), augmenter.sampling_cache.get_stats()["entries"])
+        self.assertEqual(1.0, augmenter.sampling_cache.get_stats()["hit_rate"])
+
+    def test_sampling_cache_path(self):
+        import shutil
+        import tempfile
+        cache_path = os.path.join(tempfile.mkdtemp(), "cache")
+        try:
+            # reloaded (memory-mapped) and saved again with other matrices
+            for seed in [1, 2, 1]:
+                augmenter = ia.ImageAugmenter(20, 24, hflip=True, rotation_deg=20, translation_x_px=3)
+                augmenter.pregenerate_matrices(50, seed=seed)
+                expected = augmenter.augment_batch(self.images, seed=3)
+                augmenter.pregenerate_matrices(50, seed=seed, cache_bytes=10**7, cache_path=cache_path)
+                self.assertTrue(np.array_equal(expected, augmenter.augment_batch(self.images, seed=3)),
+                                "seed %d" % (seed,))
+                # of the capacity of cache_bytes, also in the workers
+                cache = augmenter.sampling_cache
+                self.assertEqual(10**7 // cache.entry_bytes, cache.capacity)
+                self.assertEqual(10**7, augmenter.__getstate__()["sampling_cache_bytes"])
+        finally:
+            shutil.rmtree(os.path.dirname(cache_path))
+
+    def test_augment_stream(self):
+        augmenter = ia.ImageAugmenter(20, 24, hflip=True, rotation_deg=20, translation_x_px=3)
+        images = np.concatenate([self.images] * 3)
+        expected = [augmenter.augment_batch(images[start:start + 4], seed=ia._worker_seed(3, i))
+                    for i, start in enumerate(range(0, len(images), 4))]
+
+        # from batches or split from an array, e.g. a memory-mapped dataset
+        for batches, batch_size in [([images[start:start + 4] for start in range(0, len(images), 4)], None),
+                                    (images, 4)]:
+            for buffers in [2, 3]:
+                stats = {}
+                stream = augmenter.augment_stream(batches, batch_size=batch_size, buffers=buffers,
+                                                  seed=3, stats=stats)
+                # the buffers are reused, so the batches are copied
+                augmented = [np.copy(batch) for batch in stream]
+                self.assertEqual(len(expected), len(augmented))
+                self.assertTrue(all(np.array_equal(a, b) for a, b in zip(expected, augmented)))
+                self.assertEqual(len(images), stats["images"])
+                self.assertEqual(len(expected), stats["batches"])
+
+    def test_augment_stream_stalls(self):
+        augmenter = ia.ImageAugmenter(20, 24, rotation_deg=20)
+        def slow_batches():
+            for _ in range(3):
+                time.sleep(0.05)
+                yield self.images
+        stats = {}
+        for _ in augmenter.augment_stream(slow_batches(), stats=stats):
+            pass
+        self.assertEqual(3, stats["stalls"])
+        self.assertTrue(stats["stall_wait"] > 0.1)
+
+        # a slow caller: the thread waits for a free buffer, at most one
+        # batch is augmented ahead
+        stats = {}
+        stream = augmenter.augment_stream([self.images] * 10, stats=stats)
+        for _ in range(3):
+            next(stream)
+            time.sleep(0.05)
+            self.assertTrue(stats["batches"] <= 4)
+        stream.close()
+        self.assertTrue(stats["ahead_wait"] > 0.05)
+
+        # errors are raised at the failed batch
+        stream = augmenter.augment_stream([self.images, self.images[:, :10]])
+        next(stream)
+        self.assertRaises(AssertionError, next, stream)
+
+    def test_workers(self):
+        with ia.ImageAugmenter(20, 24, hflip=True, rotation_deg=20, translation_x_px=3, workers=2) as augmenter:
+            augmented = augmenter.augment_batch(self.images, seed=3)
+            self.assertTrue(np.array_equal(augmented, augmenter.augment_batch(self.images, seed=3)))
+            # larger batches grow the shared memory
+            images = np.concatenate([self.images, self.images])
+            self.assertEqual(images.shape, augmenter.augment_batch(images, seed=3).shape)
+
+        # each part of the batch is augmented like in a single process
+        augmenter = ia.ImageAugmenter(20, 24, hflip=True, rotation_deg=20, translation_x_px=3)
+        expected = augmenter.augment_batch(self.images[:2], seed=ia._worker_seed(3, 0))
+        self.assertTrue(np.array_equal(expected, augmented[:2]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+Persistent index of the image files in a set of directories and their direct
+subdirectories, the directory layout read by generate_dataset.Dataset.
+
+Directories are listed with os.scandir(), which (unlike os.listdir() followed
+by os.path.isfile()) usually does not need a stat() call per entry. The listing
+of every directory is cached together with the directory's mtime. Adding,
+removing or renaming files changes the mtime of the directory, so a refresh
+only stats the directories and relists the ones that changed, instead of
+listing millions of files again.
+
+Example usage:
+        index = FileIndex(["/foo/bar/lfw"], index_path="/tmp/lfw_index.json")
+        fps = index.refresh() # lists everything the first time
+        ...
+        fps = index.refresh() # only relists changed directories
+"""
+from __future__ import print_function, division
+import json
+import os
+import re
+import time
+
+INDEX_VERSION = 1
+DEFAULT_PATTERN = r".*\.jpg$"
+# Files added to a directory within this many nanoseconds of its last change may
+# not change its mtime again (coarse timestamps), so listings taken that soon
+# after a change are relisted on the next refresh.
+RACY_NS = 2 * 10**9
+
+class FileIndex(object):
+    """Cached listing of the files matching a pattern in dirs and their
+    direct subdirectories."""
+    def __init__(self, dirs, index_path=None, pattern=DEFAULT_PATTERN):
+        """Instantiate an index. Nothing is listed before refresh().
+        Args:
+            dirs        List of filepaths to directories. Direct subdirectories will be read.
+            index_path  File to persist the index to. Default is None (only in memory).
+            pattern     Regex that the filepaths have to match.
+        """
+        self.dirs = [os.path.abspath(fp_dir) for fp_dir in dirs]
+        self.index_path = index_path
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        # directory path -> {"mtime_ns", "racy", "files", "subdirs", "others"}
+        self.entries = {}
+        self.stats = {"dirs_checked": 0, "dirs_listed": 0}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        """Loads the persisted index, if there is one for the same pattern."""
+        if self.index_path is None or not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r") as f:
+                data = json.load(f)
+        except ValueError:
+            print("[Warning] [FileIndex] Ignoring unreadable index '%s'." % (self.index_path,))
+            return
+        if data.get("version") == INDEX_VERSION and data.get("pattern") == self.pattern:
+            self.entries = data["entries"]
+
+    def save(self):
+        """Persists the index (atomically), if it changed since loading it."""
+        if self.index_path is None or not self.changed:
+            return
+        data = {"version": INDEX_VERSION, "pattern": self.pattern, "entries": self.entries}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.index_path)
+        self.changed = False
+
+    def refresh(self):
+        """Brings the index up to date and persists it.
+        Returns:
+            Sorted list of filepaths
+        """
+        self.stats = {"dirs_checked": 0, "dirs_listed": 0}
+        seen = set()
+        for fp_dir in self.dirs:
+            entry = self.refresh_dir(fp_dir)
+            seen.add(fp_dir)
+            if entry is None:
+                continue
+            for subdir in entry["subdirs"]:
+                fp_subdir = os.path.join(fp_dir, subdir)
+                if fp_subdir not in seen:
+                    self.refresh_dir(fp_subdir)
+                    seen.add(fp_subdir)
+
+        # forget directories that were removed or are not indexed anymore
+        for fp_dir in list(self.entries.keys()):
+            if fp_dir not in seen:
+                del self.entries[fp_dir]
+                self.changed = True
+
+        self.save()
+        return self.get_filepaths()
+
+    def refresh_dir(self, fp_dir):
+        """Relists a directory if its mtime changed.
+        Returns:
+            The directory's entry or None if it does not exist.
+        """
+        self.stats["dirs_checked"] += 1
+        try:
+            mtime_ns = os.stat(fp_dir).st_mtime_ns
+        except OSError:
+            return None
+
+        entry = self.entries.get(fp_dir)
+        if entry is not None and entry["mtime_ns"] == mtime_ns and not entry["racy"]:
+            return entry
+
+        self.stats["dirs_listed"] += 1
+        racy = time.time_ns() - mtime_ns <= RACY_NS
+        files, subdirs, others = [], [], 0
+        for dir_entry in os.scandir(fp_dir):
+            if dir_entry.is_dir():
+                subdirs.append(dir_entry.name)
+            elif dir_entry.is_file():
+                if self.regex.match(dir_entry.path):
+                    files.append(dir_entry.name)
+                else:
+                    others += 1
+        entry = {"mtime_ns": mtime_ns, "racy": racy, "files": sorted(files),
+                 "subdirs": sorted(subdirs), "others": others}
+        self.entries[fp_dir] = entry
+        self.changed = True
+        return entry
+
+    def get_filepaths(self):
+        """Returns the sorted list of indexed filepaths."""
+        result = []
+        for fp_dir in sorted(self.entries.keys()):
+            result.extend([os.path.join(fp_dir, name) for name in self.entries[fp_dir]["files"]])
+        return result
+
+    def get_other_counts(self):
+        """Returns a dict of directory -> number of files not matching the pattern."""
+        return dict([(fp_dir, entry["others"]) for fp_dir, entry in self.entries.items()
+                     if entry["others"] > 0])
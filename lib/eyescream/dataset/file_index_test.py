@@ -0,0 +1,55 @@
+import unittest
+import os
+import shutil
+import tempfile
+from lib.eyescream.dataset.file_index import FileIndex
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.index_path = os.path.join(tempfile.mkdtemp(), "index.json")
+        for person in ["a", "b"]:
+            os.makedirs(os.path.join(self.root, person))
+            for i in range(3):
+                self.touch(os.path.join(self.root, person, "%s_%d.jpg" % (person, i)))
+        self.touch(os.path.join(self.root, "b", "readme.txt"))
+        self.age(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(os.path.dirname(self.index_path))
+
+    def touch(self, fp):
+        with open(fp, "w") as f:
+            f.write("x")
+
+    def age(self, fp_dir):
+        # mtimes in the past, so the listings are not racy
+        for path in [fp_dir] + [os.path.join(fp_dir, name) for name in os.listdir(fp_dir)]:
+            os.utime(path, (1000000000, 1000000000))
+
+    def test_refresh(self):
+        index = FileIndex([self.root], index_path=self.index_path)
+        fps = index.refresh()
+        self.assertEqual(6, len(fps))
+        self.assertEqual(sorted(fps), fps)
+        self.assertEqual(3, index.stats["dirs_listed"])
+        self.assertEqual({os.path.join(self.root, "b"): 1}, index.get_other_counts())
+
+        # a new index loads the persisted listing and relists nothing
+        index = FileIndex([self.root], index_path=self.index_path)
+        self.assertEqual(fps, index.refresh())
+        self.assertEqual(0, index.stats["dirs_listed"])
+
+        # only the changed directory is relisted
+        self.touch(os.path.join(self.root, "a", "a_new.jpg"))
+        os.makedirs(os.path.join(self.root, "c"))
+        self.touch(os.path.join(self.root, "c", "c_0.jpg"))
+        shutil.rmtree(os.path.join(self.root, "b"))
+        fps = index.refresh()
+        self.assertEqual(5, len(fps))
+        self.assertEqual(3, index.stats["dirs_listed"])
+        self.assertFalse(any([os.path.join(self.root, "b") in fp for fp in fps]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,13 +4,22 @@ Run with:
     python generate_dataset.py --path="/foo/bar/lfw"
 """
 from __future__ import print_function, division
+import collections
+import itertools
+import multiprocessing
 import os
 import random
-import re
+from timeit import default_timer as timer
 import numpy as np
 from scipy import misc
 from skimage import transform as tf
 import argparse
+from . import warp
+from .file_index import FileIndex
+from .prefetch import prefetch_map
+from .shards import ShardWriter
+from .writer import AsyncWriter, DEFAULT_QUALITY
+from . import manifest as mf
 
 random.seed(43)
 np.random.seed(43)
@@ -25,44 +34,438 @@ WRITE_AUG = True
 WRITE_UNAUG = False
 SCALE = 64
 AUGMENTATIONS = 19
+SEED = 43
+# Whether to sample the augmentations directly at SCALExSCALE within the crop
+# box (see crop_matrix()) instead of warping the whole image, cropping and
+# resizing the crop. Off by default, as it changes the output of gen() (see
+# the fused_crop parameter).
+FUSED_CROP = False
+# Maximum number of images handed to a worker process at once, which bounds
+# the faces held per worker (see iter_augmented()).
+MAX_CHUNKSIZE = 16
+AUGMENT_PARAMS = dict(hflip=True, vflip=False,
+                      scale_to_percent=(0.82, 1.10), scale_axis_equally=True,
+                      rotation_deg=8, shear_deg=0,
+                      translation_x_px=5, translation_y_px=5,
+                      brightness_change=0.1, noise_mean=0.0, noise_std=0.00)
+
+def gen(path, WRITE_AUG_TO, WRITE_UNAUG_TO, stats=None, workers=1, chunksize=None,
+        seed=SEED, index_path=None, shard_images=0, codec="jpg",
+        quality=DEFAULT_QUALITY, write_threads=2, write_queue=64, fsync_every=0,
+        manifest_path=None, prune=False, fused_crop=FUSED_CROP):
+    """Reads the images, augments and saves them.
+    Args:
+        path            Directory containing the source images.
+        WRITE_AUG_TO    Directory to write the augmented images to.
+        WRITE_UNAUG_TO  Directory to write the unaugmented images to.
+        stats           Optional dict. If provided, seconds spent per stage
+                        (read, augment, crop, write) as well as the number of
+                        images, bytes read and files/bytes written are
+                        accumulated into it. With workers > 1 the seconds of
+                        read, augment and crop are summed over all workers.
+                        write is the time spent handing the faces to the
+                        writer, the seconds the writer threads spent encoding
+                        and writing are counted as encode and write_io (see
+                        writer.AsyncWriter).
+        workers         Number of processes to augment the images in. The
+                        output does not depend on it, as the augmentations
+                        of each image are seeded by image_seed().
+        chunksize       Number of images handed to a worker at once.
+                        Default is None (see iter_augmented()).
+        seed            Seed from which the per image seeds are derived.
+        index_path      File to persist the index of the source images to,
+                        see Dataset. Default is None.
+        shard_images    If > 0, the faces are written to packed shards (see
+                        shards.py) of this many faces each instead of one jpg
+                        per face. Shards left from earlier runs are removed.
+                        Default is 0 (one file per face).
+        codec           Format of the files written per face: "jpg", "png"
+                        or "raw" (.npy), see writer.CODECS.
+        quality         JPEG quality.
+        write_threads   Number of threads encoding and writing the faces
+                        while the next images are augmented. 0 writes them
+                        synchronously.
+        write_queue     Maximum number of faces waiting to be written, the
+                        augmentation blocks while the queue is full.
+        fsync_every     If > 0, written files are fsynced in batches of this
+                        many. Default is 0 (no fsync).
+        manifest_path   File of the manifest (see manifest.py) for incremental
+                        runs: only sources whose content was not augmented
+                        with the same parameters and seed before are
+                        augmented, the others are counted as skipped. Outputs
+                        are named after the content hash of their source
+                        (stable over runs) and seeded by it, instead of by
+                        the source's index. Default is None (augment all,
+                        names by index). Not supported with shards.
+        prune           Whether to delete the outputs of sources that are
+                        not in path anymore (incremental runs only).
+        fused_crop      Whether to sample the faces directly at SCALExSCALE,
+                        see FUSED_CROP.
+    """
+    if stats is None:
+        stats = {}
+    for key in ["read", "augment", "crop", "write", "encode", "write_io", "write_wait",
+                "images", "skipped", "bytes_read", "files_written", "bytes_written"]:
+        stats.setdefault(key, 0)
 
-def gen(path, WRITE_AUG_TO, WRITE_UNAUG_TO):
-    # """gen method that reads the images, augments and saves them."""
-    ds = Dataset([path])
+    ds = Dataset([path], index_path=index_path)
     print("Found %d images total." % (len(ds.fps),))
-    
-    for img_idx, image in enumerate(ds.get_images()):
-        print("Image %d..." % (img_idx,))
-        augmentations = augment(image, n=AUGMENTATIONS, hflip=True, vflip=False,
-                                scale_to_percent=(0.82, 1.10), scale_axis_equally=True,
-                                rotation_deg=8, shear_deg=0,
-                                translation_x_px=5, translation_y_px=5,
-                                brightness_change=0.1, noise_mean=0.0, noise_std=0.00)
-        faces = [image]
-        faces.extend(augmentations)
-
-        for aug_idx, face in enumerate(faces):
-            crop = face[CROP_UPPER_LEFT_CORNER_Y:CROP_LOWER_RIGHT_CORNER_Y+1,
-                        CROP_UPPER_LEFT_CORNER_X:CROP_LOWER_RIGHT_CORNER_X+1,
-                        ...]
-
-            #misc.imshow(face)
-            #misc.imshow(crop)
-
-            filename = "{:0>6}_{:0>3}.jpg".format(img_idx, aug_idx)
+
+    # per task: (image index, filepath, image seed), and the output name
+    # prefix and content hash (or None) of each image index
+    tasks = []
+    outputs = {}
+    options = {"fused_crop": fused_crop}
+    manifest = None
+    if manifest_path is None:
+        for img_idx, fp in enumerate(ds.fps):
+            tasks.append((img_idx, fp, image_seed(img_idx, seed), options))
+            outputs[img_idx] = ("{:0>6}".format(img_idx), None)
+    else:
+        assert shard_images == 0, "Incremental runs do not support shards."
+        manifest = mf.Manifest(manifest_path, mf.params_key(
+            seed=seed, augmentations=AUGMENTATIONS, augment_params=AUGMENT_PARAMS,
+            scale=SCALE, fused_crop=fused_crop, write_aug=WRITE_AUG,
+            write_unaug=WRITE_UNAUG, codec=codec, quality=quality,
+            crop=[CROP_UPPER_LEFT_CORNER_X, CROP_UPPER_LEFT_CORNER_Y,
+                  CROP_LOWER_RIGHT_CORNER_X, CROP_LOWER_RIGHT_CORNER_Y]))
+        content_hashes = set()
+        for img_idx, fp in enumerate(ds.fps):
+            content_hash = manifest.content_hash(fp)
+            if content_hash in content_hashes or manifest.is_current(content_hash):
+                stats["skipped"] += 1
+            else:
+                tasks.append((img_idx, fp, mf.content_seed(content_hash, seed), options))
+                outputs[img_idx] = (mf.output_prefix(content_hash), content_hash)
+            content_hashes.add(content_hash)
+        print("%d images were already augmented." % (len(ds.fps) - len(tasks),))
+
+    nb_images = len(tasks)
+    workers = max(1, min(workers, nb_images))
+    results = iter_augmented(tasks, workers=workers, chunksize=chunksize)
+
+    shard_writers = None
+    if shard_images > 0:
+        shard_writers = (ShardWriter(WRITE_AUG_TO, shard_images, stats),
+                         ShardWriter(WRITE_UNAUG_TO, shard_images, stats))
+    writer = AsyncWriter(threads=write_threads, queue_size=write_queue, codec=codec,
+                         quality=quality, fsync_every=fsync_every, stats=stats)
+
+    gen_start = timer()
+    try:
+        for done, (img_idx, faces, image_stats) in enumerate(results):
+            for key, val in image_stats.items():
+                stats[key] += val
+
+            start = timer()
+            filename_prefix, content_hash = outputs[img_idx]
+            fps = write_faces(faces, filename_prefix, WRITE_AUG_TO, WRITE_UNAUG_TO, stats,
+                              shard_writers=shard_writers, writer=writer)
+            if manifest is not None:
+                manifest.record(content_hash, fps)
+            stats["write"] += timer() - start
+            stats["images"] += 1
+
+            elapsed = timer() - gen_start
+            print("Image %d/%d... (%.2f images/s)" % (done + 1, nb_images,
+                                                     (done + 1) / max(elapsed, 1e-6)))
+
+        if shard_writers is not None:
+            start = timer()
+            for shard_writer in shard_writers:
+                shard_writer.close()
+            stats["write"] += timer() - start
+    finally:
+        results.close()
+        start = timer()
+        writer.close()
+        stats["write"] += timer() - start
+        # the buffers of augment() grow to the largest batch
+        warp.release_scratch()
+
+    # only recorded once all outputs were written
+    if manifest is not None:
+        manifest.forget_paths(ds.fps)
+        if prune:
+            print("Pruned %d outputs of removed images." % (manifest.prune(content_hashes),))
+        manifest.save()
+
+    elapsed = timer() - gen_start
+    print("Finished %d images in %.2fs (%.2f images/s, %d workers)." % (
+        nb_images, elapsed, nb_images / max(elapsed, 1e-6), workers))
+
+def image_seed(img_idx, seed=SEED):
+    """Derives the seed for the augmentations of one image.
+    Args:
+        img_idx     Index of the image.
+        seed        Seed of the whole dataset.
+    Returns:
+        Integer seed, the same for the same arguments in every process.
+    """
+    return (seed * 1000003 + img_idx * 7919) % (2**32)
+
+def augment_faces(image, seed, fused_crop=FUSED_CROP, augmentations=AUGMENTATIONS,
+                  augment_params=None):
+    """Augments an image and crops and scales the faces out of it.
+    Args:
+        image           The image (numpy array) with a face at the LFW position.
+        seed            Seed for the augmentations, e.g. from image_seed().
+        fused_crop      Whether to sample the faces directly at SCALExSCALE, see
+                        FUSED_CROP.
+        augmentations   Number of augmented faces.
+        augment_params  Parameters of augment(). Default is None
+                        (AUGMENT_PARAMS).
+    Returns:
+        List of SCALExSCALE face images (numpy arrays, uint8), the first one
+        being unaugmented, and a dict with the seconds spent in augment and crop.
+    """
+    stats = {}
+    random.seed(seed)
+    np.random.seed(seed)
+    if augment_params is None:
+        augment_params = AUGMENT_PARAMS
+
+    if fused_crop:
+        crop_box = (CROP_UPPER_LEFT_CORNER_X, CROP_UPPER_LEFT_CORNER_Y,
+                    CROP_LOWER_RIGHT_CORNER_X, CROP_LOWER_RIGHT_CORNER_Y)
+        # all faces in one array, the augmentations are written into it
+        faces = np.empty((augmentations + 1, SCALE, SCALE) + image.shape[2:], dtype=np.uint8)
+        start = timer()
+        augment(image, n=augmentations, crop_box=crop_box,
+                output_size=(SCALE, SCALE), out=faces[1:], **augment_params)
+        stats["augment"] = timer() - start
+
+        start = timer()
+        unaugmented = warp.warp_batch(image[np.newaxis, ...],
+                                      crop_matrix(crop_box, (SCALE, SCALE)),
+                                      output_shape=(SCALE, SCALE),
+                                      out=warp.scratch_array("augment_faces", faces[:1].shape))
+        np.round(unaugmented, out=unaugmented)
+        np.copyto(faces[0], unaugmented[0], casting="unsafe")
+        stats["crop"] = timer() - start
+
+        return list(faces), stats
+
+    start = timer()
+    augmented = augment(image, n=augmentations, **augment_params)
+    stats["augment"] = timer() - start
+
+    faces = [image]
+    faces.extend(augmented)
+
+    start = timer()
+    scaled = []
+    for face in faces:
+        crop = face[CROP_UPPER_LEFT_CORNER_Y:CROP_LOWER_RIGHT_CORNER_Y+1,
+                    CROP_UPPER_LEFT_CORNER_X:CROP_LOWER_RIGHT_CORNER_X+1,
+                    ...]
+        #misc.imshow(face)
+        #misc.imshow(crop)
+        scaled.append(misc.imresize(crop, (SCALE, SCALE)))
+    stats["crop"] = timer() - start
+
+    return scaled, stats
+
+def _augment_file(task):
+    """Reads and augments one image, see gen(). Runs in the worker processes.
+    Args:
+        task        Tuple (image index, filepath, seed of the image[, dict of
+                    keyword arguments of augment_faces()]).
+    Returns:
+        Tuple (image index, faces, stats), see augment_faces().
+    """
+    img_idx, fp, seed = task[:3]
+    options = task[3] if len(task) > 3 else {}
+    start = timer()
+    image = misc.imread(fp)
+    read = timer() - start
+
+    faces, stats = augment_faces(image, seed, **options)
+    stats["read"] = read
+    stats["bytes_read"] = os.path.getsize(fp)
+
+    return img_idx, faces, stats
+
+def _augment_files(tasks):
+    """Runs _augment_file() for a chunk of tasks (in a worker process)."""
+    return [_augment_file(task) for task in tasks]
+
+def iter_augmented(tasks, workers=1, chunksize=None, max_pending=None):
+    """Reads and augments images lazily, in the order of the tasks.
+
+    Unlike Pool.imap, which augments all images as fast as the workers can
+    and queues the results, at most max_pending chunks are augmented ahead of
+    the consumer, so the memory held does not grow with the dataset when the
+    consumer is slower than the workers (e.g. writing or training).
+
+    Args:
+        tasks           Iterable of tasks of _augment_file().
+        workers         Number of processes to augment the images in. 1
+                        augments them in the calling process, when the next
+                        result is requested.
+        chunksize       Number of images handed to a worker at once.
+                        Default is None (MAX_CHUNKSIZE or, for few tasks,
+                        about four chunks per worker).
+        max_pending     Maximum number of chunks submitted to the workers
+                        but not yet consumed. Default is None (two per
+                        worker).
+    Returns:
+        Generator of tuples (image index, faces, stats), see _augment_file().
+        The worker processes are terminated when it is closed early.
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield _augment_file(task)
+        return
+
+    if chunksize is None:
+        nb_tasks = len(tasks) if hasattr(tasks, "__len__") else MAX_CHUNKSIZE * workers * 4
+        chunksize = max(1, min(MAX_CHUNKSIZE, nb_tasks // (workers * 4)))
+    if max_pending is None:
+        max_pending = 2 * workers
+    assert chunksize >= 1 and max_pending >= 1
+
+    tasks = iter(tasks)
+    pending = collections.deque()
+    pool = multiprocessing.Pool(workers)
+    finished = False
+    try:
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                chunk = list(itertools.islice(tasks, chunksize))
+                if len(chunk) == 0:
+                    exhausted = True
+                    break
+                pending.append(pool.apply_async(_augment_files, (chunk,)))
+            if len(pending) == 0:
+                break
+            for result in pending.popleft().get():
+                yield result
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+def iter_faces(path, seed=SEED, workers=1, chunksize=None, max_pending=None,
+               index_path=None, augmentations=AUGMENTATIONS, fused_crop=FUSED_CROP,
+               **augment_params):
+    """Augments the images of a dataset lazily and yields the faces one by one,
+    e.g. to feed them to a training or validation stage without writing and
+    reading them again. gen() is the same stream with files as sink, faces
+    are identical to the ones gen() writes for the same seed.
+    Args:
+        path            Directory containing the source images or a Dataset.
+        seed            Seed from which the per image seeds are derived.
+        workers         Number of processes to augment the images in.
+        chunksize       See iter_augmented().
+        max_pending     See iter_augmented(). Together with chunksize and
+                        workers, bounds the number of images augmented ahead.
+        index_path      File to persist the index of the source images to,
+                        see Dataset. Ignored if path is a Dataset.
+        augmentations   Number of augmented faces per image.
+        fused_crop      See FUSED_CROP.
+        augment_params  Parameters of augment() (e.g. rotation_deg=5),
+                        overriding the ones in AUGMENT_PARAMS.
+    Returns:
+        Generator of tuples (source_id, aug_idx, face) with source_id the
+        filepath of the source image, aug_idx the index of the face (0 being
+        the unaugmented one) and face a numpy array of shape
+        (SCALE, SCALE, C), uint8.
+    """
+    ds = path if isinstance(path, Dataset) else Dataset([path], index_path=index_path)
+    params = dict(AUGMENT_PARAMS)
+    params.update(augment_params)
+    options = dict(fused_crop=fused_crop, augmentations=augmentations, augment_params=params)
+    tasks = [(img_idx, fp, image_seed(img_idx, seed), options)
+             for img_idx, fp in enumerate(ds.fps)]
+
+    results = iter_augmented(tasks, workers=workers, chunksize=chunksize,
+                             max_pending=max_pending)
+    try:
+        for img_idx, faces, _ in results:
+            for aug_idx, face in enumerate(faces):
+                yield ds.fps[img_idx], aug_idx, face
+    finally:
+        results.close()
+
+def iter_face_batches(path, batch_size, drop_last=False, **kwargs):
+    """Like iter_faces(), but yields the faces in batches.
+    Args:
+        path        Directory containing the source images or a Dataset.
+        batch_size  Number of faces per batch.
+        drop_last   Whether to drop the last batch if it is smaller than
+                    batch_size.
+        kwargs      Further arguments of iter_faces().
+    Returns:
+        Generator of tuples (source_ids, aug_idxs, faces) with source_ids a
+        list of filepaths, aug_idxs a numpy array of ints and faces a numpy
+        array of shape (batch_size, SCALE, SCALE, C), uint8. Each batch is a
+        new array, so consumers may keep it.
+    """
+    assert batch_size >= 1
+    faces_iter = iter_faces(path, **kwargs)
+    try:
+        while True:
+            items = list(itertools.islice(faces_iter, batch_size))
+            if len(items) == 0 or (drop_last and len(items) < batch_size):
+                return
+            batch = np.empty((len(items),) + items[0][2].shape, dtype=np.uint8)
+            for i, (_, _, face) in enumerate(items):
+                batch[i] = face
+            yield ([source_id for source_id, _, _ in items],
+                   np.array([aug_idx for _, aug_idx, _ in items], dtype=np.int64),
+                   batch)
+    finally:
+        faces_iter.close()
+
+def write_faces(faces, filename_prefix, WRITE_AUG_TO, WRITE_UNAUG_TO, stats,
+                shard_writers=None, writer=None):
+    """Saves the faces of one image as <filename_prefix>_<aug index>.jpg (or
+    with the extension of the writer's codec, if an AsyncWriter is given) or,
+    if shard_writers (ShardWriters of the aug and unaug directories) are
+    given, adds them to the shards under that name.
+    Returns:
+        List of the paths of the written files (empty for shards).
+    """
+    fps = []
+    for aug_idx, face in enumerate(faces):
+        name = "{}_{:0>3}".format(filename_prefix, aug_idx)
+        if shard_writers is not None:
             if WRITE_UNAUG and aug_idx == 0:
-                face_scaled = misc.imresize(crop, (SCALE, SCALE))
-                misc.imsave(os.path.join(WRITE_UNAUG_TO, filename), face_scaled)
+                shard_writers[1].add(face, name)
             if WRITE_AUG:
-                face_scaled = misc.imresize(crop, (SCALE, SCALE))
-                misc.imsave(os.path.join(WRITE_AUG_TO, filename), face_scaled)
-
-    print("Finished.")
+                shard_writers[0].add(face, name)
+            continue
+        if writer is not None:
+            if WRITE_UNAUG and aug_idx == 0:
+                fps.append(writer.submit(os.path.join(WRITE_UNAUG_TO, name), face))
+            if WRITE_AUG:
+                fps.append(writer.submit(os.path.join(WRITE_AUG_TO, name), face))
+            continue
+        filename = name + ".jpg"
+        if WRITE_UNAUG and aug_idx == 0:
+            fps.append(os.path.join(WRITE_UNAUG_TO, filename))
+            write_image(fps[-1], face, stats)
+        if WRITE_AUG:
+            fps.append(os.path.join(WRITE_AUG_TO, filename))
+            write_image(fps[-1], face, stats)
+    return fps
+
+def write_image(fp, image, stats):
+    """Saves an image and counts the written file and bytes in stats."""
+    misc.imsave(fp, image)
+    stats["files_written"] += 1
+    stats["bytes_written"] += os.path.getsize(fp)
 
 def augment(image, n,
             hflip=False, vflip=False, scale_to_percent=1.0, scale_axis_equally=True,
             rotation_deg=0, shear_deg=0, translation_x_px=0, translation_y_px=0,
-            brightness_change=0.0, noise_mean=0.0, noise_std=0.0):
+            brightness_change=0.0, noise_mean=0.0, noise_std=0.0, batched=True,
+            crop_box=None, output_size=None, out=None, backend="float"):
     """Augment an image n times.
     Args:
             n                   Number of augmentations to generate.
@@ -80,14 +483,38 @@ def augment(image, n,
                                 E.g. 0.2 is -20% to +20%.
             noise_mean          Mean value of gaussian noise to add.
             noise_std           Standard deviation of gaussian noise to add.
+            batched             Whether to warp all augmentations at once with
+                                warp.warp_batch() (True) or one by one with
+                                scikit-image (False). Both draw the same random
+                                values, results differ by at most one
+                                intensity level of the interpolation.
+            crop_box            Optional (x0, y0, x1, y1) box (inclusive) to
+                                crop out of each augmented image. The crop is
+                                composed into the augmentation matrices, so
+                                only the pixels inside of it are sampled.
+            output_size         (height, width) to scale the crops to.
+                                Default is None (size of the crop box).
+            out                 Optional uint8 array of shape (n, height,
+                                width[, channels]) to write the augmentations
+                                to, e.g. reused across calls. Brightness,
+                                noise and clipping are applied in place in
+                                float32 scratch space (see
+                                warp.scratch_array()), so no image sized
+                                arrays are allocated besides the ones of
+                                skimage (batched=False) and of the noise.
+            backend             Interpolation of the batched version, one of
+                                warp.BACKENDS. "integer" warps straight into
+                                uint8 (at most one intensity level off
+                                "float"). Ignored if not batched. Default is
+                                "float".
     Returns:
-        List of numpy arrays
+        List of numpy arrays, or out if given.
     """
     assert n >= 0
-    result = []
+    result = [] if out is None else out
     if n == 0:
         return result
-    
+
     width = image.shape[0]
     height = image.shape[1]
     matrices = create_aug_matrices(n, img_width_px=width, img_height_px=height,
@@ -97,11 +524,28 @@ def augment(image, n,
                                    shear_deg=shear_deg,
                                    translation_x_px=translation_x_px,
                                    translation_y_px=translation_y_px)
+    output_shape = None
+    if crop_box is not None:
+        if output_size is None:
+            output_size = (crop_box[3] - crop_box[1] + 1, crop_box[2] - crop_box[0] + 1)
+        output_shape = tuple(output_size)
+        matrices = np.dot(warp.as_matrix_array(matrices), crop_matrix(crop_box, output_size))
+    if out is not None:
+        shape = (n,) + (output_shape or image.shape[:2]) + image.shape[2:]
+        assert out.shape == shape and out.dtype == np.uint8, \
+            "out must be a uint8 array of shape %s." % (str(shape),)
+    if batched:
+        result = _augment_batched(image, matrices, hflip, vflip,
+                                  brightness_change, noise_mean, noise_std,
+                                  output_shape=output_shape, out=out,
+                                  backend=backend)
+        return result if out is not None else list(result)
+
     for i in range(n):
-        img = np.copy(image)
+        img = image
         matrix = matrices[i]
         
-        # random horizontal / vertical flip
+        # random horizontal / vertical flip (views, not copies)
         if hflip and random.random() > 0.5:
             img = np.fliplr(img)
         if vflip and random.random() > 0.5:
@@ -109,79 +553,134 @@ def augment(image, n,
         
         # random brightness adjustment
         by_percent = random.uniform(1.0 - brightness_change, 1.0 + brightness_change)
-        img = img * by_percent
+        scratch = warp.scratch_array("augment", img.shape)
+        np.multiply(img, by_percent, out=scratch)
         
         # gaussian noise
         # numpy requires a std above 0
         if noise_std > 0:
-            img = img + (255 * np.random.normal(noise_mean, noise_std, (img.shape)))
+            scratch += 255 * np.random.normal(noise_mean, noise_std, (img.shape))
         
         # clip to 0-255
-        img = np.clip(img, 0, 255).astype(np.uint8)
+        np.maximum(scratch, 0, out=scratch)
+        np.minimum(scratch, 255, out=scratch)
+        img = warp.scratch_array("augment.uint8", img.shape, np.uint8)
+        np.copyto(img, scratch, casting="unsafe")
         
-        arr = tf.warp(img, matrix, mode="constant") # projects to float 0-1
-        img = np.array(arr * 255, dtype=np.uint8)
-        result.append(img)
+        arr = tf.warp(img, matrix, mode="constant", output_shape=output_shape) # projects to float 0-1
+        arr *= 255
+        if out is None:
+            result.append(arr.astype(np.uint8))
+        else:
+            np.copyto(out[i], arr, casting="unsafe")
         
     return result
 
+def _augment_batched(image, matrices, hflip, vflip, brightness_change,
+                     noise_mean, noise_std, output_shape=None, out=None,
+                     backend="float"):
+    """Applies the matrices, flips, brightness and noise of augment() at once.
+    Like in the unbatched loop, the flips, brightness, noise and clipping are
+    applied to copies of the image, which are then warped together.
+    Returns:
+        Numpy array of shape (n, height, width[, channels]), uint8, with
+        (height, width) being output_shape if given. out if given.
+    """
+    n = len(matrices)
+    matrices = warp.as_matrix_array(matrices)
+
+    # Random values are drawn in the same order as in the unbatched loop.
+    inputs = warp.scratch_array("augment.inputs", (n,) + image.shape, np.uint8)
+    scratch = warp.scratch_array("augment", image.shape)
+    for i in range(n):
+        img = image
+        if hflip and random.random() > 0.5:
+            img = np.fliplr(img)
+        if vflip and random.random() > 0.5:
+            img = np.flipud(img)
+        by_percent = random.uniform(1.0 - brightness_change, 1.0 + brightness_change)
+        np.multiply(img, by_percent, out=scratch)
+        if noise_std > 0:
+            noise = np.random.normal(noise_mean, noise_std, img.shape)
+            noise *= 255
+            scratch += noise
+        np.maximum(scratch, 0, out=scratch)
+        np.minimum(scratch, 255, out=scratch)
+        np.copyto(inputs[i], scratch, casting="unsafe")
+
+    shape = (n,) + (output_shape or image.shape[:2]) + image.shape[2:]
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
+    if backend == "integer":
+        return warp.warp_batch(inputs, matrices, output_shape=output_shape,
+                               out=out, backend="integer")
+    result = warp.warp_batch(inputs, matrices, output_shape=output_shape,
+                             out=warp.scratch_array("augment.warped", shape))
+    np.copyto(out, result, casting="unsafe")
+    return out
+
 class Dataset(object):
     """Helper class to handle the loading of the LFW dataset dataset."""
-    def __init__(self, dirs):
+    def __init__(self, dirs, index_path=None):
         """Instantiate a dataset object.
         Args:
-            dirs    List of filepaths to directories. Direct subdirectories will be read.
+            dirs        List of filepaths to directories. Direct subdirectories will be read.
+            index_path  File to persist the file index to, so that the next
+                        instantiation only relists changed directories (see
+                        file_index.FileIndex). Default is None (list all).
         """
         self.dirs = dirs
-        self.fps = self.get_filepaths(self.get_direct_subdirectories(dirs))
-    
-    def get_direct_subdirectories(self, dirs):
-        """Find all direct subdirectories of a list of directories.
-        Args:
-            dirs    List of directories to search in.
-        Returns:
-            Set of paths to directories
-        """
-        result = []
-        result.extend(dirs)
-        for fp_dir in dirs:
-            subdirs = [name for name in os.listdir(fp_dir) if os.path.isdir(os.path.join(fp_dir, name))]
-            subdirs = [os.path.join(fp_dir, name) for name in subdirs]
-            result.extend(subdirs)
-        return set(result)
+        self.index = FileIndex(dirs, index_path=index_path)
+        self.fps = self.index.refresh()
+        for fp_dir, count in sorted(self.index.get_other_counts().items()):
+            print("[Warning] directory '%s' contained %d files with extension differing from 'jpg'" % (fp_dir, count))
+        if len(self.fps) < 1:
+            print("[Warning] [Dataset] No images of extension *.jpg found in given directories.")
     
-    def get_filepaths(self, dirs):
-        """Find all jpg-images in provided filepaths.
-        Args:
-            dirs    List of paths to directories to search in.
-        Returns:
-            List of filepaths
-        """
-        result = []
-        for fp_dir in dirs:
-            fps = [f for f in os.listdir(fp_dir) if os.path.isfile(os.path.join(fp_dir, f))]
-            fps = [os.path.join(fp_dir, f) for f in fps]
-            fps_img = [fp for fp in fps if re.match(r".*\.jpg$", fp)]
-            if len(fps) != len(fps_img):
-                print("[Warning] directory '%s' contained %d files with extension differing from 'jpg'" % (fp_dir, len(fps)-len(fps_img)))
-            result.extend(fps_img)
-        if len(result) < 1:
-            print("[Warning] [Dataset] No images of extension *.ppm found in given directories.")
-        return result
-    
-    def get_images(self, start_at=None, count=None):
+    def get_images(self, start_at=None, count=None, prefetch=0, workers=2, max_bytes=None):
         """Returns a generator of images.
         Args:
             start_at    Index of first image to return or None.
             count       Maximum number of images to return or None.
+            prefetch    Number of images to read and decode ahead in
+                        background threads while the caller processes the
+                        current one. Default is 0 (read on demand).
+            workers     Number of threads reading ahead (if prefetch > 0).
+            max_bytes   Optional cap on the memory of the images read ahead,
+                        see prefetch.prefetch_map().
         Returns:
-            Generator of images (numpy arrays).
+            Generator of images (numpy arrays), in the order of self.fps.
         """
         start_at = 0 if start_at is None else start_at
         end_at = len(self.fps) if count is None else start_at+count
-        for fp in self.fps[start_at:end_at]:
-            image = misc.imread(fp)
-            yield image
+        fps = self.fps[start_at:end_at]
+        if prefetch > 0:
+            return prefetch_map(misc.imread, fps, depth=prefetch, workers=workers,
+                                max_bytes=max_bytes)
+        return (misc.imread(fp) for fp in fps)
+
+def crop_matrix(crop_box, output_size):
+    """Creates the matrix that maps the pixels of a crop, scaled to
+    output_size, to the pixels of the uncropped image.
+
+    Pixel centers are mapped like in an image resize, i.e. output pixel x
+    samples the crop at (x + 0.5) * scale - 0.5.
+
+    Args:
+        crop_box: (x0, y0, x1, y1) of the crop, inclusive.
+        output_size: (height, width) of the scaled crop.
+
+    Returns:
+        Numpy array of shape (3, 3). Compose it with an augmentation matrix
+        (in the inverse direction, as returned by create_aug_matrices()) as
+        np.dot(matrix, crop_matrix(...)).
+    """
+    x0, y0, x1, y1 = crop_box
+    scale_x = (x1 - x0 + 1) / output_size[1]
+    scale_y = (y1 - y0 + 1) / output_size[0]
+    return np.array([[scale_x, 0, x0 + 0.5 * scale_x - 0.5],
+                     [0, scale_y, y0 + 0.5 * scale_y - 0.5],
+                     [0, 0, 1]], dtype=np.float64)
 
 def create_aug_matrices(nb_matrices, img_width_px, img_height_px,
                         scale_to_percent=1.0, scale_axis_equally=False,
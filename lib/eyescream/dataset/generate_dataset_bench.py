@@ -0,0 +1,124 @@
+"""
+Benchmarks the augmentation of generate_dataset: the unbatched vs. the batched
+augment() and, per image, cropping and resizing the augmentations vs. sampling
+them directly at SCALExSCALE (FUSED_CROP). The latter is skipped for images
+smaller than the LFW crop box. With --memory, the memory allocated by
+augment() (with and without out=) and augment_faces() is measured with
+tracemalloc instead of the time.
+Run from the repository root with:
+    python -m lib.eyescream.dataset.generate_dataset_bench --sizes 250 --repeats 5
+"""
+from __future__ import print_function, division
+import argparse
+import json
+import random
+import tracemalloc
+from timeit import default_timer as timer
+import numpy as np
+from . import generate_dataset as gd
+
+def bench_augment(image, repeats, **kwargs):
+    """Returns the seconds per augment() call (the best of repeats) and its output."""
+    best = None
+    result = None
+    for _ in range(repeats):
+        random.seed(gd.SEED)
+        np.random.seed(gd.SEED)
+        start = timer()
+        result = gd.augment(image, n=gd.AUGMENTATIONS, **kwargs)
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, np.array(result)
+
+def bench_faces(image, repeats, **kwargs):
+    """Returns the seconds per augment_faces() call (the best of repeats) and its output."""
+    best = None
+    result = None
+    for _ in range(repeats):
+        start = timer()
+        result, _ = gd.augment_faces(image, gd.SEED, **kwargs)
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, np.array(result)
+
+def bench_memory(call, nb_faces):
+    """Measures the memory allocated by call() with tracemalloc, after a first
+    call that allocates the scratch space reused across calls.
+    Returns:
+        Dict with the peak of the memory allocated during the call and the
+        memory still allocated after it (e.g. the returned faces), in bytes
+        per call and per face.
+    """
+    call()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = call()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return {"peak_bytes": peak - baseline, "retained_bytes": current - baseline,
+            "peak_bytes_per_face": (peak - baseline) / nb_faces}
+
+def main_memory(sizes):
+    results = {}
+    for size in sizes:
+        image = np.random.RandomState(size).randint(0, 256, (size, size, 3)).astype(np.uint8)
+        out = np.empty((gd.AUGMENTATIONS,) + image.shape, dtype=np.uint8)
+        results[size] = {
+            "augment": bench_memory(
+                lambda: gd.augment(image, n=gd.AUGMENTATIONS, **gd.AUGMENT_PARAMS),
+                gd.AUGMENTATIONS),
+            "augment_out": bench_memory(
+                lambda: gd.augment(image, n=gd.AUGMENTATIONS, out=out, **gd.AUGMENT_PARAMS),
+                gd.AUGMENTATIONS),
+            "augment_loop_out": bench_memory(
+                lambda: gd.augment(image, n=gd.AUGMENTATIONS, out=out, batched=False,
+                                   **gd.AUGMENT_PARAMS),
+                gd.AUGMENTATIONS),
+        }
+        if size > max(gd.CROP_LOWER_RIGHT_CORNER_X, gd.CROP_LOWER_RIGHT_CORNER_Y):
+            results[size]["faces"] = bench_memory(lambda: gd.augment_faces(image, gd.SEED),
+                                                  gd.AUGMENTATIONS + 1)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="250", help="comma separated image sizes in pixels")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--memory", action="store_true",
+                        help="measure allocated memory instead of time")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    if args.memory:
+        print(json.dumps(main_memory(sizes), indent=2, sort_keys=True))
+        return
+
+    results = {}
+    for size in sizes:
+        image = np.random.RandomState(size).randint(0, 256, (size, size, 3)).astype(np.uint8)
+        loop, loop_out = bench_augment(image, args.repeats, batched=False, **gd.AUGMENT_PARAMS)
+        batched, batched_out = bench_augment(image, args.repeats, batched=True, **gd.AUGMENT_PARAMS)
+        results[size] = {
+            "loop_ms": loop * 1000,
+            "batched_ms": batched * 1000,
+            "speedup": loop / batched,
+            "mean_abs_diff": float(np.mean(np.abs(loop_out.astype(np.int16) - batched_out))),
+        }
+        if size <= max(gd.CROP_LOWER_RIGHT_CORNER_X, gd.CROP_LOWER_RIGHT_CORNER_Y):
+            continue
+        unfused, unfused_out = bench_faces(image, args.repeats, fused_crop=False)
+        fused, fused_out = bench_faces(image, args.repeats, fused_crop=True)
+        results[size]["faces"] = {
+            "unfused_ms": unfused * 1000,
+            "fused_ms": fused * 1000,
+            "speedup": unfused / fused,
+            "mean_abs_diff": float(np.mean(np.abs(unfused_out.astype(np.int16) - fused_out))),
+        }
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import numpy as np
+from PIL import Image
+from lib.eyescream.dataset import generate_dataset as gd
+from lib.eyescream.dataset import warp
+
+class TestGenerateDataset(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = self.make_dir("input")
+        self.unaug_dir = self.make_dir("unaug")
+        # of the size of the LFW images, which are cropped at a fixed box
+        rng = np.random.RandomState(0)
+        gradient = np.linspace(0, 200, 250)[np.newaxis, :, np.newaxis]
+        image = gradient + rng.randint(0, 56, (250, 250, 3))
+        self.image_fp = os.path.join(self.input_dir, "face.jpg")
+        Image.fromarray(image.astype(np.uint8)).save(self.image_fp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_dir(self, name):
+        path = os.path.join(self.tmp_dir, name)
+        os.makedirs(path)
+        return path
+
+    def read_files(self, fp_dir):
+        files = {}
+        for name in sorted(os.listdir(fp_dir)):
+            with open(os.path.join(fp_dir, name), "rb") as f:
+                files[name] = f.read()
+        return files
+
+    def test_gen_workers(self):
+        # more images than workers, handed out one by one, so that the pool
+        # schedules them and the order of the results matters
+        input_dir = self.make_dir("workers_input")
+        image = Image.open(self.image_fp)
+        for i in range(6):
+            image.rotate(15 * i).save(os.path.join(input_dir, "face_%d.jpg" % (i,)))
+        outputs = []
+        for workers in [1, 2, 4]:
+            aug_dir = self.make_dir("aug_workers_%d" % (workers,))
+            gd.gen(input_dir, aug_dir, self.unaug_dir, workers=workers, chunksize=1)
+            outputs.append(self.read_files(aug_dir))
+
+        self.assertEqual(6 * (gd.AUGMENTATIONS + 1), len(outputs[0]))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
+        # the fused crop is opt-in, it changes the faces but not their names
+        aug_dir = self.make_dir("aug_fused_crop")
+        gd.gen(input_dir, aug_dir, self.unaug_dir, fused_crop=True)
+        fused = self.read_files(aug_dir)
+        self.assertEqual(sorted(outputs[0].keys()), sorted(fused.keys()))
+        self.assertNotEqual(outputs[0], fused)
+
+    def test_gen_batched(self):
+        # by default, the augmentations are warped at once, which gives the
+        # faces of the loop over them up to one level of the interpolation,
+        # brightness included
+        self.assertTrue(0 < gd.AUGMENT_PARAMS["brightness_change"])
+        # of high contrast, where clipping the brightness before and after
+        # the interpolation differs
+        input_dir = self.make_dir("contrast_input")
+        image = np.random.RandomState(1).randint(0, 256, (250, 250, 3))
+        Image.fromarray(image.astype(np.uint8)).save(os.path.join(input_dir, "face.jpg"), quality=95)
+        outputs = []
+        augment_params = gd.AUGMENT_PARAMS
+        for label, params in [("default", augment_params),
+                             ("loop", dict(augment_params, batched=False))]:
+            aug_dir = self.make_dir("aug_" + label)
+            try:
+                gd.AUGMENT_PARAMS = params
+                gd.gen(input_dir, aug_dir, self.unaug_dir, codec="raw")
+            finally:
+                gd.AUGMENT_PARAMS = augment_params
+            outputs.append(dict((name, np.load(os.path.join(aug_dir, name)))
+                                for name in sorted(os.listdir(aug_dir))))
+
+        self.assertTrue(0 < len(outputs[0]))
+        self.assertEqual(sorted(outputs[0].keys()), sorted(outputs[1].keys()))
+        for name, face in outputs[0].items():
+            error = np.abs(face.astype(np.int32) - outputs[1][name]).max()
+            self.assertTrue(error <= 1, "%s: %d" % (name, error))
+
+    def test_gen_incremental(self):
+        input_dir = self.make_dir("incremental_input")
+        aug_dir = self.make_dir("aug_incremental")
+        manifest_fp = os.path.join(self.tmp_dir, "manifest.json")
+
+        shutil.copy(self.image_fp, os.path.join(input_dir, "a.jpg"))
+        stats = {}
+        gd.gen(input_dir, aug_dir, self.unaug_dir, stats=stats, manifest_path=manifest_fp)
+        self.assertEqual(1, stats["images"])
+        files = sorted(os.listdir(aug_dir))
+
+        # unchanged and renamed/copied sources are not augmented again
+        shutil.copy(os.path.join(input_dir, "a.jpg"), os.path.join(input_dir, "b.jpg"))
+        stats = {}
+        gd.gen(input_dir, aug_dir, self.unaug_dir, stats=stats, manifest_path=manifest_fp)
+        self.assertEqual(0, stats["images"])
+        self.assertEqual(2, stats["skipped"])
+        self.assertEqual(files, sorted(os.listdir(aug_dir)))
+
+        # a changed source gets new outputs, the old ones keep their names
+        Image.open(self.image_fp).rotate(90).save(os.path.join(input_dir, "a.jpg"))
+        stats = {}
+        gd.gen(input_dir, aug_dir, self.unaug_dir, stats=stats, manifest_path=manifest_fp)
+        self.assertEqual(1, stats["images"])
+        self.assertEqual(2 * len(files), len(os.listdir(aug_dir)))
+        self.assertTrue(set(files) < set(os.listdir(aug_dir)))
+
+    def test_iter_faces(self):
+        faces = list(gd.iter_faces(self.input_dir))
+        self.assertTrue(0 < len(faces))
+        for _, _, face in faces:
+            self.assertEqual((gd.SCALE, gd.SCALE, 3), face.shape)
+
+        # the same faces, in the same order, from the workers and in batches
+        batches = list(gd.iter_face_batches(self.input_dir, 8, workers=2, chunksize=1, max_pending=1))
+        self.assertTrue(all(len(batch[2]) == 8 for batch in batches[:-1]))
+        self.assertEqual([(source_id, aug_idx) for source_id, aug_idx, _ in faces],
+                         [(source_id, aug_idx) for batch in batches for source_id, aug_idx in zip(batch[0], batch[1])])
+        self.assertTrue(np.array_equal(np.stack([face for _, _, face in faces]),
+                                       np.concatenate([batch[2] for batch in batches])))
+
+        faces = list(gd.iter_faces(self.input_dir, augmentations=2, rotation_deg=0))
+        self.assertEqual(3, len([face for face in faces if face[0] == faces[0][0]]))
+
+    def test_fused_crop(self):
+        img = np.asarray(Image.open(self.image_fp).convert("RGB"))
+        crop_box = (gd.CROP_UPPER_LEFT_CORNER_X, gd.CROP_UPPER_LEFT_CORNER_Y,
+                    gd.CROP_LOWER_RIGHT_CORNER_X, gd.CROP_LOWER_RIGHT_CORNER_Y)
+
+        # without scaling, the crop matrix only translates
+        crop = warp.warp_batch(img[np.newaxis, ...], gd.crop_matrix(crop_box, (84, 84)), output_shape=(84, 84))
+        self.assertTrue(np.allclose(crop[0], img[crop_box[1]:crop_box[3] + 1, crop_box[0]:crop_box[2] + 1]))
+
+        # written to out, the same augmentations as without
+        def augment(batched, out=None, noise_std=0.01, backend="float"):
+            random.seed(gd.SEED)
+            np.random.seed(gd.SEED)
+            return gd.augment(img, n=3, hflip=True, rotation_deg=5, brightness_change=0.1,
+                              noise_std=noise_std, batched=batched, crop_box=crop_box,
+                              output_size=(64, 64), out=out, backend=backend)
+        for batched in [True, False]:
+            out = np.zeros((3, 64, 64, 3), dtype=np.uint8)
+            self.assertTrue(augment(batched, out) is out)
+            self.assertTrue(np.array_equal(np.stack(augment(batched)), out))
+
+        # within one level of the float backend
+        for noise_std in [0.0, 0.01]:
+            out = np.zeros((3, 64, 64, 3), dtype=np.uint8)
+            self.assertTrue(augment(True, out, noise_std, "integer") is out)
+            expected = augment(True, noise_std=noise_std)
+            self.assertTrue(np.abs(out.astype(np.int32) - expected).max() <= 1)
+
+        faces, _ = gd.augment_faces(img, gd.SEED, fused_crop=True)
+        self.assertEqual(len(faces), gd.AUGMENTATIONS + 1)
+        for face in faces:
+            self.assertEqual(face.shape, (gd.SCALE, gd.SCALE, 3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""
+Manifest of the augmented outputs of generate_dataset.gen, for incremental
+runs that only augment new or changed source images.
+
+Sources are identified by the sha1 of their content, so renamed or copied
+images are not augmented again, and an image that was overwritten with
+different content counts as new. The outputs of a source are only reused if
+they were generated with the same parameters (see params_key()). Hashes are
+cached together with the size and mtime of the source files, so unchanged
+sources are not read again.
+
+Outputs are named after the content hash (see output_prefix()), which keeps
+the names stable over runs and distinct for different sources.
+
+Example usage:
+        manifest = Manifest("/tmp/manifest.json", params_key(seed=43, ...))
+        content_hash = manifest.content_hash(fp)
+        if not manifest.is_current(content_hash):
+            ... # augment fp and write its faces
+            manifest.record(content_hash, written_files)
+        manifest.save()
+"""
+from __future__ import print_function, division
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 1
+# hex digits of the content hash used in output names
+PREFIX_LENGTH = 16
+
+def params_key(**params):
+    """Returns a key (string) identifying the parameters of an augmentation run.
+    Args:
+        params      JSON serializable values that influence the outputs.
+    """
+    encoded = json.dumps(params, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()
+
+def file_hash(fp):
+    """Returns the sha1 (hex) of a file's content."""
+    sha1 = hashlib.sha1()
+    with open(fp, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def output_prefix(content_hash):
+    """Returns the filename prefix of the outputs of a source."""
+    return content_hash[:PREFIX_LENGTH]
+
+def content_seed(content_hash, seed):
+    """Derives the seed for the augmentations of a source from its content,
+    like generate_dataset.image_seed() does from its index."""
+    return (seed * 1000003 + int(content_hash[:8], 16)) % (2**32)
+
+class Manifest(object):
+    """Maps the content hashes of sources to the outputs generated from them."""
+    def __init__(self, path, params):
+        """Instantiate a manifest, loading it from path if it exists.
+        Args:
+            path        File the manifest is persisted to.
+            params      Key of the current parameters, see params_key().
+        """
+        self.path = path
+        self.params = params
+        # content hash -> {"params": params key, "files": [output paths]}
+        self.sources = {}
+        # source path -> [size, mtime_ns, content hash]
+        self.hashes = {}
+        self.changed = False
+        if os.path.isfile(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+            except ValueError:
+                print("[Warning] [Manifest] Ignoring unreadable manifest '%s'." % (path,))
+                return
+            if data.get("version") == MANIFEST_VERSION:
+                self.sources = data["sources"]
+                self.hashes = data["hashes"]
+
+    def content_hash(self, fp):
+        """Returns the content hash of a source, reading it only if its size
+        or mtime changed since it was last hashed."""
+        fp = os.path.abspath(fp)
+        st = os.stat(fp)
+        cached = self.hashes.get(fp)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        content_hash = file_hash(fp)
+        self.hashes[fp] = [st.st_size, st.st_mtime_ns, content_hash]
+        self.changed = True
+        return content_hash
+
+    def is_current(self, content_hash):
+        """Returns whether the outputs of a source were generated with the
+        current parameters. Only the first output is checked to still exist
+        (e.g. the output directory was not wiped), to keep this one stat."""
+        entry = self.sources.get(content_hash)
+        if entry is None or entry["params"] != self.params:
+            return False
+        return len(entry["files"]) == 0 or os.path.exists(entry["files"][0])
+
+    def record(self, content_hash, files):
+        """Records the outputs generated from a source."""
+        self.sources[content_hash] = {"params": self.params, "files": sorted(files)}
+        self.changed = True
+
+    def forget_paths(self, fps):
+        """Drops the cached hashes of all source paths except fps (e.g. the
+        ones of deleted sources)."""
+        keep = set([os.path.abspath(fp) for fp in fps])
+        for fp in list(self.hashes.keys()):
+            if fp not in keep:
+                del self.hashes[fp]
+                self.changed = True
+
+    def prune(self, content_hashes):
+        """Deletes the outputs of all sources except the given ones.
+        Returns:
+            Number of deleted files.
+        """
+        keep = set(content_hashes)
+        deleted = 0
+        for content_hash in list(self.sources.keys()):
+            if content_hash in keep:
+                continue
+            for fp in self.sources[content_hash]["files"]:
+                if os.path.exists(fp):
+                    os.remove(fp)
+                    deleted += 1
+            del self.sources[content_hash]
+            self.changed = True
+        return deleted
+
+    def save(self):
+        """Persists the manifest (atomically), if it changed."""
+        if not self.changed:
+            return
+        data = {"version": MANIFEST_VERSION, "sources": self.sources, "hashes": self.hashes}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+        self.changed = False
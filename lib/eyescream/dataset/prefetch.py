@@ -0,0 +1,63 @@
+"""
+Ordered read-ahead for loading files (e.g. reading and decoding images) while
+the caller processes the previous results.
+
+Example usage:
+        for image in prefetch_map(misc.imread, fps, depth=8, workers=2):
+            ... # the next images are read and decoded meanwhile
+"""
+from __future__ import print_function, division
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+def prefetch_map(load, items, depth=4, workers=2, max_bytes=None):
+    """Yields load(item) for each item, in the order of items, while up to
+    depth items are loaded ahead by a pool of threads.
+
+    Decoding with PIL and reading files release the GIL, so the threads run
+    in parallel with the caller. Exceptions raised by load are raised by the
+    iterator at the position of the failed item. Items not loaded yet are
+    cancelled when the iterator is closed early.
+
+    Args:
+        load        Function loading one item, e.g. misc.imread.
+        items       Iterable of the items to load.
+        depth       Maximum number of items loaded ahead (queued, being
+                    loaded or loaded but not yet consumed).
+        workers     Number of loading threads.
+        max_bytes   Optional cap on the memory held by the loaded but not yet
+                    consumed results (numpy arrays). Each result is assumed to
+                    be as large as the largest one so far, at least one item
+                    is always loaded ahead. Default is None (only depth).
+    Returns:
+        Generator of the loaded items.
+    """
+    assert depth >= 1
+    assert workers >= 1
+    items = iter(items)
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    largest = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < depth:
+                if max_bytes is not None and len(pending) > 0 \
+                        and (largest == 0 or (len(pending) + 1) * largest > max_bytes):
+                    break
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append(executor.submit(load, item))
+
+            if len(pending) == 0:
+                return
+            result = pending.popleft().result()
+            largest = max(largest, getattr(result, "nbytes", 0))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
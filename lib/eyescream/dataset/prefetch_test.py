@@ -0,0 +1,39 @@
+import unittest
+import threading
+import time
+import numpy as np
+from lib.eyescream.dataset.prefetch import prefetch_map
+
+class TestPrefetch(unittest.TestCase):
+    def test_order(self):
+        # later items finish loading first
+        load = lambda i: time.sleep(0.01 * (5 - i)) or i
+        self.assertEqual(list(range(5)), list(prefetch_map(load, range(5), depth=5, workers=5)))
+
+    def test_exception(self):
+        def load(i):
+            if i == 2:
+                raise ValueError("broken image")
+            return i
+        results = prefetch_map(load, range(5), depth=3)
+        self.assertEqual(0, next(results))
+        self.assertEqual(1, next(results))
+        self.assertRaises(ValueError, next, results)
+
+    def test_max_bytes(self):
+        lock = threading.Lock()
+        loaded = [0]
+        def load(i):
+            with lock:
+                loaded[0] += 1
+            return np.zeros((1000,), dtype=np.uint8)
+        results = prefetch_map(load, range(100), depth=50, workers=4, max_bytes=3000)
+        for _ in range(10):
+            next(results)
+            time.sleep(0.01)
+            # consumed + at most 3 results of 1000 bytes ahead
+            self.assertTrue(loaded[0] <= 10 + 3)
+        results.close()
+
+if __name__ == '__main__':
+    unittest.main()
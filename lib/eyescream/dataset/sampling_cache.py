@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""Cache of the samplings (see warp.compute_sampling()) of single matrices.
+
+Augmenters that reuse a fixed set of matrices (see
+ImageAugmenter.pregenerate_matrices()) warp with the same few thousand
+matrices over and over. Instead of mapping the coordinates of every output
+pixel again, the cache keeps the source indices and interpolation offsets
+of each matrix, so that warping a batch only gathers the rows of its
+matrices and interpolates.
+
+Entries are keyed by the bytes of the (float32) matrix and evicted in least
+recently used order once max_bytes are used. A cache may be saved to a
+directory of .npy files and loaded from it memory-mapped, in which case
+only the pages of the used matrices are read and misses are stored in
+memory besides them.
+
+Only the modes "constant" and "edge" are cached, as their padding does not
+depend on the matrices.
+
+Example usage:
+        cache = SamplingCache((64, 64), max_bytes=256 * 2**20)
+        sampling = cache.sampling(matrices[order_indices])
+        warped = warp.apply_sampling(images, sampling)
+        print(cache.get_stats()["hit_rate"])
+"""
+from __future__ import print_function, division
+import collections
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from . import warp
+
+CACHE_VERSION = 1
+CACHED_MODES = ["constant", "edge"]
+# matrices whose sampling is computed at once on misses, bounds the
+# temporaries of compute_sampling()
+COMPUTE_BATCH = 256
+
+class SamplingCache(object):
+    """LRU cache of per-matrix samplings for one input/output shape."""
+    def __init__(self, input_shape, output_shape=None, order=1, mode="constant",
+                 max_bytes=256 * 2**20):
+        """Instantiate an empty cache.
+
+        Args:
+            input_shape: (height, width) of the images that will be warped.
+            output_shape: (height, width) of the warped images. Default is
+                None (same as input_shape).
+            order: Interpolation order, 0 or 1.
+            mode: One of CACHED_MODES.
+            max_bytes: Maximum size of the cached samplings. At least one
+                entry is always kept. The storage is allocated at once, but
+                its pages are only backed by memory once they are used.
+        """
+        assert mode in CACHED_MODES, "Mode '%s' is not cached." % (mode,)
+        assert order in [0, 1]
+        self.input_shape = (input_shape[0], input_shape[1])
+        output_shape = output_shape if output_shape is not None else input_shape
+        self.output_shape = (output_shape[0], output_shape[1])
+        self.order = order
+        self.mode = mode
+        # the same for all matrices, see warp.compute_sampling()
+        self.padding = ((1, 2), (1, 2))
+        self.nb_pixels = self.output_shape[0] * self.output_shape[1]
+        self.entry_bytes = self.nb_pixels * (4 if order == 0 else 12)
+        self._allocate(max(1, max_bytes // self.entry_bytes))
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _allocate(self, capacity, mapped=None):
+        """Allocates the storage of capacity entries. The first ones may be
+        given as mapped, a dict of arrays like self.entries (e.g. memory-mapped
+        by load()), the others are allocated here."""
+        self.capacity = capacity
+        names = ["indices"] if self.order == 0 else ["indices", "dx", "dy"]
+        dtypes = {"indices": np.int32, "dx": np.float32, "dy": np.float32}
+        self.mapped = mapped if mapped is not None else {}
+        self.nb_mapped = len(mapped["indices"]) if mapped is not None else 0
+        # name -> entries of the slots from nb_mapped on
+        self.entries = dict((name, np.empty((capacity - self.nb_mapped, self.nb_pixels),
+                                            dtype=dtypes[name]))
+                            for name in names)
+        # matrix key -> slot, least recently used first
+        self.slots = collections.OrderedDict()
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def _set(self, name, slot, values):
+        if slot < self.nb_mapped:
+            self.mapped[name][slot] = values
+        else:
+            self.entries[name][slot - self.nb_mapped] = values
+
+    def _take(self, name, slot_ids, out=None):
+        """Gathers the entries of name at slot_ids (into out if given)."""
+        # the slots are valid, mode "clip" does not buffer out like the
+        # default "raise" does
+        is_mapped = slot_ids < self.nb_mapped
+        if is_mapped.all():
+            return np.take(self.mapped[name], slot_ids, axis=0, mode="clip", out=out)
+        if not is_mapped.any():
+            return np.take(self.entries[name], slot_ids - self.nb_mapped, axis=0,
+                           mode="clip", out=out)
+        if out is None:
+            out = np.empty((len(slot_ids), self.nb_pixels), dtype=self.entries[name].dtype)
+        out[is_mapped] = self.mapped[name][slot_ids[is_mapped]]
+        out[~is_mapped] = self.entries[name][slot_ids[~is_mapped] - self.nb_mapped]
+        return out
+
+    def sampling(self, matrices, scratch=False):
+        """Returns the sampling of matrices, computing the missing entries.
+
+        Args:
+            matrices: N matrices, see warp.as_matrix_array().
+            scratch: Whether to gather the sampling into buffers that are
+                reused by the next call, see warp.compute_sampling().
+
+        Returns:
+            warp.Sampling of the N matrices, as by warp.compute_sampling().
+        """
+        matrices = warp.as_matrix_array(matrices).astype(np.float32)
+        slot_ids = self._lookup(matrices)
+        if slot_ids is None:
+            # more distinct matrices than entries, nothing can be reused
+            return warp.compute_sampling(matrices, self.input_shape, self.output_shape,
+                                         order=self.order, mode=self.mode,
+                                         scratch=scratch)
+        def gather(name):
+            if name not in self.entries:
+                return None
+            out = None
+            if scratch:
+                out = warp.scratch_array("SamplingCache." + name, (len(slot_ids), self.nb_pixels),
+                                         self.entries[name].dtype)
+            return self._take(name, slot_ids, out)
+        return warp.Sampling(gather("indices"), gather("dx"), gather("dy"), self.padding,
+                             self.input_shape, self.output_shape, self.mode)
+
+    def warm(self, matrices):
+        """Computes the samplings of matrices (up to the capacity) ahead of
+        their use, without counting hits or misses.
+
+        Returns:
+            Number of samplings that were not cached yet.
+        """
+        matrices = warp.as_matrix_array(matrices).astype(np.float32)[:self.capacity]
+        stats = dict(self.stats)
+        self._lookup(matrices)
+        computed = self.stats["misses"] - stats["misses"]
+        self.stats = stats
+        return computed
+
+    def _lookup(self, matrices):
+        """Returns the slots of the matrices (computing missing entries), or
+        None if there are more distinct matrices than entries."""
+        keys = [matrix.tobytes() for matrix in matrices]
+        # first position of each missing matrix, in order
+        missing = collections.OrderedDict()
+        for i, key in enumerate(keys):
+            if key in self.slots:
+                # most recently used, so it is not evicted by the misses below
+                self.slots.move_to_end(key)
+            elif key not in missing:
+                missing[key] = i
+        if len(set(keys)) > self.capacity:
+            self.stats["misses"] += len(keys)
+            return None
+        self.stats["misses"] += sum(1 for key in keys if key in missing)
+        self.stats["hits"] += sum(1 for key in keys if key not in missing)
+
+        missing_keys = list(missing.keys())
+        for start in range(0, len(missing_keys), COMPUTE_BATCH):
+            batch_keys = missing_keys[start:start + COMPUTE_BATCH]
+            computed = warp.compute_sampling(matrices[[missing[key] for key in batch_keys]],
+                                             self.input_shape, self.output_shape,
+                                             order=self.order, mode=self.mode)
+            assert computed.padding == self.padding
+            for j, key in enumerate(batch_keys):
+                slot = self._free_slot()
+                for name in self.entries:
+                    self._set(name, slot, getattr(computed, name)[j])
+                self.slots[key] = slot
+
+        return np.array([self.slots[key] for key in keys], dtype=np.int64)
+
+    def _free_slot(self):
+        if len(self.free) > 0:
+            return self.free.pop()
+        _, slot = self.slots.popitem(last=False)
+        self.stats["evictions"] += 1
+        return slot
+
+    def get_stats(self):
+        """Returns a dict with the hits, misses, evictions and hit_rate
+        (hits per lookup, 0.0 before the first one), as well as the number
+        of cached entries and the bytes they use (nbytes)."""
+        stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups > 0 else 0.0
+        stats["entries"] = len(self.slots)
+        stats["nbytes"] = len(self.slots) * self.entry_bytes
+        return stats
+
+    def save(self, fp_dir):
+        """Saves the cached entries to fp_dir (created if missing) as .npy
+        files and a meta.json describing them.
+
+        The files are written to a new directory that then replaces fp_dir,
+        so caches that memory-mapped the previous files (possibly this one,
+        see load()) keep reading them unchanged."""
+        fp_dir = os.path.abspath(fp_dir)
+        parent = os.path.dirname(fp_dir)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp_", dir=parent)
+        try:
+            self._write(tmp_dir)
+            old_dir = None
+            if os.path.exists(fp_dir):
+                old_dir = tempfile.mkdtemp(prefix=".old_", dir=parent)
+                os.rmdir(old_dir)
+                os.rename(fp_dir, old_dir)
+            os.rename(tmp_dir, fp_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        if old_dir is not None:
+            # mapped files stay readable after they are unlinked
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+    def _write(self, fp_dir):
+        keys = list(self.slots.keys())
+        slot_ids = np.array([self.slots[key] for key in keys], dtype=np.int64)
+        matrices = np.frombuffer(b"".join(keys), dtype=np.float32).reshape(-1, 3, 3)
+        np.save(os.path.join(fp_dir, "matrices.npy"), matrices)
+        for name in self.entries:
+            np.save(os.path.join(fp_dir, name + ".npy"), self._take(name, slot_ids))
+        meta = {"version": CACHE_VERSION, "input_shape": list(self.input_shape),
+                "output_shape": list(self.output_shape), "order": self.order,
+                "mode": self.mode, "entries": len(keys)}
+        # written last, a directory without it is not loaded
+        with open(os.path.join(fp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    def load(self, fp_dir, mmap=True):
+        """Replaces the cached entries with the ones saved in fp_dir.
+
+        Args:
+            fp_dir: Directory written by save().
+            mmap: Whether to memory-map the saved entries (copy-on-write, the
+                files are never modified) instead of reading them. Either way,
+                the cache keeps its capacity (max_bytes): up to that many
+                saved entries are loaded, misses are stored besides them
+                and once it is full evict the least recently used ones.
+
+        Returns:
+            Whether the saved entries matched this cache (shapes, order and
+            mode) and were loaded.
+        """
+        meta_fp = os.path.join(fp_dir, "meta.json")
+        if not os.path.isfile(meta_fp):
+            return False
+        with open(meta_fp, "r") as f:
+            meta = json.load(f)
+        if meta.get("version") != CACHE_VERSION \
+                or tuple(meta["input_shape"]) != self.input_shape \
+                or tuple(meta["output_shape"]) != self.output_shape \
+                or meta["order"] != self.order or meta["mode"] != self.mode \
+                or meta["entries"] == 0:
+            return False
+
+        matrices = np.load(os.path.join(fp_dir, "matrices.npy"))
+        nb_entries = min(len(matrices), self.capacity)
+        names = ["indices"] if self.order == 0 else ["indices", "dx", "dy"]
+        saved = dict((name, np.load(os.path.join(fp_dir, name + ".npy"),
+                                    mmap_mode="c" if mmap else None)[:nb_entries])
+                     for name in names)
+        if mmap:
+            self._allocate(self.capacity, saved)
+        else:
+            self._allocate(self.capacity)
+            for name in names:
+                self.entries[name][:nb_entries] = saved[name]
+        for slot in range(nb_entries):
+            self.slots[matrices[slot].tobytes()] = slot
+        self.free = list(range(self.capacity - 1, nb_entries - 1, -1))
+        return True
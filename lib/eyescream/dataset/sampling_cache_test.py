@@ -0,0 +1,117 @@
+import unittest
+import shutil
+import tempfile
+import numpy as np
+from lib.eyescream.dataset import warp
+from lib.eyescream.dataset.ImageAugmenter import create_aug_matrices
+from lib.eyescream.dataset.sampling_cache import SamplingCache
+
+class TestSamplingCache(unittest.TestCase):
+    def setUp(self):
+        self.matrices = create_aug_matrices(6, 20, 16, scale_to_percent=1.2, rotation_deg=20,
+                                            translation_x_px=3, seed=1)
+        self.images = np.random.RandomState(0).randint(0, 256, (6, 16, 20, 3)).astype(np.uint8)
+        self.fp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fp_dir)
+
+    def assert_same_sampling(self, cache, matrices):
+        sampling = cache.sampling(matrices)
+        expected = warp.compute_sampling(matrices, (16, 20))
+        for name in ["indices", "dx", "dy"]:
+            self.assertTrue(np.array_equal(getattr(expected, name), getattr(sampling, name)))
+        self.assertEqual(expected.padding, sampling.padding)
+        images = self.images[:len(matrices)]
+        self.assertTrue(np.array_equal(warp.apply_sampling(images, expected),
+                                       warp.apply_sampling(images, sampling)))
+
+    def test_hits(self):
+        cache = SamplingCache((16, 20))
+        self.assert_same_sampling(cache, self.matrices)
+        self.assert_same_sampling(cache, self.matrices[::-1])
+        stats = cache.get_stats()
+        self.assertEqual(6, stats["misses"])
+        self.assertEqual(6, stats["hits"])
+        self.assertEqual(0.5, stats["hit_rate"])
+        self.assertEqual(6, stats["entries"])
+        self.assertEqual(6 * 16 * 20 * 12, stats["nbytes"])
+
+    def test_eviction(self):
+        cache = SamplingCache((16, 20), max_bytes=3 * 16 * 20 * 12)
+        self.assertEqual(3, cache.capacity)
+        self.assert_same_sampling(cache, self.matrices[:3])
+        self.assert_same_sampling(cache, self.matrices[[0, 3]])
+        # 1 was the least recently used one
+        self.assertEqual(1, cache.get_stats()["evictions"])
+        self.assert_same_sampling(cache, self.matrices[[0, 2, 3]])
+        self.assertEqual(4, cache.get_stats()["hits"])
+        # more matrices than entries are computed without the cache
+        self.assert_same_sampling(cache, self.matrices)
+        self.assertEqual(3, cache.get_stats()["entries"])
+
+    def test_save_load(self):
+        cache = SamplingCache((16, 20), order=0)
+        cache.warm(self.matrices)
+        self.assertEqual(0, cache.get_stats()["misses"])
+        cache.save(self.fp_dir)
+
+        for mmap in [True, False]:
+            loaded = SamplingCache((16, 20), order=0)
+            self.assertTrue(loaded.load(self.fp_dir, mmap=mmap))
+            sampling = loaded.sampling(self.matrices)
+            self.assertEqual(1.0, loaded.get_stats()["hit_rate"])
+            self.assertTrue(np.array_equal(warp.compute_sampling(self.matrices, (16, 20), order=0).indices,
+                                           sampling.indices))
+            # misses evict entries of the memory-mapped cache, not of the files
+            loaded.sampling(create_aug_matrices(2, 20, 16, rotation_deg=5, seed=2))
+        self.assertFalse(SamplingCache((16, 20), order=1).load(self.fp_dir))
+
+    def test_save_mapped(self):
+        cache = SamplingCache((16, 20))
+        cache.warm(self.matrices[:3])
+        cache.save(self.fp_dir)
+
+        # saved over the files it maps, with the new entries stored besides
+        # the mapped ones
+        loaded = SamplingCache((16, 20))
+        self.assertTrue(loaded.load(self.fp_dir))
+        self.assertEqual(3, loaded.warm(self.matrices))
+        loaded.save(self.fp_dir)
+        self.assert_same_sampling(loaded, self.matrices)
+        reloaded = SamplingCache((16, 20))
+        self.assertTrue(reloaded.load(self.fp_dir))
+        self.assertEqual(0, reloaded.warm(self.matrices))
+        self.assert_same_sampling(reloaded, self.matrices)
+
+        # the capacity still bounds the mapped entries
+        small = SamplingCache((16, 20), max_bytes=2 * 16 * 20 * 12)
+        self.assertTrue(small.load(self.fp_dir))
+        self.assertEqual(2, small.get_stats()["entries"])
+        self.assert_same_sampling(small, self.matrices[3:5])
+
+    def test_load_capacity(self):
+        cache = SamplingCache((16, 20))
+        cache.warm(self.matrices[:4])
+        cache.save(self.fp_dir)
+
+        # loading keeps the capacity of max_bytes, misses are cached besides
+        # the saved entries until it is used up, then evict the oldest ones
+        for mmap in [True, False]:
+            loaded = SamplingCache((16, 20), max_bytes=7 * 16 * 20 * 12)
+            self.assertTrue(loaded.load(self.fp_dir, mmap=mmap))
+            self.assertEqual(7, loaded.capacity)
+            matrices = create_aug_matrices(3, 20, 16, rotation_deg=5, seed=2)
+            self.assert_same_sampling(loaded, matrices)
+            self.assert_same_sampling(loaded, np.concatenate([matrices, self.matrices[:3]]))
+            stats = loaded.get_stats()
+            self.assertEqual((3, 6, 7), (stats["misses"], stats["hits"], stats["entries"]))
+
+            # evicts the saved entry 3 and the first new one
+            self.assert_same_sampling(loaded, self.matrices[4:])
+            self.assertEqual(2, loaded.get_stats()["evictions"])
+            self.assert_same_sampling(loaded, np.concatenate([matrices[1:], self.matrices[:3]]))
+            self.assertEqual(6 + 5, loaded.get_stats()["hits"])
+
+if __name__ == '__main__':
+    unittest.main()
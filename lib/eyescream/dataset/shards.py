@@ -0,0 +1,182 @@
+"""
+Packed dataset shards: many equally sized uint8 images in one file, which can
+be memory-mapped (numpy.memmap here, torch.ByteStorage in dataset.lua) instead
+of listing, reading and decoding one jpg per image.
+
+Layout of a shard (all integers little endian):
+    0   8 bytes     magic "EYESHRD1"
+    8   uint32      format version (1)
+    12  uint32      number of images N
+    16  uint32      height H
+    20  uint32      width W
+    24  uint32      channels C
+    28  uint64      offset of the pixel data (64)
+    36  uint64      offset of the index
+    44  uint32      bytes per index entry (NAME_BYTES)
+    48  16 bytes    reserved (zero)
+    64  N*H*W*C     pixels, uint8, shape (N, H, W, C), C-contiguous
+    ..  N*NAME_BYTES  index: one zero-padded ascii name per image
+                    (e.g. "000012_005", the name of the jpg it replaces)
+
+Example usage:
+        with ShardWriter("/tmp/aug", images_per_shard=1000) as writer:
+            for name, face in faces:
+                writer.add(face, name)
+        images, names = read_shard("/tmp/aug/shard_000000.shard")
+"""
+from __future__ import print_function, division
+import os
+import struct
+import numpy as np
+
+MAGIC = b"EYESHRD1"
+VERSION = 1
+EXTENSION = "shard"
+HEADER_FORMAT = "<8sIIIIIQQI16x"
+HEADER_BYTES = 64
+NAME_BYTES = 32
+
+assert struct.calcsize(HEADER_FORMAT) == HEADER_BYTES
+
+def write_shard(fp, images, names=None):
+    """Writes images to a shard file.
+    Args:
+        fp          Path of the shard.
+        images      Numpy array of shape (N, H, W, C) or (N, H, W), uint8,
+                    or a list of such images.
+        names       Optional list of N names (ascii, at most NAME_BYTES).
+    Returns:
+        Number of bytes written.
+    """
+    images = np.ascontiguousarray(images, dtype=np.uint8)
+    if images.ndim == 3:
+        images = images[..., np.newaxis]
+    assert images.ndim == 4, "Expected images of shape (N, H, W, C)."
+    nb_images, height, width, channels = images.shape
+    if names is None:
+        names = [""] * nb_images
+    assert len(names) == nb_images
+
+    index = np.zeros((nb_images,), dtype="S%d" % (NAME_BYTES,))
+    for i, name in enumerate(names):
+        encoded = name.encode("ascii")
+        assert len(encoded) <= NAME_BYTES, "Name '%s' is too long." % (name,)
+        index[i] = encoded
+
+    index_offset = HEADER_BYTES + images.nbytes
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, nb_images, height, width,
+                         channels, HEADER_BYTES, index_offset, NAME_BYTES)
+    # written to a temporary file first, so that readers never see half a shard
+    tmp_fp = fp + ".tmp"
+    with open(tmp_fp, "wb") as f:
+        f.write(header)
+        f.write(images.data)
+        f.write(index.tobytes())
+    os.rename(tmp_fp, fp)
+    return index_offset + index.nbytes
+
+def read_header(fp):
+    """Reads the header of a shard.
+    Returns:
+        Dict with the keys count, height, width, channels, data_offset,
+        index_offset and name_bytes.
+    """
+    with open(fp, "rb") as f:
+        header = f.read(HEADER_BYTES)
+    assert len(header) == HEADER_BYTES, "'%s' is not a shard." % (fp,)
+    magic, version, count, height, width, channels, data_offset, index_offset, \
+        name_bytes = struct.unpack(HEADER_FORMAT, header)
+    assert magic == MAGIC, "'%s' is not a shard." % (fp,)
+    assert version == VERSION, "Unsupported shard version %d." % (version,)
+    return {"count": count, "height": height, "width": width, "channels": channels,
+            "data_offset": data_offset, "index_offset": index_offset,
+            "name_bytes": name_bytes}
+
+def read_shard(fp, mmap=True):
+    """Reads the images and names of a shard.
+    Args:
+        fp          Path of the shard.
+        mmap        Whether to memory-map the images (read-only) instead of
+                    reading them into memory.
+    Returns:
+        Tuple (images, names) with images as numpy array of shape
+        (N, H, W, C), uint8, and names as list of strings.
+    """
+    header = read_header(fp)
+    shape = (header["count"], header["height"], header["width"], header["channels"])
+    if mmap and header["count"] > 0:
+        images = np.memmap(fp, dtype=np.uint8, mode="r", offset=header["data_offset"],
+                           shape=shape)
+    else:
+        with open(fp, "rb") as f:
+            f.seek(header["data_offset"])
+            images = np.fromfile(f, dtype=np.uint8, count=int(np.prod(shape))).reshape(shape)
+
+    with open(fp, "rb") as f:
+        f.seek(header["index_offset"])
+        index = np.fromfile(f, dtype="S%d" % (header["name_bytes"],), count=header["count"])
+    names = [name.decode("ascii") for name in index]
+    return images, names
+
+def shard_filepaths(fp_dir):
+    """Returns the sorted paths of the shards in a directory."""
+    names = [name for name in os.listdir(fp_dir) if name.endswith("." + EXTENSION)]
+    return [os.path.join(fp_dir, name) for name in sorted(names)]
+
+class ShardWriter(object):
+    """Collects images and writes them to shard_<number>.shard files of
+    images_per_shard images each (the last one may be smaller). Shards are
+    numbered from 0 on each run, close() removes the higher numbered ones
+    left over from earlier runs."""
+    def __init__(self, fp_dir, images_per_shard, stats=None):
+        """Instantiate a shard writer.
+        Args:
+            fp_dir              Directory to write the shards to.
+            images_per_shard    Number of images per shard.
+            stats               Optional dict, files_written and bytes_written
+                                are counted in it (like in generate_dataset).
+        """
+        assert images_per_shard > 0
+        self.fp_dir = fp_dir
+        self.images_per_shard = images_per_shard
+        self.stats = stats
+        self.images = []
+        self.names = []
+        self.nb_shards = 0
+
+    def add(self, image, name=""):
+        """Adds an image, writes a shard if enough images were collected."""
+        self.images.append(image)
+        self.names.append(name)
+        if len(self.images) >= self.images_per_shard:
+            self.flush()
+
+    def flush(self):
+        """Writes the collected images (if any) to a shard."""
+        if len(self.images) == 0:
+            return
+        fp = os.path.join(self.fp_dir, "shard_{:0>6}.{}".format(self.nb_shards, EXTENSION))
+        nb_bytes = write_shard(fp, self.images, self.names)
+        if self.stats is not None:
+            self.stats["files_written"] = self.stats.get("files_written", 0) + 1
+            self.stats["bytes_written"] = self.stats.get("bytes_written", 0) + nb_bytes
+        self.nb_shards += 1
+        self.images = []
+        self.names = []
+
+    def close(self):
+        """Writes the collected images and removes the shards in fp_dir that
+        were not written by this writer (e.g. by an earlier run with more
+        images), so that shard_filepaths() only finds the current ones."""
+        self.flush()
+        written = set("shard_{:0>6}.{}".format(i, EXTENSION) for i in range(self.nb_shards))
+        for fp in shard_filepaths(self.fp_dir):
+            if os.path.basename(fp) not in written:
+                os.remove(fp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
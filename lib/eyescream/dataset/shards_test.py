@@ -0,0 +1,58 @@
+import unittest
+import os
+import shutil
+import struct
+import tempfile
+import numpy as np
+from lib.eyescream.dataset import shards
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.images = np.random.RandomState(0).randint(0, 256, (5, 64, 64, 3)).astype(np.uint8)
+        self.names = ["000000_%03d" % i for i in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        fp = os.path.join(self.dir, "a.shard")
+        nb_bytes = shards.write_shard(fp, self.images, self.names)
+        self.assertEqual(os.path.getsize(fp), nb_bytes)
+        for mmap in [True, False]:
+            images, names = shards.read_shard(fp, mmap=mmap)
+            self.assertTrue(np.array_equal(self.images, images))
+            self.assertEqual(self.names, names)
+
+    def test_layout(self):
+        # the offsets dataset.lua reads the header from
+        fp = os.path.join(self.dir, "a.shard")
+        shards.write_shard(fp, self.images[..., 0])
+        with open(fp, "rb") as f:
+            data = f.read()
+        self.assertEqual(b"EYESHRD1", data[0:8])
+        self.assertEqual((1, 5, 64, 64, 1), struct.unpack("<IIIII", data[8:28]))
+        self.assertEqual(64, struct.unpack("<Q", data[28:36])[0])
+        self.assertEqual(self.images[0, 0, 0, 0], ord(data[64:65]))
+
+    def test_writer(self):
+        stats = {}
+        with shards.ShardWriter(self.dir, images_per_shard=2, stats=stats) as writer:
+            for image, name in zip(self.images, self.names):
+                writer.add(image, name)
+        fps = shards.shard_filepaths(self.dir)
+        self.assertEqual(3, len(fps))
+        self.assertEqual(3, stats["files_written"])
+        images = np.concatenate([shards.read_shard(fp)[0] for fp in fps])
+        self.assertTrue(np.array_equal(self.images, images))
+
+        # a shorter run removes the shards of the longer one
+        with shards.ShardWriter(self.dir, images_per_shard=2) as writer:
+            for image, name in zip(self.images[:2], self.names):
+                writer.add(image, name)
+        fps = shards.shard_filepaths(self.dir)
+        self.assertEqual(1, len(fps))
+        self.assertTrue(np.array_equal(self.images[:2], shards.read_shard(fps[0])[0]))
+
+if __name__ == '__main__':
+    unittest.main()
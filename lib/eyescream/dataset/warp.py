@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+"""Vectorized affine warping of image batches.
+
+scikit-image's transform.warp() handles one image (and, for multi-channel
+images, one channel) per call, converts it to float64 and recomputes the
+sampling coordinates every time. The functions in this module instead compute
+the inverse-mapped coordinates of many matrices at once with numpy broadcasting
+and sample all images with a few gathers over the stacked array.
+
+Warping happens in two steps, which may also be used separately:
+    compute_sampling()  Maps every output pixel of every matrix to the index
+                        of its (top left) source pixel and the fractional
+                        offsets used for bilinear interpolation.
+    apply_sampling()    Gathers and interpolates the source pixels of a batch
+                        of images.
+
+Points outside of the images are handled by padding the images according to
+the mode (e.g. with cval for "constant") instead of checking every neighbour.
+For "constant" and "edge", coordinates are clamped to one pixel outside of the
+image, so a padding of 1-2 pixels is enough. For the other modes the padding
+covers all coordinates.
+
+Two interpolation backends are available (see BACKENDS): "float" gathers
+and interpolates in float32, "integer" keeps uint8 images in integers and
+returns uint8 images. For order 0 it gathers the uint8 pixels, which is
+exact. For order 1 it gathers each pixel and the one below it packed into a
+uint32, i.e. two gathers per output pixel instead of four, and interpolates
+both rows at once with fixed-point weights (see FIXED_POINT_BITS). The
+result is at most one intensity level off the rounded float result.
+
+Example usage:
+        images = ... # numpy array of shape (N, height, width, channels), uint8
+        matrices = create_aug_matrices(len(images), width, height, ...)
+        warped = warp_batch(images, matrices) # float32, values 0-255
+        warped = warp_batch(images, matrices, backend="integer") # uint8
+"""
+from __future__ import division
+from collections import namedtuple
+import threading
+import numpy as np
+
+MODES = ["constant", "edge", "symmetric", "reflect", "wrap"]
+
+# output pixels interpolated at once by apply_sampling()
+CHUNK_SIZE = 16384
+
+BACKENDS = ["float", "integer"]
+# Fractional bits of the bilinear weights of the "integer" backend (Q8). A
+# uint8 pixel interpolated along a row, at most 255 * 2**8, fits into the 16
+# bit halves of a uint32.
+FIXED_POINT_BITS = 8
+
+# indices:      Flat indices (y * padded width + x) of the source pixel of
+#               each output pixel within its padded image, shape (N, output
+#               pixels). For order 1 this is the top left of the four
+#               neighbours.
+# dx, dy:       Fractional offsets to the top left neighbour, float32, same
+#               shape. None for order 0.
+# padding:      ((top, bottom), (left, right)) padding of the input images.
+# input_shape:  (height, width) of the input images.
+# output_shape: (height, width) of the warped images.
+# mode:         One of MODES.
+Sampling = namedtuple("Sampling", ["indices", "dx", "dy", "padding",
+                                   "input_shape", "output_shape", "mode"])
+
+# per thread buffers of scratch_array(), by name
+_scratch = threading.local()
+
+def scratch_array(name, shape, dtype=np.float32):
+    """Returns an uninitialized array from a buffer that is reused across
+    calls with the same name in the same thread. The buffer is only
+    reallocated if it is too small, so hot loops do not allocate.
+
+    The array is overwritten by the next call with the same name, it must
+    not be returned to callers that keep it.
+
+    Args:
+        name: Name of the buffer, e.g. the function using it.
+        shape: Shape of the array.
+        dtype: Dtype of the array.
+
+    Returns:
+        Numpy array of the given shape and dtype, C-contiguous.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buffers = getattr(_scratch, "buffers", None)
+    if buffers is None:
+        buffers = _scratch.buffers = {}
+    buf = buffers.get(name)
+    if buf is None or buf.nbytes < nbytes:
+        buf = buffers[name] = np.empty((nbytes,), dtype=np.uint8)
+    return buf[:nbytes].view(dtype).reshape(shape)
+
+def release_scratch():
+    """Frees the buffers of scratch_array() of the calling thread, e.g. after
+    a large batch. They only grow otherwise, and are kept until the thread
+    exits. Arrays returned before stay valid, later calls allocate again."""
+    _scratch.buffers = {}
+
+def index_dtype_for(nb_elements):
+    """Returns the smallest of int32 and int64 that can index nb_elements
+    (plus the neighbours of bilinear interpolation, which stay within them)."""
+    return np.dtype(np.int32 if nb_elements < 2**31 else np.int64)
+
+def as_matrix_array(matrices):
+    """Converts augmentation matrices to one array of 3x3 matrices.
+
+    Args:
+        matrices: Either a numpy array of shape (N, 3, 3) or (3, 3) or a list
+            of 3x3 arrays or scikit-image transforms (or their inverse, as
+            produced by create_aug_matrices()). Each matrix maps coordinates
+            (x, y) of the output image to coordinates in the input image.
+
+    Returns:
+        Numpy array of shape (N, 3, 3), dtype float64.
+    """
+    if isinstance(matrices, np.ndarray):
+        return np.asarray(matrices, dtype=np.float64).reshape(-1, 3, 3)
+
+    result = np.zeros((len(matrices), 3, 3), dtype=np.float64)
+    for i, matrix in enumerate(matrices):
+        if hasattr(matrix, "params"):
+            result[i] = matrix.params
+        elif hasattr(matrix, "__self__") and hasattr(matrix.__self__, "params"):
+            # bound method "inverse" of a transform (older scikit-image)
+            result[i] = np.linalg.inv(matrix.__self__.params)
+        else:
+            result[i] = matrix
+    return result
+
+def compute_coordinates(matrices, output_shape, out=None):
+    """Maps every output pixel to its (x, y) coordinates in the input image.
+
+    Args:
+        matrices: Augmentation matrices, see as_matrix_array().
+        output_shape: (height, width) of the warped images.
+        out: Optional tuple (x, y) of float32 arrays of shape
+            (N, height, width) to write the coordinates to.
+
+    Returns:
+        Tuple (x, y) of float32 arrays of shape (N, height, width), out if
+        given.
+    """
+    matrices = as_matrix_array(matrices).astype(np.float32)
+    height, width = output_shape[0], output_shape[1]
+    ys = np.arange(height, dtype=np.float32).reshape(1, height, 1)
+    xs = np.arange(width, dtype=np.float32).reshape(1, 1, width)
+    m = matrices[:, :, :, np.newaxis, np.newaxis]
+
+    # affine matrices are separable: the x and y parts are broadcast
+    # against each other instead of multiplying full (N, height, width) grids
+    if out is None:
+        shape = (matrices.shape[0], height, width)
+        out = (np.empty(shape, dtype=np.float32), np.empty(shape, dtype=np.float32))
+    src_x, src_y = out
+    np.add(m[:, 0, 0] * xs, m[:, 0, 1] * ys + m[:, 0, 2], out=src_x)
+    np.add(m[:, 1, 0] * xs, m[:, 1, 1] * ys + m[:, 1, 2], out=src_y)
+    if not np.allclose(matrices[:, 2], [0, 0, 1]):
+        z = m[:, 2, 0] * xs + (m[:, 2, 1] * ys + m[:, 2, 2])
+        src_x /= z
+        src_y /= z
+    return src_x, src_y
+
+def compute_sampling(matrices, input_shape, output_shape=None, order=1,
+                     mode="constant", scratch=False):
+    """Computes where each output pixel of each matrix is sampled from.
+
+    Args:
+        matrices: Augmentation matrices, see as_matrix_array().
+        input_shape: (height, width) of the images that will be warped.
+        output_shape: (height, width) of the warped images. Default is None
+            (same as input_shape).
+        order: Interpolation order, 0 (nearest neighbour) or 1 (bilinear).
+        mode: How to handle points outside of the image, one of MODES.
+            Same semantics as in scikit-image's warp().
+        scratch: Whether to compute the sampling in buffers that are reused
+            by the next call (see scratch_array()), for samplings that are
+            applied right away. Default is False (new arrays).
+
+    Returns:
+        Sampling.
+    """
+    assert order in [0, 1], "Only interpolation orders 0 and 1 are supported."
+    assert mode in MODES, "Unknown mode '%s'." % (mode,)
+    height, width = input_shape[0], input_shape[1]
+    if output_shape is None:
+        output_shape = input_shape
+    output_shape = (output_shape[0], output_shape[1])
+
+    matrices = as_matrix_array(matrices)
+    coords = None
+    if scratch:
+        shape = (matrices.shape[0],) + output_shape
+        coords = (scratch_array("compute_sampling.x", shape),
+                  scratch_array("compute_sampling.y", shape))
+    src_x, src_y = compute_coordinates(matrices, output_shape, out=coords)
+    nb_matrices = src_x.shape[0]
+    src_x = src_x.reshape(nb_matrices, -1)
+    src_y = src_y.reshape(nb_matrices, -1)
+
+    if mode in ["constant", "edge"]:
+        # One pixel outside of the image is enough to produce cval (or the
+        # edge pixel) for every point further away. The bottom/right padding
+        # is 2 pixels, as the neighbour of a point at x=width is x=width+1.
+        for coords, limit in [(src_x, width), (src_y, height)]:
+            np.maximum(coords, -1, out=coords)
+            np.minimum(coords, limit, out=coords)
+
+    if order == 0:
+        # nearest neighbour: round instead of floor
+        src_x += 0.5
+        src_y += 0.5
+
+    if mode in ["constant", "edge"]:
+        padding = ((1, 2), (1, 2))
+    else:
+        min_row, max_row = int(np.floor(src_y.min())), int(np.floor(src_y.max()))
+        min_col, max_col = int(np.floor(src_x.min())), int(np.floor(src_x.max()))
+        padding = ((max(0, -min_row), max(0, max_row + 2 - height)),
+                   (max(0, -min_col), max(0, max_col + 2 - width)))
+
+    # Shifted into the padded image, all coordinates are positive, so
+    # truncating to integers is the same as flooring them.
+    src_x += padding[1][0]
+    src_y += padding[0][0]
+    padded_width = width + padding[1][0] + padding[1][1]
+    padded_height = height + padding[0][0] + padding[0][1]
+    index_dtype = index_dtype_for(padded_height * padded_width)
+    if scratch:
+        col0 = scratch_array("compute_sampling.col0", src_x.shape, index_dtype)
+        row0 = scratch_array("compute_sampling.row0", src_y.shape, index_dtype)
+    else:
+        col0 = np.empty(src_x.shape, dtype=index_dtype)
+        row0 = np.empty(src_y.shape, dtype=index_dtype)
+    np.copyto(col0, src_x, casting="unsafe")
+    np.copyto(row0, src_y, casting="unsafe")
+    if order == 0:
+        dx, dy = None, None
+    else:
+        # in place and in float32, float32 minus int32 would be promoted to
+        # a float64 temporary
+        dx = np.subtract(src_x, col0, out=src_x, casting="unsafe", dtype=np.float32)
+        dy = np.subtract(src_y, row0, out=src_y, casting="unsafe", dtype=np.float32)
+    # in place, the sampling of a batch is the largest allocation of a warp
+    indices = np.multiply(row0, padded_width, out=row0)
+    indices += col0
+
+    return Sampling(indices, dx, dy, padding, (height, width), output_shape,
+                    mode)
+
+def pad_images(images, sampling, cval=0.0):
+    """Pads images as required by the sampling.
+
+    Args:
+        images: Numpy array of shape (M, height, width[, channels]).
+        sampling: Sampling from compute_sampling().
+        cval: Value of the padding for mode "constant".
+
+    Returns:
+        Numpy array of shape (M, padded height, padded width[, channels]).
+        Integer images are converted to float32 if cval is not an integer.
+    """
+    pad_width = [(0, 0), sampling.padding[0], sampling.padding[1]]
+    pad_width += [(0, 0)] * (images.ndim - 3)
+    if sampling.mode == "constant":
+        if np.issubdtype(images.dtype, np.integer) and cval != int(cval):
+            images = images.astype(np.float32)
+        return np.pad(images, pad_width, mode="constant", constant_values=cval)
+    return np.pad(images, pad_width, mode=sampling.mode)
+
+def apply_sampling(images, sampling, image_indices=None, cval=0.0, out=None,
+                   channel_first=False, backend="float"):
+    """Warps a batch of images according to a precomputed sampling.
+
+    Args:
+        images: Numpy array of shape (M, height, width) or
+            (M, height, width, channels), or (M, channels, height, width)
+            with channel_first, any dtype.
+        sampling: Sampling from compute_sampling() with N matrices.
+        image_indices: Index of the image in images to warp with each of
+            the N matrices. Default is None (matrix i warps image i).
+        cval: Value of the pixels outside of the image for mode "constant",
+            in the units of images (e.g. 0-255 for uint8).
+        out: Optional float32 array of the shape of the result to write
+            it to. Default is None (a new array).
+        channel_first: Whether the channels are the second axis of images
+            (and of the result). All channels of an image are warped with
+            the same sampling. Default is False.
+        backend: One of BACKENDS. "integer" requires uint8 images, rounds
+            cval to an integer and returns uint8 images. Default is "float".
+
+    Returns:
+        Numpy array of shape (N, output height, output width[, channels]),
+        or (N, channels, output height, output width) with channel_first,
+        dtype float32 (uint8 for the "integer" backend), in the units of
+        images. out if given.
+    """
+    assert backend in BACKENDS, "Unknown backend '%s'." % (backend,)
+    integer = backend == "integer"
+    if integer:
+        assert images.dtype == np.uint8, "The integer backend requires uint8 images."
+        cval = min(max(int(round(cval)), 0), 255)
+    nb_outputs = sampling.indices.shape[0]
+    if channel_first:
+        assert images.ndim == 4, "Expected images of shape (M, channels, height, width)."
+        # A channel-last view: the planes are copied from it plane by plane
+        # (see _padded_planes()), so channel-first images are not
+        # transposed in memory.
+        images = np.moveaxis(images, 1, 3)
+    assert images.shape[1:3] == tuple(sampling.input_shape), \
+        "Images of shape %s do not match the sampling's input shape %s." % (
+            str(images.shape), str(sampling.input_shape))
+    shape = (nb_outputs,) + tuple(sampling.output_shape) + tuple(images.shape[3:])
+    if channel_first:
+        shape = (nb_outputs, images.shape[3]) + tuple(sampling.output_shape)
+    dtype = np.dtype(np.uint8 if integer else np.float32)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    assert out.shape == shape and out.dtype == dtype and out.flags.c_contiguous, \
+        "out must be a C-contiguous %s array of shape %s." % (dtype.name, str(shape))
+
+    planes = _padded_planes(images, sampling, cval, dtype if integer else np.float32)
+    nb_channels, padded_height, padded_width = planes.shape[0], planes.shape[2], planes.shape[3]
+    image_size = padded_height * padded_width
+    planes = planes.reshape(nb_channels, -1)
+
+    indices = sampling.indices
+    if image_indices is None:
+        assert images.shape[0] == nb_outputs
+        image_indices = np.arange(nb_outputs)
+    image_indices = np.asarray(image_indices)
+    if images.shape[0] > 1 or np.any(image_indices != 0):
+        # indices into the planes of all images, which may need more bits
+        # than the ones into a single image
+        index_dtype = np.promote_types(indices.dtype,
+                                       index_dtype_for(images.shape[0] * image_size))
+        offsets = image_indices.astype(index_dtype) * image_size
+        indices = np.add(indices, offsets[:, np.newaxis],
+                         out=scratch_array("apply_sampling.indices", indices.shape, index_dtype))
+    indices = indices.reshape(-1)
+    nb_pixels = indices.shape[0]
+    offsets = [0] if sampling.dx is None else [0, 1, padded_width, padded_width + 1]
+    dx = sampling.dx.reshape(-1) if sampling.dx is not None else None
+    dy = sampling.dy.reshape(-1) if sampling.dy is not None else None
+
+    result = scratch_array("apply_sampling.result", (nb_channels, nb_pixels), dtype)
+    if integer:
+        _interpolate_integer(planes, indices, offsets, dx, dy, result)
+    else:
+        _interpolate_float(planes, indices, offsets, dx, dy, result)
+
+    if channel_first:
+        np.copyto(out.reshape(nb_outputs, nb_channels, -1).transpose(1, 0, 2),
+                  result.reshape(nb_channels, nb_outputs, -1))
+    else:
+        # back to channel-last
+        np.copyto(out.reshape(nb_pixels, nb_channels).T, result)
+    return out
+
+def _interpolate_float(planes, indices, offsets, dx, dy, result):
+    """Gathers (and for order 1 interpolates) the pixels of apply_sampling()
+    from float32 planes into result, shape (channels, output pixels)."""
+    nb_pixels = indices.shape[0]
+    # Pixels are interpolated in chunks that fit into the cpu cache, the
+    # temporaries of a whole batch would make this memory bound.
+    scratch = scratch_array("apply_sampling.neighbours",
+                            (len(offsets), min(CHUNK_SIZE, nb_pixels)))
+    for start in range(0, nb_pixels, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, nb_pixels)
+        neighbours = scratch[:, :end - start]
+        neighbour_indices = [indices[start:end] + offset for offset in offsets]
+        for channel in range(len(planes)):
+            for neighbour, idx in zip(neighbours, neighbour_indices):
+                # in bounds of the padded planes, mode "clip" does not
+                # buffer out like the default "raise" does
+                np.take(planes[channel], idx, out=neighbour, mode="clip")
+            if dx is None:
+                result[channel, start:end] = neighbours[0]
+                continue
+            top_left, top_right, bottom_left, bottom_right = neighbours
+            top_right -= top_left
+            top_right *= dx[start:end]
+            top_left += top_right
+            bottom_right -= bottom_left
+            bottom_right *= dx[start:end]
+            bottom_left += bottom_right
+            bottom_left -= top_left
+            bottom_left *= dy[start:end]
+            np.add(top_left, bottom_left, out=result[channel, start:end])
+
+def _interpolate_integer(planes, indices, offsets, dx, dy, result):
+    """Gathers the pixels of apply_sampling() from uint8 planes (order 0), or
+    interpolates them with fixed-point weights (order 1), into result
+    (uint8), shape (channels, output pixels)."""
+    nb_pixels = indices.shape[0]
+    if dx is None:
+        # no temporaries, the whole batch is gathered at once
+        for channel in range(len(planes)):
+            np.take(planes[channel], indices, out=result[channel], mode="clip")
+        return
+
+    # Each pixel packed with the one below it into the 16 bit halves of a
+    # uint32, so that both rows are gathered and interpolated at once: the
+    # gathers, not the arithmetic, dominate.
+    below = offsets[2]
+    packed = scratch_array("apply_sampling.packed", planes.shape, np.uint32)
+    np.left_shift(planes[:, below:], 16, out=packed[:, :-below], dtype=np.uint32)
+    packed[:, :-below] |= planes[:, :-below]
+    np.copyto(packed[:, -below:], planes[:, -below:])
+
+    one = 1 << FIXED_POINT_BITS
+    chunk_size = min(CHUNK_SIZE, nb_pixels)
+    left, right = scratch_array("apply_sampling.rows", (2, chunk_size), np.uint32)
+    weights = scratch_array("apply_sampling.weights", (4, chunk_size), np.uint32)
+    fractions = scratch_array("apply_sampling.fractions", (chunk_size,))
+    right_indices = scratch_array("apply_sampling.right_indices", (chunk_size,), indices.dtype)
+    for start in range(0, nb_pixels, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, nb_pixels)
+        size = end - start
+        # weights rounded to multiples of 1 / one, and their complements
+        wx, wx_left, wy, wy_top = weights[:, :size]
+        for weight, complement, offset in [(wx, wx_left, dx), (wy, wy_top, dy)]:
+            fraction = fractions[:size]
+            np.multiply(offset[start:end], one, out=fraction)
+            np.rint(fraction, out=fraction)
+            np.copyto(weight, fraction, casting="unsafe")
+            np.subtract(one, weight, out=complement)
+        np.add(indices[start:end], offsets[1], out=right_indices[:size])
+        for channel in range(len(planes)):
+            top, bottom = left[:size], right[:size]
+            np.take(packed[channel], indices[start:end], out=top, mode="clip")
+            np.take(packed[channel], right_indices[:size], out=bottom, mode="clip")
+            # both rows at once, each half stays below 255 * one <= 2**16
+            top *= wx_left
+            bottom *= wx
+            top += bottom
+            np.right_shift(top, 16, out=bottom)
+            top &= 0xFFFF
+            # between the rows, rounded once
+            top *= wy_top
+            bottom *= wy
+            top += bottom
+            top += one * one // 2
+            top >>= 2 * FIXED_POINT_BITS
+            np.copyto(result[channel, start:end], top, casting="unsafe")
+
+def _padded_planes(images, sampling, cval, dtype=np.float32):
+    """Returns the padded images as one contiguous plane (of dtype) per
+    channel, shape (channels, M, padded height, padded width), in a buffer
+    reused across calls. numpy is much slower on arrays with a short
+    (channel) last axis."""
+    (top, bottom), (left, right) = sampling.padding
+    height, width = images.shape[1], images.shape[2]
+    nb_channels = images.shape[3] if images.ndim == 4 else 1
+    shape = (nb_channels, images.shape[0], height + top + bottom, width + left + right)
+    planes = scratch_array("apply_sampling.planes", shape, dtype)
+    as_planes = lambda arr: np.moveaxis(arr, 3, 0) if arr.ndim == 4 else arr[np.newaxis]
+    if sampling.mode != "constant":
+        np.copyto(planes, as_planes(pad_images(images, sampling)), casting="unsafe")
+        return planes
+    # only the border is filled with cval, the inside with the images
+    planes[:, :, :top] = cval
+    planes[:, :, top + height:] = cval
+    planes[:, :, top:top + height, :left] = cval
+    planes[:, :, top:top + height, left + width:] = cval
+    np.copyto(planes[:, :, top:top + height, left:left + width], as_planes(images),
+              casting="unsafe")
+    return planes
+
+def warp_batch(images, matrices, image_indices=None, output_shape=None, order=1,
+               mode="constant", cval=0.0, out=None, channel_first=False,
+               backend="float"):
+    """Warps a batch of images with affine (or projective) matrices.
+
+    The vectorized counterpart of calling scikit-image's transform.warp() on
+    each image, but without the conversion of the images to float 0-1.
+
+    Args:
+        images: Numpy array of shape (M, height, width) or
+            (M, height, width, channels), or (M, channels, height, width)
+            with channel_first.
+        matrices: N matrices, see as_matrix_array().
+        image_indices: Index of the image to warp with each matrix. Default is
+            None (matrix i warps image i, so N must be M).
+        output_shape: (height, width) of the warped images. Default is None
+            (same as the input images).
+        order: Interpolation order, 0 (nearest neighbour) or 1 (bilinear).
+        mode: How to handle points outside of the image, one of MODES.
+        cval: Fill value for mode "constant", in the units of images.
+        out: Optional float32 array to write the result to, see
+            apply_sampling().
+        channel_first: Whether the channels are the second axis, see
+            apply_sampling(). The sampling is computed once per matrix for
+            all channels.
+        backend: One of BACKENDS, see apply_sampling().
+
+    Returns:
+        Numpy array of the shape of the images (with output_shape) and N
+        images, dtype float32 (uint8 for the "integer" backend), in the
+        units of images. out if given.
+    """
+    # used once, so computed in reused buffers
+    input_shape = images.shape[2:4] if channel_first else images.shape[1:3]
+    sampling = compute_sampling(matrices, input_shape,
+                                output_shape=output_shape, order=order,
+                                mode=mode, scratch=True)
+    return apply_sampling(images, sampling, image_indices=image_indices,
+                          cval=cval, out=out, channel_first=channel_first,
+                          backend=backend)
@@ -0,0 +1,125 @@
+import unittest
+import numpy as np
+from skimage import transform as tf
+from lib.eyescream.dataset import warp
+
+class TestWarp(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.images = rng.randint(0, 256, (6, 40, 50, 3)).astype(np.uint8)
+        self.matrices = [tf.AffineTransform(scale=(rng.uniform(0.5, 1.5),) * 2,
+                                            rotation=rng.uniform(-0.5, 0.5),
+                                            translation=(rng.uniform(-15, 15), rng.uniform(-15, 15)))
+                         for _ in range(len(self.images))]
+
+    def reference(self, images, order, mode, cval):
+        return np.stack([tf.warp(image.astype(np.float64) / 255, matrix, order=order, mode=mode, cval=cval)
+                         for image, matrix in zip(images, self.matrices)])
+
+    def test_same_as_skimage(self):
+        for order in [0, 1]:
+            for mode in warp.MODES:
+                for cval in [0.0, 0.5]:
+                    warped = warp.warp_batch(self.images, self.matrices, order=order, mode=mode, cval=cval * 255)
+                    expected = self.reference(self.images, order, mode, cval)
+                    self.assertEqual(warped.dtype, np.float32)
+                    self.assertTrue(np.allclose(warped / 255, expected, atol=1e-4),
+                                    "order %d, mode %s, cval %.1f" % (order, mode, cval))
+
+    def test_grayscale(self):
+        warped = warp.warp_batch(self.images[..., 0], self.matrices)
+        expected = self.reference(self.images[..., 0], 1, "constant", 0.0)
+        self.assertEqual(warped.shape, self.images.shape[:3])
+        self.assertTrue(np.allclose(warped / 255, expected, atol=1e-4))
+
+    def test_channel_first(self):
+        chw = np.ascontiguousarray(np.moveaxis(self.images, 3, 1))
+        for mode in ["constant", "reflect"]:
+            expected = warp.warp_batch(self.images, self.matrices, mode=mode, cval=10)
+            warped = warp.warp_batch(chw, self.matrices, mode=mode, cval=10, channel_first=True)
+            self.assertEqual(chw.shape, warped.shape)
+            self.assertTrue(np.array_equal(np.moveaxis(warped, 1, 3), expected), mode)
+
+    def test_image_indices(self):
+        warped = warp.warp_batch(self.images[:1], self.matrices, image_indices=np.zeros((6,), dtype=np.int32))
+        expected = self.reference([self.images[0]] * 6, 1, "constant", 0.0)
+        self.assertTrue(np.allclose(warped / 255, expected, atol=1e-4))
+
+    def test_chunks(self):
+        chunk_size = warp.CHUNK_SIZE
+        try:
+            warp.CHUNK_SIZE = 1000
+            warped = warp.warp_batch(self.images, self.matrices)
+        finally:
+            warp.CHUNK_SIZE = chunk_size
+        self.assertTrue(np.allclose(warped, warp.warp_batch(self.images, self.matrices)))
+
+    def test_out(self):
+        expected = warp.warp_batch(self.images, self.matrices)
+        out = np.zeros(self.images.shape, dtype=np.float32)
+        warped = warp.warp_batch(self.images, self.matrices, out=out)
+        self.assertTrue(warped is out)
+        self.assertTrue(np.array_equal(out, expected))
+
+    def test_integer_backend(self):
+        for order in [0, 1]:
+            for mode in warp.MODES:
+                for cval in [0.0, 1.0]:
+                    warped = warp.warp_batch(self.images, self.matrices, order=order, mode=mode,
+                                             cval=cval * 255, backend="integer")
+                    expected = self.reference(self.images, order, mode, cval) * 255
+                    self.assertEqual(warped.dtype, np.uint8)
+                    # exact for order 0, at most one level off the rounded
+                    # float result for order 1
+                    error = np.abs(warped - expected).max()
+                    self.assertTrue(error <= (0.5 if order == 0 else 1.5),
+                                    "order %d, mode %s, cval %.1f: %.2f" % (order, mode, cval, error))
+
+        chunk_size = warp.CHUNK_SIZE
+        try:
+            warp.CHUNK_SIZE = 1000
+            chunked = warp.warp_batch(self.images, self.matrices, backend="integer")
+        finally:
+            warp.CHUNK_SIZE = chunk_size
+        self.assertTrue(np.array_equal(chunked, warp.warp_batch(self.images, self.matrices, backend="integer")))
+
+        chw = np.ascontiguousarray(np.moveaxis(self.images, 3, 1))
+        out = np.zeros(chw.shape, dtype=np.uint8)
+        warped = warp.warp_batch(chw, self.matrices, channel_first=True, out=out, backend="integer")
+        self.assertTrue(warped is out)
+        self.assertTrue(np.array_equal(np.moveaxis(out, 1, 3), chunked))
+
+    def test_index_dtype(self):
+        self.assertEqual(np.int32, warp.index_dtype_for(2**31 - 1))
+        self.assertEqual(np.int64, warp.index_dtype_for(2**31))
+        # a batch whose indices need more bits than those of its images
+        sampling = warp.compute_sampling(self.matrices, (40, 50))
+        self.assertEqual(np.int32, sampling.indices.dtype)
+        index_dtype_for = warp.index_dtype_for
+        sizes = []
+        def more_bits_for_batches(nb_elements):
+            sizes.append(nb_elements)
+            return np.dtype(np.int64 if nb_elements > 43 * 53 else np.int32)
+        try:
+            warp.index_dtype_for = more_bits_for_batches
+            warped = warp.apply_sampling(self.images, sampling)
+        finally:
+            warp.index_dtype_for = index_dtype_for
+        self.assertEqual([6 * 43 * 53], sizes)
+        self.assertTrue(np.array_equal(warp.apply_sampling(self.images, sampling), warped))
+
+    def test_scratch_array(self):
+        a = warp.scratch_array("test", (4, 5))
+        b = warp.scratch_array("test", (2, 3), np.uint8)
+        self.assertEqual((2, 3), b.shape)
+        self.assertEqual(np.uint8, b.dtype)
+        self.assertTrue(np.shares_memory(a, b))
+        c = warp.scratch_array("test", (100,))
+        self.assertFalse(np.shares_memory(a, c))
+
+        warp.release_scratch()
+        d = warp.scratch_array("test", (2, 3))
+        self.assertFalse(np.shares_memory(c, d))
+
+if __name__ == '__main__':
+    unittest.main()
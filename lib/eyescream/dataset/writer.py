@@ -0,0 +1,188 @@
+"""
+Asynchronous image writer: encodes and writes images in background threads
+behind a bounded queue, so that encoding and write syscalls overlap with
+augmentation. The producer blocks when the queue is full (back-pressure).
+
+Example usage:
+        with AsyncWriter(threads=2, codec="jpg", quality=90) as writer:
+            for name, face in faces:
+                writer.submit("/tmp/aug/" + name, face) # extension is added
+        print(writer.stats["encode"], writer.stats["bytes_written"])
+"""
+from __future__ import print_function, division
+import io
+import os
+import threading
+from timeit import default_timer as timer
+import numpy as np
+from PIL import Image
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# codec -> file extension. "raw" writes numpy .npy files (uint8 pixels and a
+# small header with the shape), which need no decoding.
+CODECS = {"jpg": "jpg", "png": "png", "raw": "npy"}
+# scipy's misc.imsave wrote jpgs with PIL's default quality
+DEFAULT_QUALITY = 75
+
+def encode_image(image, codec="jpg", quality=DEFAULT_QUALITY):
+    """Encodes an image.
+    Args:
+        image       Numpy array of shape (H, W[, C]), uint8.
+        codec       One of CODECS.
+        quality     JPEG quality (1-95), ignored by the other codecs.
+    Returns:
+        Encoded bytes.
+    """
+    buf = io.BytesIO()
+    if codec == "raw":
+        np.save(buf, np.ascontiguousarray(image, dtype=np.uint8))
+    elif codec == "jpg":
+        Image.fromarray(image).save(buf, format="JPEG", quality=quality)
+    elif codec == "png":
+        # low compression levels are several times faster and only slightly larger
+        Image.fromarray(image).save(buf, format="PNG", compress_level=1)
+    else:
+        raise ValueError("Unknown codec '%s'." % (codec,))
+    return buf.getvalue()
+
+class AsyncWriter(object):
+    """Encodes and writes images in a pool of threads."""
+    def __init__(self, threads=2, queue_size=64, codec="jpg", quality=DEFAULT_QUALITY,
+                 fsync_every=0, stats=None):
+        """Instantiate a writer and start its threads.
+        Args:
+            threads         Number of encoding/writing threads. 0 encodes and
+                            writes in submit() itself.
+            queue_size      Maximum number of queued images, submit() blocks
+                            while the queue is full.
+            codec           Output format, one of CODECS.
+            quality         JPEG quality (1-95).
+            fsync_every     If > 0, each thread fsyncs its files (and their
+                            directories) once it has written this many, and
+                            on close(). Default is 0 (no fsync).
+            stats           Optional dict to accumulate into (see self.stats).
+        """
+        assert codec in CODECS, "Unknown codec '%s'." % (codec,)
+        self.codec = codec
+        self.extension = CODECS[codec]
+        self.quality = quality
+        self.fsync_every = fsync_every
+        # encode:        seconds spent encoding, summed over the threads
+        # write_io:      seconds spent in write and fsync, summed over the threads
+        # write_wait:    seconds submit() blocked on a full queue
+        # files_written, bytes_written
+        self.stats = stats if stats is not None else {}
+        for key in ["encode", "write_io", "write_wait", "files_written", "bytes_written"]:
+            self.stats.setdefault(key, 0)
+        self.lock = threading.Lock()
+        self.error = None
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.threads = []
+        self.unsynced = [] if threads == 0 else None
+        for _ in range(threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, fp, image):
+        """Queues an image to be written to fp + "." + the codec's extension.
+        Blocks while the queue is full. Raises the first error of the threads.
+        Returns:
+            Path the image will be written to.
+        """
+        self._raise_error()
+        fp = "%s.%s" % (fp, self.extension)
+        if len(self.threads) == 0:
+            self._write(fp, image, self.unsynced)
+            return fp
+        start = timer()
+        self.queue.put((fp, image))
+        waited = timer() - start
+        with self.lock:
+            self.stats["write_wait"] += waited
+        return fp
+
+    def close(self):
+        """Waits until all queued images are written (and synced), stops the
+        threads and raises the first error of the threads, if any."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.unsynced:
+            self._sync(self.unsynced)
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        unsynced = []
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            if self.error is not None:
+                # drain the queue, so that the producer does not block forever
+                continue
+            try:
+                self._write(task[0], task[1], unsynced)
+            except Exception as e:
+                self.error = e
+        try:
+            self._sync(unsynced)
+        except Exception as e:
+            self.error = self.error or e
+
+    def _write(self, fp, image, unsynced):
+        start = timer()
+        data = encode_image(image, self.codec, self.quality)
+        encoded = timer()
+        with open(fp, "wb") as f:
+            f.write(data)
+        end = timer()
+        with self.lock:
+            self.stats["encode"] += encoded - start
+            self.stats["write_io"] += end - encoded
+            self.stats["files_written"] += 1
+            self.stats["bytes_written"] += len(data)
+        if self.fsync_every > 0:
+            unsynced.append(fp)
+            if len(unsynced) >= self.fsync_every:
+                self._sync(unsynced)
+
+    def _sync(self, unsynced):
+        """fsyncs the files in unsynced and their directories, empties unsynced."""
+        if len(unsynced) == 0:
+            return
+        start = timer()
+        for fp in unsynced:
+            fd = os.open(fp, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        # the directory entries of new files are only durable after this
+        for fp_dir in set([os.path.dirname(fp) for fp in unsynced]):
+            fd = os.open(fp_dir or ".", os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        del unsynced[:]
+        with self.lock:
+            self.stats["write_io"] += timer() - start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,47 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from PIL import Image
+from lib.eyescream.dataset.writer import AsyncWriter
+
+class TestWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.images = np.random.RandomState(0).randint(0, 256, (10, 64, 64, 3)).astype(np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, **kwargs):
+        with AsyncWriter(**kwargs) as writer:
+            fps = [writer.submit(os.path.join(self.dir, "%03d" % i), image)
+                   for i, image in enumerate(self.images)]
+        return fps, writer.stats
+
+    def test_codecs(self):
+        for codec in ["jpg", "png", "raw"]:
+            fps, stats = self.write(codec=codec, threads=2, queue_size=2, fsync_every=3)
+            self.assertEqual(10, stats["files_written"])
+            self.assertEqual(sum([os.path.getsize(fp) for fp in fps]), stats["bytes_written"])
+            self.assertTrue(stats["encode"] > 0)
+            if codec == "jpg":
+                continue
+            for fp, image in zip(fps, self.images):
+                loaded = np.load(fp) if codec == "raw" else np.asarray(Image.open(fp))
+                self.assertTrue(np.array_equal(image, loaded))
+
+    def test_same_output(self):
+        sync_fps, _ = self.write(threads=0, quality=90)
+        sync = [open(fp, "rb").read() for fp in sync_fps]
+        async_fps, _ = self.write(threads=3, quality=90)
+        self.assertEqual(sync, [open(fp, "rb").read() for fp in async_fps])
+
+    def test_error(self):
+        writer = AsyncWriter(threads=2)
+        writer.submit(os.path.join(self.dir, "missing", "000"), self.images[0])
+        self.assertRaises(IOError, writer.close)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,15 @@ require 'image'
 --require 'datasets'
 require 'pl'
 require 'paths'
+require 'sys'
+
+-- wall-clock start, --timeBudget counts from here
+START_TIME = sys.clock()
+
+-- flush every line, so that callers reading our output through a pipe
+-- (e.g. main.py timing the epochs) see it as it happens
+io.stdout:setvbuf('line')
+
 ok, DISP = pcall(require, 'display')
 if not ok then print('display not found. unable to plot') end
 ADVERSARIAL = require('./adversarial')
@@ -51,6 +60,7 @@ OPT = lapp[[
   --denoise                                Whether to apply the denoiser trained with train_denoiser to the generated images
   --aws                                    Activate AWS settings
   --epochs           (default 1)           Number of epochs for which to train
+  --timeBudget       (default 0)           Wall-clock seconds to train for (overrides --epochs, 0 is off)
   --dataDir          (default "dataset/out_aug_64x64")
 ]]
 
@@ -203,9 +213,18 @@ function main()
     -- the networks were loaded from file)
     VIS_NOISE_INPUTS = NN_UTILS.createNoiseInputs(100)
 
+    -- With a time budget we train as many batches as fit into it (see
+    -- adversarial.train), otherwise for a fixed number of epochs.
+    TRAIN_DEADLINE = nil
+    if OPT.timeBudget > 0 then
+        TRAIN_DEADLINE = START_TIME + OPT.timeBudget
+    end
+    BUDGET_EXHAUSTED = false
+    BATCHES_COMPLETED = 0
+
     -- training loop
     EPOCH = 1
-    while EPOCH <= OPT.epochs do
+    while (TRAIN_DEADLINE ~= nil and not BUDGET_EXHAUSTED) or (TRAIN_DEADLINE == nil and EPOCH <= OPT.epochs) do
         print('Loading new training data...')
         TRAIN_DATA = DATASET.loadRandomImages(OPT.N_epoch)
         
@@ -215,6 +234,11 @@ function main()
     
         ADVERSARIAL.train(TRAIN_DATA, OPT.D_maxAcc, math.max(20, math.min(1000/OPT.batchSize, 250)))
     end
+
+    print(string.format("<trainer> completed %d batches in %.3f s", BATCHES_COMPLETED, sys.clock() - START_TIME))
+    if BUDGET_EXHAUSTED then
+        print(string.format("<trainer> time budget of %.3f s exhausted", OPT.timeBudget))
+    end
 end
 
 --------------------------------------
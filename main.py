@@ -1,9 +1,20 @@
 from lib.c3_sdk_python_0_0_2 import sdk
 from lib.eyescream.dataset import generate_dataset as gd
 from PIL import Image
+import contextlib
 import io
+import json
+import math
 import os
+import re
+import shutil
+import struct
 import subprocess
+import sys
+import threading
+import time
+import zlib
+import numpy as np
 
 c3 = None
 PillowImageRequired = Exception("pillow image is required")
@@ -26,8 +37,38 @@ networkAbsPath = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + netw
 oldNetworkAbsPath = networkAbsPath + os.path.sep + "old.net"
 newNetworkAbsPath = networkAbsPath + os.path.sep + "adversarial.net"
 scriptFileAbsPath = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + scriptFileRelPath
+# the trainer is run as [trainerExecutable, scriptFileAbsPath, options...]
+trainerExecutable = "th"
+# on hosts with more than 2 cpus, this many cpus are left to the c3 server and
+# the rest of this process while the trainer runs
+reservedCpus = 1
+# niceness added to the trainer, so that serving is not starved by training
+trainerNice = 5
+maxTrainerBatchSize = 32
+# default wall-clock seconds the trainer may spend per acceptImage, None trains
+# for the fixed number of epochs of train.lua. the trainer gets killed if it
+# overruns its budget by more than trainerBudgetGrace seconds.
+trainingBudgetSeconds = None
+trainerBudgetGrace = 60
+timingsAbsPath = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + tmpDir + os.path.sep + "timings.jsonl"
+# once the timings file reaches this size, it is moved to <file>.1 (replacing
+# the previous one) and a new one is started, so at most twice this is kept
+timingsMaxBytes = 16 * 2**20
+# cached listing of inputAbsPath, so gd.gen does not relist unchanged directories
+inputIndexAbsPath = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + tmpDir + os.path.sep + "input_index.json"
+# outputs of gd.gen per input image content, so every image is only augmented
+# once and its faces keep their names (kept outside of augAbsPath, which is
+# copied into the state file by file)
+augManifestAbsPath = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + tmpDir + os.path.sep + "aug_manifest.json"
+# sample the augmented faces directly at their output size, see gd.FUSED_CROP
+augFusedCrop = True
 augImagesKey = "aug_images"
 networkKey = "network"
+networkDeltasKey = "network_deltas"
+# the latest network is stored as a base blob plus a chain of deltas against
+# the previous version. once this many deltas have accumulated, the next
+# network is stored as a new base, which bounds the reconstruction cost.
+networkRebaseInterval = 10
 
 def main():
     global c3
@@ -57,11 +98,66 @@ def initState():
             im = imageFromBytes(b)
             im.save(augAbsPath + os.path.sep + idx + standardImgFormat)
 
+    writeBytesToFile(reconstructNetwork(), oldNetworkAbsPath)
+
+def reconstructNetwork():
+    global c3
     network = bytearray()
     if networkKey in c3.state:
         network = c3.state[networkKey]
 
-    writeBytesToFile(network, oldNetworkAbsPath) 
+    if networkDeltasKey in c3.state:
+        for delta in c3.state[networkDeltasKey]:
+            network = applyNetworkDelta(network, delta)
+
+    return network
+
+# a delta is the length of the new network followed by the zlib compressed xor
+# of the new network against the previous one (truncated or zero padded to the
+# new length). weights which did not change xor to runs of zero bytes, so the
+# compressed delta grows with what actually changed between two versions.
+def networkDelta(prev, curr):
+    size = len(curr)
+    xored = np.frombuffer(curr, dtype=np.uint8).copy()
+    xorPrefix(xored, prev)
+
+    return struct.pack("<Q", size) + zlib.compress(xored)
+
+def applyNetworkDelta(prev, delta):
+    size, = struct.unpack_from("<Q", delta)
+    curr = np.frombuffer(zlib.decompress(delta[8:]), dtype=np.uint8).copy()
+    assert len(curr) == size
+    xorPrefix(curr, prev)
+
+    return curr.tobytes()
+
+# xors prev (truncated to the length of arr, the rest counts as zeros) into
+# the uint8 array arr in place
+def xorPrefix(arr, prev):
+    common = min(len(prev), len(arr))
+    prev = np.frombuffer(prev, dtype=np.uint8, count=common)
+    np.bitwise_xor(arr[:common], prev, out=arr[:common])
+
+def storeNetwork(network):
+    global c3
+    # old.net always holds the latest network of the chain, see initState
+    prev = readBytesFromFile(oldNetworkAbsPath)
+    delta = networkDelta(prev, network)
+
+    deltas = []
+    if networkDeltasKey in c3.state:
+        deltas = c3.state[networkDeltasKey]
+
+    rebase = not networkKey in c3.state or len(c3.state[networkKey]) == 0 \
+        or len(deltas) >= networkRebaseInterval or len(delta) >= len(network)
+    if rebase:
+        c3.state[networkKey] = network
+        c3.state[networkDeltasKey] = []
+    else:
+        c3.state[networkDeltasKey] = deltas + [delta]
+
+    # the next training run continues from (and is diffed against) this network
+    writeBytesToFile(network, oldNetworkAbsPath)
 
 def writeBytesToFile(b, fileName):
     with open(fileName, 'wb+') as f:
@@ -85,60 +181,339 @@ def imageToBytes(name, ext, img):
 
     return b
 
-def acceptImage(img):
+# the budget is keyword-only: the c3 sdk invokes registered methods with two
+# positional arguments (key and value), which must not be taken as a budget
+def acceptImage(img, *, trainingBudget=None):
     if img == None:
         print("pillow image is required")
         raise PillowImageRequired
 
-    imgCP = img.copy()
+    if trainingBudget == None:
+        trainingBudget = trainingBudgetSeconds
+
+    record = newTimingRecord()
     try:
-        imgCP.verify()
+        acceptImageTimed(img, record, trainingBudget)
+        record["result"] = "ok"
 
     except Exception as err:
-        print("invalid img", err)
-        raise InvalidImage
+        record["result"] = str(err)
+        raise
+
+    finally:
+        record["stages"]["total"] = time.perf_counter() - record["start"]
+        emitTimingRecord(record)
+
+def acceptImageTimed(img, record, trainingBudget=None):
+    with timeStage(record, "verify"):
+        imgCP = img.copy()
+        try:
+            imgCP.verify()
+
+        except Exception as err:
+            print("invalid img", err)
+            raise InvalidImage
 
-    img.save(inputAbsPath + os.path.sep + "input.jpg", format=standardImgFormat)
+    inputFileAbsPath = inputAbsPath + os.path.sep + "input.jpg"
+    with timeStage(record, "save"):
+        img.save(inputFileAbsPath, format=standardImgFormat)
+    record["bytes"]["input"] = os.path.getsize(inputFileAbsPath)
+
+    resources = planResources()
+    record["resources"] = resources
 
     # augment the input image and save it to disk
-    gd.gen(inputAbsPath, augAbsPath, unaugAbsPath)
+    with timeStage(record, "augment"):
+        gd.gen(inputAbsPath, augAbsPath, unaugAbsPath, stats=record["augment"],
+               workers=resources["augWorkers"], index_path=inputIndexAbsPath,
+               manifest_path=augManifestAbsPath, fused_crop=augFusedCrop)
 
     # run an epoch of the model and save the weights
     # note: it's not ideal to run an epoch after each image is added \
     #       but this code is for example purposes, only...
-    result = None
+    returncode = None
     try:
-        cmd = ["th", scriptFileAbsPath]
+        cmd = [trainerExecutable, scriptFileAbsPath]
         if os.stat(oldNetworkAbsPath).st_size != 0:
             cmd.extend(["--network", oldNetworkAbsPath])
 
         cmd.extend(["--save", networkAbsPath, "--dataDir", augAbsPath])
-        result = subprocess.run(cmd)
+        cmd.extend(["--threads", str(resources["trainerThreads"]),
+                    "--batchSize", str(resources["batchSize"])])
+
+        timeout = None
+        if trainingBudget != None:
+            cmd.extend(["--timeBudget", str(trainingBudget)])
+            timeout = trainingBudget + trainerBudgetGrace
+
+        with timeStage(record, "train"):
+            returncode = runTrainer(cmd, record["trainer"], resources, timeout)
 
     except Exception as err:
         print("subprocess errored", err)
         raise SubprocessFailed
 
-    if result.returncode != 0:
-        print("Preprocess failed: ", result.stderr, result)
+    if returncode != 0:
+        print("Preprocess failed: ", returncode)
         raise TrainingFailed
 
-    gatherState()
+    with timeStage(record, "gatherState"):
+        gatherState(record)
 
-def gatherState():
-    global c3
-    if not networkKey in c3.state:
-        c3.state[networkKey] = bytearray()
+# runs the trainer, echoing its output while timestamping the lines that mark
+# the end of the startup (model creation or loading) and the epochs
+trainerLoadingPattern = re.compile(r"^Loading new training data")
+trainerEpochPattern = re.compile(r"^<trainer> Epoch #(\d+)")
+trainerEpochTimePattern = re.compile(r"^<trainer> time required for this epoch = ([\d.]+) s")
+trainerLossPattern = re.compile(r"^<trainer> mean loss D = ([^,\s]+), G = ([^,\s]+)")
+trainerBatchesPattern = re.compile(r"^<trainer> completed (\d+) batches")
+trainerBudgetPattern = re.compile(r"^<trainer> time budget of [\d.]+ s exhausted")
+
+def runTrainer(cmd, trainer, resources=None, timeout=None):
+    env = None
+    if resources != None:
+        env = dict(os.environ)
+        env["OMP_NUM_THREADS"] = str(resources["trainerThreads"])
+        cmd = confineTrainer(cmd, resources)
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, env=env)
+
+    killer = None
+    if timeout != None:
+        killer = threading.Timer(timeout, proc.kill)
+        killer.daemon = True
+        killer.start()
+
+    try:
+        for line in proc.stdout:
+            sys.stdout.write(line)
+            parseTrainerLine(line, time.perf_counter() - start, trainer)
+
+        return proc.wait()
+
+    finally:
+        if killer != None:
+            killer.cancel()
+
+# returns cmd prefixed with taskset and nice to pin the trainer to its cpus and
+# lower its priority. done by the commands instead of a preexec_fn, which may
+# deadlock in this process as the c3 sdk always runs threads.
+def confineTrainer(cmd, resources):
+    prefix = []
+    if len(resources["trainerCpus"]) > 0 and shutil.which("taskset") != None:
+        prefix.extend(["taskset", "-c", ",".join(str(cpu) for cpu in resources["trainerCpus"])])
+    if trainerNice > 0 and shutil.which("nice") != None:
+        prefix.extend(["nice", "-n", str(trainerNice)])
+    return prefix + list(cmd)
 
-    with open(newNetworkAbsPath, "rb+") as file:
-        c3.state[networkKey] = file.read()
+# returns the cpus this process may run on, which are further limited by the
+# cgroup cpu quota (e.g. docker --cpus) if there is one
+def availableCpus():
+    cpus = list(range(os.cpu_count() or 1))
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+
+    quota = cgroupCpuQuota()
+    if quota != None:
+        cpus = cpus[:max(1, int(math.floor(quota)))]
+
+    return cpus
+
+# returns the cgroup cpu quota in cpus (quota / period) or None if unlimited
+def cgroupCpuQuota():
+    # cgroup v2
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / float(period)
+        return None
+
+    except (IOError, OSError, ValueError):
+        pass
+
+    # cgroup v1
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / float(period)
+
+    except (IOError, OSError, ValueError):
+        pass
+
+    return None
+
+# decides how many processes augment the images, how many threads the trainer
+# runs with, which cpus it is pinned to and its batch size (at least 8 examples
+# per thread, up to maxTrainerBatchSize). augmentation finishes before the
+# trainer starts, so it may use all cpus.
+def planResources(cpus=None):
+    if cpus == None:
+        cpus = availableCpus()
+
+    trainerCpus = cpus
+    if len(cpus) > 2:
+        trainerCpus = cpus[reservedCpus:]
+
+    threads = len(trainerCpus)
+    batchSize = max(4, min(maxTrainerBatchSize, 8 * threads))
+    batchSize -= batchSize % 2
+
+    return {
+        "cpus": len(cpus),
+        "augWorkers": len(cpus),
+        "trainerCpus": trainerCpus,
+        "trainerThreads": threads,
+        "batchSize": batchSize,
+    }
+
+def parseTrainerLine(line, elapsed, trainer):
+    match = trainerBatchesPattern.match(line)
+    if match:
+        trainer["batches"] = int(match.group(1))
+        return
+
+    if trainerBudgetPattern.match(line):
+        trainer["budgetExhausted"] = True
+        return
+
+    epochs = trainer["epochs"]
+    if trainerLoadingPattern.match(line):
+        if not "startup" in trainer:
+            trainer["startup"] = elapsed
+        epochs.append({"loadStart": elapsed})
+        return
+
+    match = trainerEpochPattern.match(line)
+    if match:
+        if len(epochs) == 0:
+            epochs.append({"loadStart": elapsed})
+        epochs[-1]["epoch"] = int(match.group(1))
+        epochs[-1]["load"] = elapsed - epochs[-1]["loadStart"]
+        epochs[-1]["trainStart"] = elapsed
+        return
+
+    if len(epochs) == 0:
+        return
+
+    match = trainerEpochTimePattern.match(line)
+    if match:
+        epochs[-1]["train"] = elapsed - epochs[-1].get("trainStart", elapsed)
+        epochs[-1]["reported"] = float(match.group(1))
+        return
+
+    match = trainerLossPattern.match(line)
+    if match:
+        epochs[-1]["lossD"] = float(match.group(1))
+        epochs[-1]["lossG"] = float(match.group(2))
+
+def gatherState(record=None):
+    global c3
+    network = readBytesFromFile(newNetworkAbsPath)
+    storeNetwork(network)
 
     c3.state[augImagesKey] = []
+    augBytes = 0
     # r=root, d=directories, f=files
     for r, d, f in os.walk(augAbsPath):
         for file in f:
             if "." + standardImgFormat in file:
-                c3.state[augImagesKey].append(readBytesFromFile(os.path.join(r, file)))
+                b = readBytesFromFile(os.path.join(r, file))
+                augBytes += len(b)
+                c3.state[augImagesKey].append(b)
+
+    if record is not None:
+        record["bytes"]["network"] = len(network)
+        record["bytes"]["augImages"] = augBytes
+        if networkDeltasKey in c3.state and len(c3.state[networkDeltasKey]) > 0:
+            record["bytes"]["networkDelta"] = len(c3.state[networkDeltasKey][-1])
+
+# timing records are appended to timingsAbsPath as one json object per line.
+# "stages" and "bytes" hold the seconds and byte counts of the main pipeline,
+# "augment" the stats of gd.gen and "trainer" the trainer startup and epochs.
+def newTimingRecord():
+    return {
+        "time": time.time(),
+        "start": time.perf_counter(),
+        "stages": {},
+        "bytes": {},
+        "augment": {},
+        "trainer": {"epochs": []},
+    }
+
+@contextlib.contextmanager
+def timeStage(record, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record["stages"][stage] = record["stages"].get(stage, 0.0) + time.perf_counter() - start
+
+def emitTimingRecord(record, fileName=None):
+    if fileName == None:
+        fileName = timingsAbsPath
+
+    record = dict(record)
+    del record["start"]
+    if os.path.exists(fileName) and os.path.getsize(fileName) >= timingsMaxBytes:
+        os.replace(fileName, fileName + ".1")
+    with open(fileName, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+def flattenTimingRecord(record):
+    values = {}
+    for group in ["stages", "bytes", "augment"]:
+        for key, val in record.get(group, {}).items():
+            values[group + "." + key] = val
+
+    trainer = record.get("trainer", {})
+    if "startup" in trainer:
+        values["trainer.startup"] = trainer["startup"]
+    for epoch in trainer.get("epochs", []):
+        for key in ["load", "train", "lossD", "lossG"]:
+            if key in epoch:
+                values.setdefault("trainer.epoch." + key, []).append(epoch[key])
+
+    return values
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    pos = (len(values) - 1) * p / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+# aggregates the timing records of a file into percentiles per value, e.g.
+# {"stages.train": {"count": 10, "p50": 4.2, "p90": 5.0, "p99": 5.3}}
+def summarizeTimings(fileName=None, percentiles=(50, 90, 99)):
+    if fileName == None:
+        fileName = timingsAbsPath
+
+    samples = {}
+    with open(fileName, "r") as f:
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            for key, val in flattenTimingRecord(json.loads(line)).items():
+                if isinstance(val, list):
+                    samples.setdefault(key, []).extend(val)
+                else:
+                    samples.setdefault(key, []).append(val)
+
+    summary = {}
+    for key, vals in samples.items():
+        summary[key] = {"count": len(vals)}
+        for p in percentiles:
+            summary[key]["p%d" % p] = percentile(vals, p)
+
+    return summary
 
 if __name__ == "__main__":
     main()
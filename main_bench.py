@@ -0,0 +1,198 @@
+"""
+Benchmarks main.initState/acceptImage end to end, with test_files/stub_trainer.py
+standing in for `th train.lua`, so that regressions in the python pipeline show
+up without Torch or a GPU. Note that the tmp directories of main.py are wiped
+before each image size. The baseline is kept in tmp/ with the other run
+artifacts, so save one on the machine you compare on.
+
+Run with:
+    python main_bench.py --sizes 250,500 --images 10
+    python main_bench.py --save-baseline
+    python main_bench.py --compare --threshold 0.2
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import time
+import numpy as np
+from PIL import Image
+import main
+
+benchDir = "test_files"
+stubTrainerAbsPath = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + benchDir + os.path.sep + "stub_trainer.py"
+baselineAbsPath = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + main.tmpDir + os.path.sep + "main_bench_baseline.json"
+benchTimingsAbsPath = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + main.tmpDir + os.path.sep + "bench_timings.jsonl"
+
+# metrics compared against the baseline and whether higher values are better
+comparedMetrics = {
+    "throughput": True,
+    "latency.p50": False,
+    "latency.p90": False,
+    "latency.p99": False,
+    "peakRssKb": False,
+    "diskWritePerImage": False,
+    "stateBytesPerImage": False,
+}
+
+# sdk.NewC3() starts non-daemon threads and reads the container state file,
+# the pipeline only needs the state dict
+class BenchC3():
+    def __init__(self):
+        self.state = {}
+
+def syntheticFace(size, seed):
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:size, 0:size] / float(size)
+    # a bright ellipse with a random tint on a noisy background
+    face = ((x - 0.5) ** 2 / 0.09 + (y - 0.5) ** 2 / 0.16) < 1.0
+    img = rng.randint(0, 64, (size, size, 3))
+    img[face] = rng.randint(120, 230, 3) + rng.randint(-20, 20, (int(face.sum()), 3))
+
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8), "RGB")
+
+# returns the bytes read and written by this process and its waited-for children
+def diskIO():
+    read, written = 0, 0
+    if os.path.exists("/proc/self/io"):
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                key, val = line.split(":")
+                if key == "read_bytes":
+                    read += int(val)
+                elif key == "write_bytes":
+                    written += int(val)
+    else:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        read += usage.ru_inblock * 512
+        written += usage.ru_oublock * 512
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read += usage.ru_inblock * 512
+    written += usage.ru_oublock * 512
+
+    return read, written
+
+def peakRssKb():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def stateBytes(state):
+    total = 0
+    for val in state.values():
+        if isinstance(val, list):
+            total += sum([len(v) for v in val])
+        else:
+            total += len(val)
+    return total
+
+def resetWorkDirs():
+    for path in [main.inputAbsPath, main.augAbsPath, main.unaugAbsPath, main.networkAbsPath]:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    for path in [benchTimingsAbsPath, main.inputIndexAbsPath, main.augManifestAbsPath]:
+        if os.path.exists(path):
+            os.remove(path)
+
+def benchSize(size, nbImages):
+    resetWorkDirs()
+    main.c3 = BenchC3()
+    main.initState()
+
+    latencies = []
+    ioStart = diskIO()
+    for i in range(nbImages):
+        img = syntheticFace(size, i)
+        start = time.perf_counter()
+        main.acceptImage(img)
+        latencies.append(time.perf_counter() - start)
+    ioEnd = diskIO()
+
+    result = {
+        "images": nbImages,
+        "throughput": nbImages / sum(latencies),
+        "latency": {},
+        "peakRssKb": peakRssKb(),
+        "diskReadPerImage": (ioEnd[0] - ioStart[0]) / float(nbImages),
+        "diskWritePerImage": (ioEnd[1] - ioStart[1]) / float(nbImages),
+        "stateBytesPerImage": stateBytes(main.c3.state) / float(nbImages),
+        "stages": main.summarizeTimings(benchTimingsAbsPath),
+    }
+    for p in [50, 90, 99]:
+        result["latency"]["p%d" % p] = main.percentile(latencies, p)
+
+    return result
+
+def metric(result, name):
+    val = result
+    for key in name.split("."):
+        val = val[key]
+    return val
+
+# returns a list of (size, metric, baseline, current) for every metric that got
+# worse than the baseline by more than threshold (e.g. 0.2 is 20%)
+def compare(results, baseline, threshold):
+    regressions = []
+    for size, result in results.items():
+        if size not in baseline:
+            continue
+        for name, higherIsBetter in comparedMetrics.items():
+            old, new = metric(baseline[size], name), metric(result, name)
+            if old == 0:
+                continue
+            change = (new - old) / float(old)
+            if higherIsBetter:
+                change = -change
+            if change > threshold:
+                regressions.append((size, name, old, new))
+
+    return regressions
+
+def benchMain():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="250,320,500", help="comma separated face sizes in pixels")
+    parser.add_argument("--images", type=int, default=10, help="images to accept per size")
+    parser.add_argument("--network-mb", default="160", help="size of the stub network")
+    parser.add_argument("--training-budget", type=float, default=None, help="seconds, see main.trainingBudgetSeconds")
+    parser.add_argument("--baseline", default=baselineAbsPath)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+    # before running all sizes only to fail on opening it
+    if args.compare and not args.save_baseline and not os.path.isfile(args.baseline):
+        print("nothing to compare with:", args.baseline, "does not exist, run with --save-baseline")
+        return 2
+
+    main.trainerExecutable = sys.executable
+    main.scriptFileAbsPath = stubTrainerAbsPath
+    main.timingsAbsPath = benchTimingsAbsPath
+    main.trainingBudgetSeconds = args.training_budget
+    os.environ["STUB_NETWORK_MB"] = args.network_mb
+
+    results = {}
+    for size in args.sizes.split(","):
+        results[size] = benchSize(int(size), args.images)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("baseline saved to", args.baseline)
+
+    if args.compare:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for size, name, old, new in regressions:
+            print("[regression] size %s: %s went from %.4g to %.4g" % (size, name, old, new))
+        if len(regressions) > 0:
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(benchMain())
@@ -1,5 +1,8 @@
 import unittest
+import json
 import os
+import shutil
+import tempfile
 import main
 from lib.c3_sdk_python_0_0_2 import sdk
 from lib.eyescream.dataset import generate_dataset as gd
@@ -16,7 +19,32 @@ testUnaugAbsPath = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + te
 testNetworkAbsPath = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + testNetworkRelPath
 testInputAbsPath = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + testInputRelPath
 
+# paths of main that the tests redirect into a temporary directory
+mainTmpPaths = {
+    "inputAbsPath": "input",
+    "augAbsPath": "aug_64x64",
+    "unaugAbsPath": "unaug_64x64",
+    "networkAbsPath": "network",
+    "oldNetworkAbsPath": "network" + os.path.sep + "old.net",
+    "newNetworkAbsPath": "network" + os.path.sep + "adversarial.net",
+    "timingsAbsPath": "timings.jsonl",
+    "inputIndexAbsPath": "input_index.json",
+    "augManifestAbsPath": "aug_manifest.json",
+}
+
 class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.mainPaths = {}
+        for name, relPath in mainTmpPaths.items():
+            self.mainPaths[name] = getattr(main, name)
+            setattr(main, name, self.tmpDir + os.path.sep + relPath)
+
+    def tearDown(self):
+        for name, path in self.mainPaths.items():
+            setattr(main, name, path)
+        shutil.rmtree(self.tmpDir)
+
     def test_gd_gen(self):
         gd.gen(testInputAbsPath, testAugAbsPath, testUnaugAbsPath)
 
@@ -35,5 +63,111 @@ class TestMain(unittest.TestCase):
         self.assertTrue(0 < len(list(c3.state[main.networkKey])))
         self.assertTrue(0 < len(list(c3.state[main.augImagesKey])))
 
+    def test_network_delta(self):
+        prev = bytes(range(256)) * 64
+        curr = bytearray(prev)
+        curr[1000:1010] = bytes(10)
+        curr.extend(b"grown")
+
+        delta = main.networkDelta(prev, bytes(curr))
+        self.assertTrue(len(delta) < len(curr))
+        self.assertEqual(bytes(curr), main.applyNetworkDelta(prev, delta))
+
+        shrunk = main.networkDelta(curr, prev[:100])
+        self.assertEqual(prev[:100], main.applyNetworkDelta(curr, shrunk))
+
+    def test_network_chain(self):
+        main.c3 = sdk.NewC3()
+        main.initState()
+
+        versions = [bytes([v]) * 4096 + bytes([v + 1]) * 4096 for v in range(main.networkRebaseInterval + 2)]
+        for network in versions:
+            main.storeNetwork(network)
+            self.assertEqual(network, bytes(main.reconstructNetwork()))
+
+        self.assertTrue(len(main.c3.state[main.networkDeltasKey]) < main.networkRebaseInterval)
+
+    def test_parse_trainer_output(self):
+        trainer = {"epochs": []}
+        lines = [
+            (1.0, "<torch> set nb of threads to 8"),
+            (5.0, "Loading new training data..."),
+            (6.0, "<trainer> Epoch #1 [batchSize = 32]"),
+            (9.5, "<trainer> time required for this epoch = 3.400 s"),
+            (9.6, "<trainer> mean loss D = 0.693147, G = nan"),
+            (9.7, "<trainer> completed 31 batches in 9.700 s"),
+            (9.7, "<trainer> time budget of 10.000 s exhausted"),
+        ]
+        for elapsed, line in lines:
+            main.parseTrainerLine(line, elapsed, trainer)
+
+        self.assertEqual(5.0, trainer["startup"])
+        epoch = trainer["epochs"][0]
+        self.assertEqual(1, epoch["epoch"])
+        self.assertEqual(1.0, epoch["load"])
+        self.assertEqual(3.5, epoch["train"])
+        self.assertEqual(3.4, epoch["reported"])
+        self.assertEqual(0.693147, epoch["lossD"])
+        self.assertEqual(31, trainer["batches"])
+        self.assertTrue(trainer["budgetExhausted"])
+
+    def test_summarize_timings(self):
+        fileName = testAbsPath + os.path.sep + "timings.jsonl"
+        if os.path.exists(fileName):
+            os.remove(fileName)
+
+        for i in range(1, 11):
+            record = main.newTimingRecord()
+            record["stages"]["train"] = float(i)
+            main.emitTimingRecord(record, fileName)
+
+        summary = main.summarizeTimings(fileName)
+        os.remove(fileName)
+        self.assertEqual(10, summary["stages.train"]["count"])
+        self.assertEqual(5.5, summary["stages.train"]["p50"])
+        self.assertAlmostEqual(9.91, summary["stages.train"]["p99"])
+
+    def test_rotate_timings(self):
+        maxBytes = main.timingsMaxBytes
+        main.timingsMaxBytes = 1000
+        try:
+            for i in range(100):
+                record = main.newTimingRecord()
+                record["stages"]["train"] = float(i)
+                main.emitTimingRecord(record)
+        finally:
+            main.timingsMaxBytes = maxBytes
+
+        self.assertTrue(os.path.getsize(main.timingsAbsPath) < 1000 + 200)
+        self.assertTrue(os.path.getsize(main.timingsAbsPath + ".1") < 1000 + 200)
+        self.assertEqual(["timings.jsonl", "timings.jsonl.1"], sorted(os.listdir(self.tmpDir)))
+        # the newest records are in the current file
+        with open(main.timingsAbsPath, "r") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(99.0, json.loads(lines[-1])["stages"]["train"])
+        self.assertTrue(main.summarizeTimings()["stages.train"]["count"] < 100)
+
+    def test_plan_resources(self):
+        plan = main.planResources([0])
+        self.assertEqual(1, plan["trainerThreads"])
+        self.assertEqual(8, plan["batchSize"])
+
+        plan = main.planResources(list(range(32)))
+        self.assertEqual(32, plan["cpus"])
+        self.assertEqual(32 - main.reservedCpus, plan["trainerThreads"])
+        self.assertEqual(main.maxTrainerBatchSize, plan["batchSize"])
+        self.assertTrue(0 not in plan["trainerCpus"])
+
+        self.assertTrue(0 < len(main.availableCpus()))
+
+    def test_confine_trainer(self):
+        plan = main.planResources(list(range(4)))
+        cmd = main.confineTrainer(["th", "train.lua"], plan)
+        self.assertEqual(["th", "train.lua"], cmd[-2:])
+        if shutil.which("taskset") != None:
+            self.assertEqual(["taskset", "-c", "1,2,3"], cmd[:3])
+        if shutil.which("nice") != None:
+            self.assertEqual(["nice", "-n", str(main.trainerNice)], cmd[-5:-2])
+
 if __name__ == '__main__':
     unittest.main()
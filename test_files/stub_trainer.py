@@ -0,0 +1,67 @@
+"""
+Stand-in for `th train.lua`, used by main_bench.py to benchmark the python
+side of acceptImage without Torch or a GPU.
+
+It accepts the same command line as train.lua, prints the lines main.py parses
+from the trainer output and writes <save>/adversarial.net. Without --network a
+random network of STUB_NETWORK_MB megabytes is written, otherwise the given
+network is reloaded and the lowest byte of every float is changed, which is
+roughly what a training run does to the weights.
+
+Environment:
+    STUB_NETWORK_MB         Size of a new network (default 160, about the size
+                            of the G/D pair at --scale 32).
+    STUB_EPOCH_SECONDS      Seconds to sleep per epoch (default 0).
+"""
+import argparse
+import os
+import sys
+import time
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--network", default="")
+    parser.add_argument("--save", default="logs")
+    parser.add_argument("--dataDir", default="dataset/out_aug_64x64")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--batchSize", type=int, default=32)
+    parser.add_argument("--timeBudget", type=float, default=0)
+    args, _ = parser.parse_known_args()
+
+    if len(os.listdir(args.dataDir)) == 0:
+        print("given directory doesnt contain any files")
+        return 1
+
+    if args.network != "":
+        with open(args.network, "rb") as f:
+            network = bytearray(f.read())
+        network[0::4] = os.urandom(len(network[0::4]))
+    else:
+        network = os.urandom(int(float(os.environ.get("STUB_NETWORK_MB", "160")) * 1024 * 1024))
+
+    start = time.time()
+    epochSeconds = float(os.environ.get("STUB_EPOCH_SECONDS", "0"))
+    if args.timeBudget > 0:
+        epochSeconds = min(epochSeconds, args.timeBudget / float(args.epochs))
+    for epoch in range(1, args.epochs + 1):
+        print("Loading new training data...")
+        print("<trainer> Epoch #%d [batchSize = %d]" % (epoch, args.batchSize))
+        epochStart = time.time()
+        time.sleep(epochSeconds)
+        print("<trainer> time required for this epoch = %.3f s" % (time.time() - epochStart,))
+        print("<trainer> mean loss D = %f, G = %f" % (0.693147, 0.693147))
+        sys.stdout.flush()
+
+    print("<trainer> completed %d batches in %.3f s" % (args.epochs, time.time() - start))
+    if args.timeBudget > 0:
+        print("<trainer> time budget of %.3f s exhausted" % (args.timeBudget,))
+
+    if not os.path.exists(args.save):
+        os.makedirs(args.save)
+    with open(os.path.join(args.save, "adversarial.net"), "wb") as f:
+        f.write(network)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())